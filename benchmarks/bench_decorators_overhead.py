@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark decorators per call overhead when logging is disabled.
+
+With logging disabled, no log message is built, but each decorator still
+has its own per call work (counters, latency histogram, retry loop), so
+the overhead is some hundreds of nanoseconds, not zero.
+
+Usage (from the repository root, pcof does not need to be installed):
+    PYTHONPATH=. python benchmarks/bench_decorators_overhead.py
+"""
+
+import logging
+import timeit
+
+from pcof import decorators
+
+
+def func(value, option=None):
+    """Return value (decorated in the benchmark)."""
+    return value
+
+
+def main():
+    """Run benchmark."""
+    logging.getLogger(decorators.LOG.name).setLevel(logging.WARNING)
+    number = 200000
+    args = ([1, 2, 3] * 10,)
+
+    functions = [("undecorated", func)]
+    for name in ("num_calls", "debug", "retry_on_exception", "time_elapsed"):
+        functions.append((name, getattr(decorators, name)(func)))
+
+    baseline = None
+    for name, function in functions:
+        elapsed = min(
+            timeit.repeat(lambda: function(*args, option="x"), number=number, repeat=5)
+        )
+        per_call = elapsed / number * 1e9
+        if baseline is None:
+            baseline = per_call
+        print(
+            "{:20s} {:8.0f} ns/call  overhead {:6.0f} ns".format(
+                name, per_call, per_call - baseline
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark misc.freeze memory usage.
+
+Build a nested_dict tree with one million leaves and compare the memory
+used by the tree structure (containers and keys) before and after misc.freeze.
+
+Usage (from the repository root, pcof does not need to be installed):
+    PYTHONPATH=. python benchmarks/bench_misc_freeze.py [number_of_leaves]
+"""
+
+import sys
+
+from pcof import misc
+
+
+def build_tree(leaves):
+    """Build host -> interface -> counter tree (10 counters per interface)."""
+    tree = misc.nested_dict()
+    for num in range(leaves):
+        host, rest = divmod(num, 100)
+        iface, counter = divmod(rest, 10)
+        tree["host{}".format(host)]["eth{}".format(iface)][
+            "counter{}".format(counter)
+        ] = num
+    return tree
+
+
+def containers_size(obj):
+    """Return bytes used by the containers and keys of a tree.
+
+    Leaf values are not counted, so both trees are compared on the memory
+    used by their structure only. Shared objects (interned keys and
+    FrozenDict key indexes) are counted once.
+    """
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, str):
+            total += sys.getsizeof(node)
+        elif isinstance(node, misc.FrozenDict):
+            total += sys.getsizeof(node)
+            stack.append(node._index)
+            stack.append(node._values)
+            stack.extend(v for v in node.values() if isinstance(v, misc.FrozenDict))
+        elif isinstance(node, dict):
+            total += sys.getsizeof(node)
+            stack.extend(node)
+            stack.extend(v for v in node.values() if isinstance(v, dict))
+        elif isinstance(node, tuple):
+            total += sys.getsizeof(node)
+    return total
+
+
+def main():
+    """Run benchmark."""
+    leaves = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    tree = build_tree(leaves)
+    tree_size = containers_size(tree)
+    frozen = misc.freeze(tree)
+    frozen_size = containers_size(frozen)
+
+    print("leaves:       {}".format(leaves))
+    print("nested_dict:  {:.1f} MB".format(tree_size / 1024**2))
+    print("freeze:       {:.1f} MB".format(frozen_size / 1024**2))
+    print("savings:      {:.1f}%".format(100 - frozen_size * 100 / tree_size))
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark rate_limit overhead and accuracy.
+
+Overhead: cost of taking a token when tokens are available.
+Accuracy: calls/s achieved by several threads sharing one limiter.
+
+Usage (from the repository root, pcof does not need to be installed):
+    PYTHONPATH=. python benchmarks/bench_rate_limit.py
+"""
+
+import threading
+import time
+import timeit
+
+from pcof import decorators
+
+
+def func():
+    """Return None (decorated in the benchmark)."""
+    return None
+
+
+def overhead():
+    """Print per call overhead when tokens are always available."""
+    number = 200000
+    bucket = decorators.TokenBucket(1e12)
+    limited = decorators.rate_limit(limiter=decorators.TokenBucket(1e12))(func)
+
+    baseline = min(timeit.repeat(func, number=number, repeat=5)) / number * 1e9
+    for name, function in (
+        ("try_acquire", bucket.try_acquire),
+        ("rate_limit call", limited),
+    ):
+        per_call = min(timeit.repeat(function, number=number, repeat=5)) / number
+        per_call *= 1e9
+        print(
+            "{:20s} {:8.0f} ns/call  overhead {:6.0f} ns".format(
+                name, per_call, per_call - baseline
+            )
+        )
+
+
+def accuracy(rate, num_threads, seconds):
+    """Print calls/s achieved by threads sharing a limiter."""
+    limited = decorators.rate_limit(rate=rate, burst=1)(func)
+    calls = int(rate * seconds)
+    per_thread = calls // num_threads
+
+    def call():
+        for _ in range(per_thread):
+            limited()
+
+    threads = [threading.Thread(target=call) for _ in range(num_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print(
+        "rate {:>7} threads {:2d}: {:10.1f} calls/s "
+        "({:+.2f}% of the rate)".format(
+            rate,
+            num_threads,
+            per_thread * num_threads / elapsed,
+            (per_thread * num_threads / elapsed / rate - 1) * 100,
+        )
+    )
+
+
+def main():
+    """Run benchmark."""
+    overhead()
+    for rate in (100, 1000, 10000):
+        accuracy(rate, 8, 2)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4
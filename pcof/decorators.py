@@ -5,18 +5,415 @@ Python Collection Of Functions.
 Package with collection of small useful functions.
 
 Decorators functions
+
+Decorators can be used with functions, generators, coroutine functions
+(async def) and async generators.
 """
 
 
+import asyncio
+import atexit
+import collections
+import collections.abc
+import concurrent.futures
+import cProfile
 import functools
+import hashlib
+import heapq
+import inspect
+import itertools
+import json
 import logging
+import multiprocessing
+import os
+import pickle
+import pstats
+import random
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
+import weakref
 
 
 LOG = logging.getLogger(__name__)
 
 
-def num_calls(_func=None, *, loglevel="DEBUG", print_info=False):
+class _ThreadShards:
+    """
+    One object (shard) per thread, created by "factory" when needed.
+
+    Each thread updates only its own shard, so no lock is needed to update
+    it. Readers aggregate all shards.
+
+    When a thread exits, its shard is folded into a "retired" shard with
+    merge(retired, shard), which returns the new retired shard, so memory
+    does not grow with the number of threads that ever used it.
+    """
+
+    def __init__(self, factory, merge):
+        """Initialize shards."""
+        self._factory = factory
+        self._merge = merge
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        # id(shard) -> shard of the live threads
+        self._shards = {}
+        self._retired = factory()
+
+    def get(self):
+        """Return the shard of the current thread."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._factory()
+            # deleted with the thread local data, when the thread exits
+            self._local.sentinel = sentinel = _ShardSentinel()
+            finalizer = weakref.finalize(
+                sentinel, _ThreadShards._retire, weakref.ref(self), shard
+            )
+            finalizer.atexit = False
+            with self._lock:
+                self._shards[id(shard)] = shard
+            return shard
+
+    @staticmethod
+    def _retire(shards_ref, shard):
+        """Fold the shard of an exited thread into the retired shard."""
+        shards = shards_ref()
+        if shards is None:
+            return
+        with shards._lock:
+            # shard is not there after reset()
+            if shards._shards.get(id(shard)) is shard:
+                del shards._shards[id(shard)]
+                shards._retired = shards._merge(shards._retired, shard)
+
+    def all(self):
+        """Return a list with all shards."""
+        with self._lock:
+            return list(self._shards.values()) + [self._retired]
+
+    def reset(self):
+        """Remove all shards."""
+        with self._lock:
+            old_local = self._local
+            self._local = threading.local()
+            self._shards = {}
+            self._retired = self._factory()
+        # old shards are retired (ignored) outside the lock
+        del old_local
+
+
+class _ShardSentinel:
+    """Object deleted when the thread that owns a shard exits."""
+
+    __slots__ = ("__weakref__",)
+
+
+def _log_level(loglevel):
+    """Return log level number for the level name (e.g. DEBUG)."""
+    level = logging.getLevelName(loglevel.upper())
+    if not isinstance(level, int):
+        raise ValueError("Invalid loglevel")
+    return level
+
+
+def _log(level, print_info, msg, *args):
+    """
+    Log (and print) message.
+
+    The message is formatted only if it is logged or printed. Callers
+    check LOG.isEnabledFor(level) (or print_info) before calling it, so
+    arguments are not even collected when nothing would be shown.
+    """
+    LOG.log(level, msg, *args)
+    if print_info:
+        print(msg % args)
+
+
+def _wrap(func, before, after=None, failed=None, async_before=None):
+    """
+    Return a wrapper of "func" calling the hooks around its execution.
+
+    before(args, kwargs) is called before the execution and the value it
+    returns is passed to after(state, args, kwargs, result), called when
+    the execution finishes without exception, or to failed(state, error),
+    called when it raises an exception (that is raised again).
+    If async_before is set, it is awaited instead of calling before for
+    coroutine functions and async generators.
+
+    Coroutine functions are awaited and generators (sync and async) are
+    consumed inside the wrapper, so the hooks see the real execution and
+    not only the creation of the coroutine/generator object. The result
+    of a generator is its return value (always None for async generators).
+    """
+    if inspect.iscoroutinefunction(func):
+
+        async def wrapped_f(*args, **kwargs):
+            if async_before is None:
+                state = before(args, kwargs)
+            else:
+                state = await async_before(args, kwargs)
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException as error:
+                if failed is not None:
+                    failed(state, error)
+                raise
+            if after is not None:
+                after(state, args, kwargs, result)
+            return result
+
+    elif inspect.isasyncgenfunction(func):
+
+        async def wrapped_f(*args, **kwargs):
+            if async_before is None:
+                state = before(args, kwargs)
+            else:
+                state = await async_before(args, kwargs)
+            agen = func(*args, **kwargs)
+            # forward values, asend() and athrow() to the async generator
+            try:
+                value = await agen.__anext__()
+                while True:
+                    try:
+                        sent = yield value
+                    except GeneratorExit:
+                        await agen.aclose()
+                        raise
+                    except BaseException as error:
+                        value = await agen.athrow(error)
+                    else:
+                        value = await agen.asend(sent)
+            except StopAsyncIteration:
+                pass
+            except BaseException as error:
+                if failed is not None:
+                    failed(state, error)
+                raise
+            if after is not None:
+                after(state, args, kwargs, None)
+
+    elif inspect.isgeneratorfunction(func):
+
+        def wrapped_f(*args, **kwargs):
+            state = before(args, kwargs)
+            try:
+                result = yield from func(*args, **kwargs)
+            except BaseException as error:
+                if failed is not None:
+                    failed(state, error)
+                raise
+            if after is not None:
+                after(state, args, kwargs, result)
+            return result
+
+    else:
+
+        def wrapped_f(*args, **kwargs):
+            state = before(args, kwargs)
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as error:
+                if failed is not None:
+                    failed(state, error)
+                raise
+            if after is not None:
+                after(state, args, kwargs, result)
+            return result
+
+    return functools.wraps(func)(wrapped_f)
+
+
+def _resume(gen, value):
+    """Yield "value", already produced by generator "gen", and the rest of gen."""
+    try:
+        while True:
+            try:
+                sent = yield value
+            except GeneratorExit:
+                gen.close()
+                raise
+            except BaseException as error:
+                value = gen.throw(error)
+            else:
+                value = gen.send(sent)
+    except StopIteration as stop:
+        return stop.value
+
+
+@functools.total_ordering
+class ShardedCounter:
+    """
+    Thread safe counter without lock.
+
+    Each thread increments its own counter (shard) and the value is the sum
+    of all shards, calculated when it is read. It can be used like an int
+    in comparisons, formatting, int(counter) and + / - operations (the
+    result is an int), but it is not an int: use int(counter) or value()
+    to serialize it (e.g. json.dumps) and reset() to set it to zero.
+
+    Example:
+    >>> counter = ShardedCounter()
+    >>> counter.add()
+    >>> counter.add(2)
+    >>> counter.value()
+    3
+    >>> counter == 3, counter > 2, int(counter), "{}".format(counter)
+    (True, True, 3, '3')
+    >>> counter + 1, 10 - counter, sum([counter, counter])
+    (4, 7, 6)
+    >>> counter.reset()
+    >>> counter.value()
+    0
+    """
+
+    def __init__(self):
+        """Initialize counter."""
+        self._shards = _ThreadShards(lambda: [0], self._merge_shards)
+
+    @staticmethod
+    def _merge_shards(retired, shard):
+        """Add a shard to the retired shard."""
+        retired[0] += shard[0]
+        return retired
+
+    def add(self, value=1):
+        """Add value to the counter."""
+        self._shards.get()[0] += value
+
+    def value(self):
+        """Return counter value."""
+        return sum(shard[0] for shard in self._shards.all())
+
+    def reset(self):
+        """Set counter to zero."""
+        self._shards.reset()
+
+    def __int__(self):
+        """Return counter value."""
+        return self.value()
+
+    __index__ = __int__
+
+    def __add__(self, other):
+        """Return counter value plus other."""
+        return self.value() + other
+
+    def __radd__(self, other):
+        """Return other plus counter value."""
+        return other + self.value()
+
+    def __sub__(self, other):
+        """Return counter value minus other."""
+        return self.value() - other
+
+    def __rsub__(self, other):
+        """Return other minus counter value."""
+        return other - self.value()
+
+    def __eq__(self, other):
+        """Compare counter value."""
+        return self.value() == other
+
+    def __lt__(self, other):
+        """Compare counter value."""
+        return self.value() < other
+
+    __hash__ = None
+
+    def __repr__(self):
+        """Return counter value representation."""
+        return repr(self.value())
+
+    def __format__(self, format_spec):
+        """Format counter value."""
+        return format(self.value(), format_spec)
+
+
+class HeavyHitters:
+    """
+    Approximate top-K most frequent values, using fixed memory.
+
+    It uses the Space-Saving algorithm: at most "k" values are counted.
+    When a new value arrives and there are already "k" values, the value
+    with the lowest count is replaced by the new one, which inherits its
+    count. The most frequent values are kept with counts that may be
+    overestimated by at most the replaced count.
+
+    Each thread has its own summary (no lock) and they are merged when
+    most_common() is called. The summary of a thread that exits is merged
+    into a shared summary, trimmed to the "k" most frequent values.
+
+    Arguments (opt):
+        k            (int): max number of values counted (per live thread).
+                            default 10
+
+    Example:
+    >>> hitters = HeavyHitters(2)
+    >>> for value in ["a", "b", "a", "c", "a", "c"]:
+    ...     hitters.add(value)
+    >>> hitters.most_common(1)
+    [('a', 3)]
+    """
+
+    def __init__(self, k=10):
+        """Initialize summary."""
+        self.k = k
+        # per thread: {value: count}
+        self._shards = _ThreadShards(dict, self._merge_shards)
+
+    def _merge_shards(self, retired, counts):
+        """Return the retired summary with counts added (k values)."""
+        merged = dict(retired)
+        for value, count in counts.items():
+            merged[value] = merged.get(value, 0) + count
+        if len(merged) > self.k:
+            merged = dict(
+                heapq.nlargest(self.k, merged.items(), key=lambda item: item[1])
+            )
+        return merged
+
+    def add(self, value):
+        """Count value."""
+        counts = self._shards.get()
+        if value in counts:
+            counts[value] += 1
+        elif len(counts) < self.k:
+            counts[value] = 1
+        else:
+            lowest = min(counts, key=counts.__getitem__)
+            counts[value] = counts.pop(lowest) + 1
+
+    def most_common(self, n=None):
+        """
+        Return the most frequent values.
+
+        Arguments (opt):
+            n        (int): number of values. default k
+
+        Return:
+            (list)        : [(value, count), ...] highest count first
+        """
+        merged = {}
+        for counts in self._shards.all():
+            for value, count in list(counts.items()):
+                merged[value] = merged.get(value, 0) + count
+        return heapq.nlargest(
+            n if n is not None else self.k, merged.items(), key=lambda item: item[1]
+        )
+
+    def reset(self):
+        """Remove all counted values."""
+        self._shards.reset()
+
+
+def num_calls(
+    _func=None, *, loglevel="DEBUG", print_info=False, count_by=None, top_k=10
+):
     """
     Count the number of times a function is called.
 
@@ -25,6 +422,18 @@ def num_calls(_func=None, *, loglevel="DEBUG", print_info=False):
                                   calls information. (default DEBUG)
         print_info (True/False):  print function number of call information
                                   (default False)
+        count_by     (function):  function called with the same arguments
+                                  of the decorated function. It returns
+                                  the value used to count calls by argument
+                                  (default None - do not count by argument)
+        top_k             (int):  number of most frequent values counted
+                                  by count_by (default 10)
+
+    The number of calls is kept in the function attribute "numcalls"
+    (a ShardedCounter, thread safe) and the calls by argument in the
+    attribute "top_calls" (a HeavyHitters or None). numcalls is not an
+    int: use int(my_func.numcalls) to serialize it. It can be reset with
+    my_func.numcalls.reset() or by assigning an int (my_func.numcalls = 0).
 
     Example:
     @num_calls
@@ -34,24 +443,39 @@ def num_calls(_func=None, *, loglevel="DEBUG", print_info=False):
     @num_calls(print_info=True)
     def my_other_func():
         print("my other func")
+
+    @num_calls(count_by=lambda host, *args, **kwargs: host)
+    def get_status(host, timeout=10):
+        ...
+    get_status.top_calls.most_common(3)
+    [('host1', 120), ('host3', 25), ('host2', 7)]
     """
+    level = _log_level(loglevel)
 
     def decorator_num_calls(func):
-        @functools.wraps(func)
-        def wrapped_f(*args, **kwargs):
-            wrapped_f.numcalls += 1
-
-            output = "Decorator num_calls: {} called {} times".format(
-                func.__name__, wrapped_f.numcalls
-            )
+        def before(args, kwargs):
+            numcalls = wrapped_f.numcalls
+            if type(numcalls) is not ShardedCounter:
+                # assigned by the user (e.g. func.numcalls = 0 to reset it)
+                numcalls = ShardedCounter()
+                numcalls.add(int(wrapped_f.numcalls))
+                wrapped_f.numcalls = numcalls
+            numcalls.add()
+            if count_by is not None:
+                wrapped_f.top_calls.add(count_by(*args, **kwargs))
 
-            getattr(LOG, loglevel.lower())(output)
-            if print_info:
-                print(output)
-
-            return func(*args, **kwargs)
+            if print_info or LOG.isEnabledFor(level):
+                _log(
+                    level,
+                    print_info,
+                    "Decorator num_calls: %s called %s times",
+                    func.__name__,
+                    wrapped_f.numcalls,
+                )
 
-        wrapped_f.numcalls = 0
+        wrapped_f = _wrap(func, before)
+        wrapped_f.numcalls = ShardedCounter()
+        wrapped_f.top_calls = HeavyHitters(top_k) if count_by is not None else None
         return wrapped_f
 
     # wrapper to decorator, so it can be used with and without parameter
@@ -61,6 +485,158 @@ def num_calls(_func=None, *, loglevel="DEBUG", print_info=False):
         return decorator_num_calls(_func)
 
 
+class LatencyHistogram:
+    """
+    Latency histogram with fixed memory (HDR histogram style).
+
+    Values (seconds) are counted in buckets with logarithmic size: each
+    power of two (in nanoseconds) is split in 128 buckets, so percentiles
+    have less than 1% of error and the number of buckets is small, no
+    matter how many values are recorded.
+
+    Each thread records values in its own buckets (no lock). The buckets
+    of all threads are merged when statistics are read; the buckets of a
+    thread that exits are merged into shared buckets.
+
+    Example:
+    >>> histogram = LatencyHistogram()
+    >>> for value in range(1, 101):
+    ...     histogram.record(value / 1000)
+    >>> histogram.count()
+    100
+    >>> round(histogram.percentile(50), 3)
+    0.05
+    >>> round(histogram.percentile(99), 3)
+    0.099
+    >>> stats = histogram.snapshot()
+    >>> stats["min"], stats["max"], round(stats["mean"], 4)
+    (0.001, 0.1, 0.0505)
+    """
+
+    # each power of two is split in 2 ** _SUB_BITS buckets
+    _SUB_BITS = 7
+    _EXACT = 2 ** (_SUB_BITS + 1)
+
+    def __init__(self):
+        """Initialize histogram."""
+        # per thread shard: [buckets {index: count}, count, sum, min, max]
+        self._shards = _ThreadShards(
+            lambda: [{}, 0, 0.0, None, None], self._merge_shards
+        )
+
+    @classmethod
+    def _bucket_index(cls, nanoseconds):
+        """Return bucket index of a value in nanoseconds."""
+        if nanoseconds < cls._EXACT:
+            return nanoseconds
+        shift = nanoseconds.bit_length() - cls._SUB_BITS - 1
+        return (shift << cls._SUB_BITS) + (nanoseconds >> shift)
+
+    @classmethod
+    def _bucket_value(cls, index):
+        """Return the value (seconds) in the middle of a bucket."""
+        if index < cls._EXACT:
+            return index / 1e9
+        shift = (index >> cls._SUB_BITS) - 1
+        lowest = (index - (shift << cls._SUB_BITS)) << shift
+        return (lowest + (1 << shift) / 2) / 1e9
+
+    def record(self, seconds):
+        """Record a value in seconds."""
+        shard = self._shards.get()
+        # min and max first, readers ignore shards without max
+        if shard[3] is None or seconds < shard[3]:
+            shard[3] = seconds
+        if shard[4] is None or seconds > shard[4]:
+            shard[4] = seconds
+        index = self._bucket_index(int(seconds * 1e9))
+        buckets = shard[0]
+        buckets[index] = buckets.get(index, 0) + 1
+        shard[2] += seconds
+        shard[1] += 1
+
+    @staticmethod
+    def _merge_shards(merged, shard):
+        """Add a shard to the merged shard."""
+        shard_buckets, shard_count, shard_total, shard_min, shard_max = shard
+        if shard_max is None:
+            return merged
+        buckets = merged[0]
+        for index, bucket_count in list(shard_buckets.items()):
+            buckets[index] = buckets.get(index, 0) + bucket_count
+        merged[1] += shard_count
+        merged[2] += shard_total
+        merged[3] = shard_min if merged[3] is None else min(merged[3], shard_min)
+        merged[4] = shard_max if merged[4] is None else max(merged[4], shard_max)
+        return merged
+
+    def _merge(self):
+        """Return merged shards: buckets, count, sum, min and max."""
+        merged = [{}, 0, 0.0, None, None]
+        for shard in self._shards.all():
+            self._merge_shards(merged, shard)
+        return merged
+
+    @classmethod
+    def _percentiles(cls, buckets, count, minimum, maximum, percentiles):
+        """Return a list with the values of the percentiles."""
+        results = []
+        if not count:
+            return [0.0 for _ in percentiles]
+        sorted_buckets = sorted(buckets.items())
+        for percentile in percentiles:
+            rank = max(1, percentile / 100 * count)
+            cumulative = 0
+            for index, bucket_count in sorted_buckets:
+                cumulative += bucket_count
+                if cumulative >= rank:
+                    break
+            value = cls._bucket_value(index)
+            results.append(min(max(value, minimum), maximum))
+        return results
+
+    def count(self):
+        """Return number of recorded values."""
+        return sum(shard[1] for shard in self._shards.all())
+
+    def percentile(self, percentile):
+        """Return the value in seconds of a percentile, between 0 and 100."""
+        buckets, count, _, minimum, maximum = self._merge()
+        return self._percentiles(buckets, count, minimum, maximum, [percentile])[0]
+
+    def snapshot(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        Return statistics (in seconds).
+
+        Keyword arguments (opt):
+            percentiles  (tuple): percentiles to calculate
+                                  default: 50, 90, 99 and 99.9
+
+        Return:
+            (dict): count, min, max, mean and the percentiles
+                    {"count": 10, "min": 0.1, ..., "p50": 0.2, "p99.9": 0.3}
+        """
+        buckets, count, total, minimum, maximum = self._merge()
+        stats = {
+            "count": count,
+            "min": minimum if count else 0.0,
+            "max": maximum if count else 0.0,
+            "mean": total / count if count else 0.0,
+        }
+        values = self._percentiles(buckets, count, minimum, maximum, percentiles)
+        for percentile, value in zip(percentiles, values):
+            stats["p{:g}".format(percentile)] = value
+        return stats
+
+    def to_json(self, **kwargs):
+        """Return snapshot() as a JSON string."""
+        return json.dumps(self.snapshot(**kwargs))
+
+    def reset(self):
+        """Remove all recorded values."""
+        self._shards.reset()
+
+
 def time_elapsed(_func=None, *, loglevel="DEBUG", print_info=False):
     """
     Calculate elapsed time in seconds.
@@ -70,6 +646,10 @@ def time_elapsed(_func=None, *, loglevel="DEBUG", print_info=False):
                                   (default DEBUG)
         print_info (True/False):  print elapsed time (default False)
 
+    Latency statistics (count, min, max, mean and percentiles) of all
+    executions are kept in the function attribute "latency"
+    (see LatencyHistogram).
+
     Example:
     @time_elapsed
     def my_func():
@@ -78,34 +658,40 @@ def time_elapsed(_func=None, *, loglevel="DEBUG", print_info=False):
     @time_elapsed(print_info=True)
     def my_other_func():
         print("my other func")
+
+    my_func.latency.snapshot()
+    {'count': 1, 'min': 1.7e-05, 'max': 1.7e-05, 'mean': 1.7e-05, 'p50': ...}
+    my_func.latency.reset()
     """
+    level = _log_level(loglevel)
 
     def decorator_time_elapsed(func):
-        @functools.wraps(func)
-        def wrapped_f(*args, **kwargs):
-            start_time = time.perf_counter()
-            result = func(*args, **kwargs)
-            end_time = time.perf_counter()
-            elapsed_time = end_time - start_time
+        def before(args, kwargs):
+            return time.perf_counter()
+
+        def after(start_time, args, kwargs, result):
+            elapsed_time = time.perf_counter() - start_time
             # keep track of total elapsed time for all execution of the function
             wrapped_f.elapsed += elapsed_time
+            wrapped_f.latency.record(elapsed_time)
 
-            output = (
-                "Decorator time_elapsed: {} args: {} kwargs: {} - "
-                "elapsed time {:.4f} seconds. "
-                "This function all execution elapsed time: {:.4f} "
-                "seconds".format(
-                    func.__name__, args, kwargs, elapsed_time, wrapped_f.elapsed
+            if print_info or LOG.isEnabledFor(level):
+                _log(
+                    level,
+                    print_info,
+                    "Decorator time_elapsed: %s args: %s kwargs: %s - "
+                    "elapsed time %.4f seconds. "
+                    "This function all execution elapsed time: %.4f seconds",
+                    func.__name__,
+                    args,
+                    kwargs,
+                    elapsed_time,
+                    wrapped_f.elapsed,
                 )
-            )
-
-            getattr(LOG, loglevel.lower())(output)
-            if print_info:
-                print(output)
-
-            return result
 
+        wrapped_f = _wrap(func, before, after)
         wrapped_f.elapsed = 0
+        wrapped_f.latency = LatencyHistogram()
         return wrapped_f
 
     # wrapper to decorator, so it can be used with and without parameter
@@ -135,33 +721,32 @@ def debug(_func=None, *, loglevel="DEBUG", print_info=False):
     def my_other_func(my_param):
         print("my other func")
     """
+    level = _log_level(loglevel)
 
     def decorator_debug(func):
-        @functools.wraps(func)
-        def wrapped_f(*args, **kwargs):
-            func_call = (
-                "Decorator debug: "
-                "Calling function: {} arguments: args: {}; kwargs: {}".format(
-                    func.__name__, args, kwargs
+        def before(args, kwargs):
+            if print_info or LOG.isEnabledFor(level):
+                _log(
+                    level,
+                    print_info,
+                    "Decorator debug: "
+                    "Calling function: %s arguments: args: %s; kwargs: %s",
+                    func.__name__,
+                    args,
+                    kwargs,
                 )
-            )
-
-            getattr(LOG, loglevel.lower())(func_call)
-            if print_info:
-                print(func_call)
-
-            result = func(*args, **kwargs)
 
-            func_return = "Decorator debug: function: {} returns: {}".format(
-                func.__name__, result
-            )
-            getattr(LOG, loglevel.lower())(func_return)
-            if print_info:
-                print(func_return)
-
-            return result
+        def after(state, args, kwargs, result):
+            if print_info or LOG.isEnabledFor(level):
+                _log(
+                    level,
+                    print_info,
+                    "Decorator debug: function: %s returns: %s",
+                    func.__name__,
+                    result,
+                )
 
-        return wrapped_f
+        return _wrap(func, before, after)
 
     # wrapper to decorator, so it can be used with and without parameter
     if _func is None:
@@ -170,6 +755,184 @@ def debug(_func=None, *, loglevel="DEBUG", print_info=False):
         return decorator_debug(_func)
 
 
+# delay before retry number "attempt" (0 first retry) for each backoff strategy
+_BACKOFF = {
+    "fixed": lambda base, attempt, previous: base,
+    "exponential": lambda base, attempt, previous: base * 2 ** min(attempt, 64),
+    "full_jitter": lambda base, attempt, previous: random.uniform(
+        0, base * 2 ** min(attempt, 64)
+    ),
+    "decorrelated_jitter": lambda base, attempt, previous: random.uniform(
+        base, previous * 3
+    ),
+}
+
+
+class RetryStats:
+    """
+    Retry statistics of a function decorated with retry_on_exception.
+
+    Counters (thread safe, see ShardedCounter):
+        calls          : number of calls
+        retries        : number of retries
+        giveups        : calls that reached max_retry or deadline
+        retry_time     : seconds spent since the first failed attempt of each
+                         call (waiting and retrying)
+
+    snapshot() also returns "attempts": number of executions of the function
+    (calls + retries).
+    """
+
+    _FIELDS = ("calls", "retries", "giveups", "retry_time")
+
+    def __init__(self):
+        """Initialize counters."""
+        for field in self._FIELDS:
+            setattr(self, field, ShardedCounter())
+
+    def snapshot(self):
+        """Return dict with counters value."""
+        stats = {field: getattr(self, field).value() for field in self._FIELDS}
+        stats["attempts"] = stats["calls"] + stats["retries"]
+        return stats
+
+    def reset(self):
+        """Set all counters to zero."""
+        for field in self._FIELDS:
+            getattr(self, field).reset()
+
+
+class _Retry:
+    """
+    Retry policy of a function decorated with retry_on_exception.
+
+    The state of each call is a list:
+    [retry number, last delay, start time (with deadline), first failure time]
+    """
+
+    def __init__(
+        self,
+        name,
+        level,
+        max_retry,
+        sleep_retry,
+        exception_error,
+        backoff,
+        max_delay,
+        deadline,
+        retry_if,
+    ):
+        """Initialize policy."""
+        if backoff not in _BACKOFF:
+            raise ValueError("Invalid backoff")
+        self.name = name
+        self.level = level
+        self.max_retry = max_retry
+        self.sleep_retry = sleep_retry
+        self.exception_error = exception_error
+        self.backoff = _BACKOFF[backoff]
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_if = retry_if
+        self.stats = RetryStats()
+
+    def start(self):
+        """Return the state of a new call."""
+        self.stats.calls.add()
+        start_time = time.perf_counter() if self.deadline is not None else None
+        return [1, self.sleep_retry, start_time, None]
+
+    def attempt(self, call):
+        """Log a new execution of the function."""
+        if LOG.isEnabledFor(self.level):
+            LOG.log(
+                self.level,
+                "Decorator retry for function: %s - retry: %s of %s",
+                self.name,
+                call[0],
+                self.max_retry,
+            )
+
+    def failed(self, call, error):
+        """Return seconds to wait before next retry or raise the exception."""
+        if LOG.isEnabledFor(self.level):
+            LOG.log(
+                self.level,
+                "Decorator retry for function: %s - exception catched: %r",
+                self.name,
+                error,
+            )
+        if isinstance(error, CircuitOpenError) or (
+            self.retry_if is not None and not self.retry_if(None, error)
+        ):
+            self.finish(call)
+            raise error
+        return self._next_delay(call, error)
+
+    def succeeded(self, call, result):
+        """Return seconds to wait before next retry or None to return result."""
+        if self.retry_if is None or not self.retry_if(result, None):
+            self.finish(call)
+            return None
+        if LOG.isEnabledFor(self.level):
+            LOG.log(
+                self.level,
+                "Decorator retry for function: %s - retry result: %r",
+                self.name,
+                result,
+            )
+        return self._next_delay(call, None)
+
+    def finish(self, call):
+        """Update statistics when the call ends."""
+        if call[3] is not None:
+            self.stats.retry_time.add(time.perf_counter() - call[3])
+
+    def _next_delay(self, call, error):
+        """Return seconds to wait before next retry, None or raise if giving up."""
+        now = time.perf_counter()
+        if call[3] is None:
+            call[3] = now
+        call[0] += 1
+
+        if self.max_retry != -1 and call[0] > self.max_retry:
+            return self._give_up(call, error, "max retry", self.max_retry)
+
+        delay = self.backoff(self.sleep_retry, call[0] - 2, call[1])
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        if self.deadline is not None and now + delay - call[2] > self.deadline:
+            return self._give_up(call, error, "deadline", self.deadline)
+
+        call[1] = delay
+        self.stats.retries.add()
+        if LOG.isEnabledFor(self.level):
+            LOG.log(
+                self.level,
+                "Decorator retry for function: %s - waiting: %gs for next retry",
+                self.name,
+                delay,
+            )
+        return delay
+
+    def _give_up(self, call, error, reason, value):
+        """Raise exception_error (or error) or return None if there is no error."""
+        self.stats.giveups.add()
+        self.finish(call)
+        LOG.log(
+            self.level,
+            "Decorator retry for function: %s - %s '%s' reached. Giving up",
+            self.name,
+            reason,
+            value,
+        )
+        if self.exception_error:
+            raise self.exception_error("{} reached".format(reason))
+        elif error is not None:
+            raise error
+        return None
+
+
 def retry_on_exception(
     _func=None,
     *,
@@ -177,7 +940,11 @@ def retry_on_exception(
     loglevel="DEBUG",
     max_retry=5,
     sleep_retry=1,
-    exception_error=None
+    exception_error=None,
+    backoff="fixed",
+    max_delay=None,
+    deadline=None,
+    retry_if=None
 ):
     """
     Retry function execution if exception raises.
@@ -190,11 +957,46 @@ def retry_on_exception(
                                       (default DEBUG)
         max_retry              (int): Max number of retries. -1 to retry forever
                                       (default 5)
-        sleep_retry            (int): Time in seconds to wait between retries
+        sleep_retry            (int): Time in seconds to wait between retries,
+                                      base delay of the backoff strategies
                                       (default 1)
         exception_error  (exception): Exception that decorator will raise if
                                       max_retry is reached without success
                                       (default the same exception function raises)
+        backoff                (str): Delay between retries:
+                                      fixed: always sleep_retry
+                                      exponential: sleep_retry * 2 ** retry
+                                      full_jitter: random between 0 and the
+                                          exponential delay
+                                      decorrelated_jitter: random between
+                                          sleep_retry and 3 * last delay
+                                      (default fixed)
+        max_delay            (float): Max time in seconds to wait between retries
+                                      (default None - no limit)
+        deadline             (float): Max time in seconds since the first
+                                      execution. It gives up if the next
+                                      retry would start after the deadline
+                                      (default None - no limit)
+        retry_if          (function): Function called as retry_if(result, None)
+                                      after a successful execution or
+                                      retry_if(None, exception) when one of the
+                                      exceptions raises. Retry only if it returns
+                                      True. If max_retry/deadline is reached
+                                      retrying a result, the result is returned
+                                      (or exception_error raised)
+                                      (default None - retry all exceptions)
+
+    CircuitOpenError (see circuit_breaker) is never retried.
+
+    Jitter spreads the retries of many clients, so they do not retry in
+    lockstep and overload a recovering service.
+
+    Retry statistics are kept in the function attribute "retry_stats"
+    (see RetryStats).
+
+    Coroutine functions wait between retries with asyncio.sleep, so the event
+    loop is not blocked. Generators (sync and async) are retried only if the
+    exception is raised before the first value is produced.
 
     Example:
     # Retry function if any exception raise
@@ -207,44 +1009,126 @@ def retry_on_exception(
     @retry_on_exception(exception=(TimeoutError, IndexError), max_retry=10)
     def my_other_func(my_param):
         print("my other func")
+
+    # Exponential backoff with jitter, up to 30 seconds between retries and
+    # giving up after 5 minutes. Retry also if the response is an error 503
+    @retry_on_exception(
+        backoff="decorrelated_jitter",
+        sleep_retry=0.5,
+        max_delay=30,
+        max_retry=-1,
+        deadline=300,
+        retry_if=lambda response, error: error or response.status_code == 503,
+    )
+    def get_status(url):
+        return requests.get(url)
+
+    get_status.retry_stats.snapshot()
+    {'calls': 10, 'retries': 4, 'giveups': 0, 'retry_time': 3.2, 'attempts': 14}
     """
+    level = _log_level(loglevel)
 
     def decorator_retry(func):
-        @functools.wraps(func)
-        def wrapped_f(*args, **kwargs):
-            current_retry = 1
-            log_prefix = "Decorator retry for function: {} -".format(func.__name__)
+        retry = _Retry(
+            func.__name__,
+            level,
+            max_retry,
+            sleep_retry,
+            exception_error,
+            backoff,
+            max_delay,
+            deadline,
+            retry_if,
+        )
 
-            while True:
-                log_msg = "{} retry: {} of {}".format(
-                    log_prefix, current_retry, max_retry
-                )
-                getattr(LOG, loglevel.lower())(log_msg)
+        # generators are retried only while they did not yield any value
+        if inspect.iscoroutinefunction(func):
+
+            async def wrapped_f(*args, **kwargs):
+                call = retry.start()
+                while True:
+                    retry.attempt(call)
+                    try:
+                        result = await func(*args, **kwargs)
+                    except exception as error:
+                        delay = retry.failed(call, error)
+                    else:
+                        delay = retry.succeeded(call, result)
+                        if delay is None:
+                            return result
+                    await asyncio.sleep(delay)
+
+        elif inspect.isasyncgenfunction(func):
 
+            async def wrapped_f(*args, **kwargs):
+                call = retry.start()
+                while True:
+                    retry.attempt(call)
+                    agen = func(*args, **kwargs)
+                    try:
+                        value = await agen.__anext__()
+                        break
+                    except StopAsyncIteration:
+                        retry.finish(call)
+                        return
+                    except exception as error:
+                        delay = retry.failed(call, error)
+                    await asyncio.sleep(delay)
+                retry.finish(call)
+
+                # forward values, asend() and athrow() to the async generator
                 try:
-                    return func(*args, **kwargs)
-                except exception as error:
-                    log_msg = "{} exception catched: {}".format(log_prefix, repr(error))
-                    getattr(LOG, loglevel.lower())(log_msg)
-
-                    if max_retry != -1:
-                        current_retry += 1
-                        if current_retry > max_retry:
-                            log_msg = "{} max retry '{}' reached. Giving up".format(
-                                log_prefix, max_retry
-                            )
-                            getattr(LOG, loglevel.lower())(log_msg)
-                            if exception_error:
-                                raise exception_error("max retry reached")
-                            else:
-                                raise
-
-                    log_msg = "{} waiting: {}s for next retry".format(
-                        log_prefix, sleep_retry
-                    )
-                    getattr(LOG, loglevel.lower())(log_msg)
-                    time.sleep(sleep_retry)
+                    while True:
+                        try:
+                            sent = yield value
+                        except GeneratorExit:
+                            await agen.aclose()
+                            raise
+                        except BaseException as error:
+                            value = await agen.athrow(error)
+                        else:
+                            value = await agen.asend(sent)
+                except StopAsyncIteration:
+                    pass
+
+        elif inspect.isgeneratorfunction(func):
+
+            def wrapped_f(*args, **kwargs):
+                call = retry.start()
+                while True:
+                    retry.attempt(call)
+                    gen = func(*args, **kwargs)
+                    try:
+                        value = next(gen)
+                        break
+                    except StopIteration as stop:
+                        retry.finish(call)
+                        return stop.value
+                    except exception as error:
+                        delay = retry.failed(call, error)
+                    time.sleep(delay)
+                retry.finish(call)
 
+                return (yield from _resume(gen, value))
+
+        else:
+
+            def wrapped_f(*args, **kwargs):
+                call = retry.start()
+                while True:
+                    retry.attempt(call)
+                    try:
+                        result = func(*args, **kwargs)
+                    except exception as error:
+                        delay = retry.failed(call, error)
+                    else:
+                        delay = retry.succeeded(call, result)
+                        if delay is None:
+                            return result
+                    time.sleep(delay)
+
+        wrapped_f = functools.wraps(func)(wrapped_f)
+        wrapped_f.retry_stats = retry.stats
         return wrapped_f
 
     # wrapper to decorator, so it can be used with and without parameter
@@ -254,4 +1138,2351 @@ def retry_on_exception(
         return decorator_retry(_func)
 
 
+class CircuitOpenError(RuntimeError):
+    """
+    Exception raised by circuit_breaker when the circuit is open.
+
+    Attribute "retry_after" has the seconds until the circuit becomes
+    half-open and probe calls are allowed.
+    """
+
+    def __init__(self, name, retry_after):
+        """Initialize exception."""
+        super().__init__(
+            "circuit breaker '{}' is open, retry after {:.3f}s".format(
+                name, retry_after
+            )
+        )
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Thread safe circuit breaker.
+
+    States:
+        closed    : calls are executed and their result recorded in a
+                    sliding window of the last "window_size" calls. When at
+                    least "min_calls" were recorded and the failure rate
+                    reaches "failure_rate", the circuit opens.
+        open      : calls fail fast with CircuitOpenError for
+                    "reset_timeout" seconds, then the circuit is half-open.
+        half_open : up to "half_open_calls" probe calls are executed (others
+                    fail fast). If all of them succeed the circuit closes,
+                    if one fails it opens again.
+
+    Only exceptions in "exception" are failures, other exceptions are
+    recorded as successes. Interrupted calls (BaseExceptions that are not
+    Exception, like GeneratorExit or KeyboardInterrupt, and
+    asyncio.CancelledError) are not recorded.
+
+    Keyword arguments (opt):
+        name               (str): name used in logs and errors
+        failure_rate     (float): failure rate (0 - 1) that opens the circuit
+                                  default 0.5
+        window_size        (int): number of calls in the sliding window.
+                                  default 20
+        min_calls          (int): min calls in the window to open the circuit.
+                                  default 10
+        reset_timeout    (float): seconds the circuit stays open. default 30
+        half_open_calls    (int): number of probe calls. default 1
+        exception        (tuple): exceptions that are failures.
+                                  default (Exception,)
+        loglevel           (str): log level of state changes. default WARNING
+
+    Example:
+    >>> breaker = CircuitBreaker(name="db", min_calls=2, window_size=2)
+    >>> breaker.state
+    'closed'
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        *,
+        name="circuit_breaker",
+        failure_rate=0.5,
+        window_size=20,
+        min_calls=10,
+        reset_timeout=30,
+        half_open_calls=1,
+        exception=(Exception,),
+        loglevel="WARNING"
+    ):
+        """Initialize circuit breaker."""
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.exception = exception
+        self.level = _log_level(loglevel)
+        self._lock = threading.Lock()
+        self._window = collections.deque(maxlen=window_size)
+        self._window_failures = 0
+        self._state = self.CLOSED
+        self._opened_at = 0
+        self._probes = 0
+        self._probe_successes = 0
+        self._stats = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self):
+        """Return current state: closed, open or half_open."""
+        with self._lock:
+            if (
+                self._state == self.OPEN
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """
+        Allow a call or raise CircuitOpenError.
+
+        Return:
+            (str)  : state when the call started, passed to after_call()
+        """
+        with self._lock:
+            if self._state == self.OPEN:
+                open_time = time.monotonic() - self._opened_at
+                if open_time < self.reset_timeout:
+                    self._stats["rejected"] += 1
+                    raise CircuitOpenError(self.name, self.reset_timeout - open_time)
+                self._set_state(self.HALF_OPEN)
+                self._probes = 0
+                self._probe_successes = 0
+
+            if self._state == self.HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self._stats["rejected"] += 1
+                    raise CircuitOpenError(self.name, 0)
+                self._probes += 1
+
+            self._stats["calls"] += 1
+            return self._state
+
+    def after_call(self, call_state, error=None):
+        """Record the result of a call allowed by before_call()."""
+        if error is not None and (
+            not isinstance(error, Exception)
+            or isinstance(error, asyncio.CancelledError)
+        ):
+            # interrupted (cancelled, closed, KeyboardInterrupt...): there
+            # is no result, only the half-open probe is released
+            with self._lock:
+                if call_state == self.HALF_OPEN and self._state == self.HALF_OPEN:
+                    self._probes -= 1
+            return
+        failure = error is not None and isinstance(error, self.exception)
+        with self._lock:
+            if failure:
+                self._stats["failures"] += 1
+
+            if call_state == self.HALF_OPEN:
+                # calls started in a previous half-open state are ignored
+                if self._state != self.HALF_OPEN:
+                    return
+                if failure:
+                    self._open()
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._window.clear()
+                        self._window_failures = 0
+                        self._set_state(self.CLOSED)
+
+            elif self._state == self.CLOSED:
+                if len(self._window) == self._window.maxlen:
+                    self._window_failures -= self._window[0]
+                self._window.append(failure)
+                self._window_failures += failure
+                if (
+                    len(self._window) >= self.min_calls
+                    and self._window_failures / len(self._window) >= self.failure_rate
+                ):
+                    self._open()
+
+    def _open(self):
+        """Open the circuit. Lock must be held."""
+        self._opened_at = time.monotonic()
+        self._stats["opened"] += 1
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        """Change state. Lock must be held."""
+        LOG.log(
+            self.level,
+            "Decorator circuit_breaker: %s state changed from %s to %s",
+            self.name,
+            self._state,
+            state,
+        )
+        self._state = state
+
+    def stats(self):
+        """
+        Return circuit breaker statistics.
+
+        Return:
+            (dict)  : state, calls (executed), failures, rejected (failed
+                      fast), opened (number of times the circuit opened) and
+                      failure_rate (in the sliding window)
+        """
+        state = self.state
+        with self._lock:
+            stats = dict(self._stats)
+            stats["failure_rate"] = (
+                self._window_failures / len(self._window) if self._window else 0.0
+            )
+        stats["state"] = state
+        return stats
+
+    def reset(self):
+        """Close the circuit and clear the sliding window and statistics."""
+        with self._lock:
+            self._window.clear()
+            self._window_failures = 0
+            self._state = self.CLOSED
+            self._stats = dict.fromkeys(self._stats, 0)
+
+
+def circuit_breaker(_func=None, *, breaker=None, **breaker_options):
+    """
+    Fail fast while a dependency is failing (circuit breaker).
+
+    Decorator keyword arguments (optional):
+        breaker  (CircuitBreaker): circuit breaker used by the function. The
+                                   same breaker can be shared by several
+                                   functions (e.g. all calls to one service)
+                                   (default new CircuitBreaker for the
+                                   function)
+        other keyword arguments  : CircuitBreaker arguments (failure_rate,
+                                   window_size, min_calls, reset_timeout,
+                                   half_open_calls, exception, loglevel),
+                                   used when breaker is not set
+
+    While the circuit is open, calls raise CircuitOpenError without
+    executing the function. The breaker is in the function attribute
+    "circuit_breaker".
+
+    retry_on_exception does not retry CircuitOpenError, so it can be used
+    with the circuit breaker (retry_on_exception must be the outer one):
+    the retries stop as soon as the circuit opens.
+
+    Example:
+    @circuit_breaker(failure_rate=0.5, min_calls=10, reset_timeout=30)
+    def get_status(url):
+        return requests.get(url)
+
+    db_breaker = CircuitBreaker(name="db", exception=(ConnectionError,))
+
+    @retry_on_exception(exception=(ConnectionError,), max_retry=3)
+    @circuit_breaker(breaker=db_breaker)
+    def query(sql):
+        ...
+
+    @circuit_breaker(breaker=db_breaker)
+    async def async_query(sql):
+        ...
+
+    get_status.circuit_breaker.stats()
+    {'calls': 12, 'failures': 7, 'rejected': 40, 'opened': 1,
+     'failure_rate': 0.58, 'state': 'open'}
+    """
+
+    def decorator_circuit_breaker(func):
+        func_breaker = breaker
+        if func_breaker is None:
+            options = dict({"name": func.__name__}, **breaker_options)
+            func_breaker = CircuitBreaker(**options)
+
+        def before(args, kwargs):
+            return func_breaker.before_call()
+
+        def after(call_state, args, kwargs, result):
+            func_breaker.after_call(call_state)
+
+        wrapped_f = _wrap(func, before, after, func_breaker.after_call)
+        wrapped_f.circuit_breaker = func_breaker
+        return wrapped_f
+
+    # wrapper to decorator, so it can be used with and without parameter
+    if _func is None:
+        return decorator_circuit_breaker
+    else:
+        return decorator_circuit_breaker(_func)
+
+
+class RateLimitExceeded(RuntimeError):
+    """
+    Exception raised by rate_limit when there is no token available.
+
+    Attribute "retry_after" has the seconds until a token is available.
+    """
+
+    def __init__(self, retry_after):
+        """Initialize exception."""
+        super().__init__("rate limit exceeded, retry after {:.3f}s".format(retry_after))
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter.
+
+    The bucket has up to "burst" tokens and it is refilled with "rate"
+    tokens per second. Each call takes a token.
+
+    Blocking acquire reserves the token (the bucket may be negative, so
+    waiting calls are served in order) and sleeps once the exact time
+    until the token is available, there is no busy-wait.
+
+    Arguments:
+        rate           (float): tokens per second
+
+    Arguments (opt):
+        burst          (float): max number of tokens in the bucket.
+                                default max(1, rate)
+
+    Example:
+    >>> bucket = TokenBucket(10, burst=2)
+    >>> bucket.try_acquire(), bucket.try_acquire(), bucket.try_acquire()
+    (True, True, False)
+    """
+
+    def __init__(self, rate, burst=None):
+        """Initialize full bucket."""
+        if rate <= 0:
+            raise ValueError("Invalid rate")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {"acquired": 0, "rejected": 0, "wait_time": 0.0}
+
+    def _reserve(self, tokens, max_wait):
+        """
+        Reserve tokens if they are available in max_wait seconds.
+
+        Return:
+            (tuple)  : (True, seconds to wait) if reserved or
+                       (False, seconds until tokens are available)
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            wait = max(0.0, (tokens - self._tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                self._stats["rejected"] += 1
+                return False, wait
+            self._tokens -= tokens
+            self._stats["acquired"] += 1
+            self._stats["wait_time"] += wait
+            return True, wait
+
+    async def _wait_async(self, tokens, wait):
+        """Wait for reserved tokens, they are given back if cancelled."""
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            with self._lock:
+                self._tokens = min(self.burst, self._tokens + tokens)
+                self._stats["acquired"] -= 1
+                self._stats["wait_time"] -= wait
+            raise
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available now, without waiting. Return True/False."""
+        return self._reserve(tokens, 0)[0]
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Take tokens, waiting until they are available.
+
+        Arguments (opt):
+            tokens       (float): number of tokens. default 1
+            timeout      (float): max seconds to wait. default None (forever)
+
+        Return:
+            (bool)              : True if acquired, False if timeout
+        """
+        acquired, wait = self._reserve(tokens, timeout)
+        if acquired and wait > 0:
+            time.sleep(wait)
+        return acquired
+
+    async def acquire_async(self, tokens=1, timeout=None):
+        """
+        Take tokens as acquire(), but waiting with asyncio.sleep.
+
+        If the task is cancelled while waiting, the tokens are given back.
+        """
+        acquired, wait = self._reserve(tokens, timeout)
+        if acquired and wait > 0:
+            await self._wait_async(tokens, wait)
+        return acquired
+
+    def stats(self):
+        """
+        Return bucket statistics.
+
+        Return:
+            (dict)  : acquired, rejected and wait_time (seconds waited by
+                      all acquired calls)
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+def rate_limit(*, rate=None, burst=None, limiter=None, block=True, timeout=None):
+    """
+    Limit the rate of function calls (token bucket).
+
+    Decorator keyword arguments (rate or limiter is required):
+        rate              (float): max calls per second
+        burst             (float): max calls allowed at once (bucket size)
+                                   (default max(1, rate))
+        limiter     (TokenBucket): limiter used instead of rate/burst. The
+                                   same limiter can be shared by several
+                                   functions (e.g. all calls to one API)
+        block        (True/False): wait for a token. If False, raises
+                                   RateLimitExceeded when there is no token
+                                   (default True)
+        timeout           (float): max seconds to wait for a token, it
+                                   raises RateLimitExceeded if the token is
+                                   not available in time
+                                   (default None - wait forever)
+
+    Coroutine functions and async generators wait with asyncio.sleep. The
+    limiter is in the function attribute "rate_limiter".
+
+    Example:
+    @rate_limit(rate=10, burst=20)
+    def call_api(url):
+        return requests.get(url)
+
+    api_limiter = TokenBucket(rate=100)
+
+    @rate_limit(limiter=api_limiter, block=False)
+    async def get_item(item):
+        ...
+
+    @rate_limit(limiter=api_limiter, timeout=5)
+    def put_item(item):
+        ...
+    """
+    if limiter is None and rate is None:
+        raise ValueError("rate or limiter is required")
+    max_wait = timeout if block else 0
+
+    def decorator_rate_limit(func):
+        func_limiter = limiter if limiter is not None else TokenBucket(rate, burst)
+
+        def before(args, kwargs):
+            acquired, wait = func_limiter._reserve(1, max_wait)
+            if not acquired:
+                raise RateLimitExceeded(wait)
+            if wait > 0:
+                time.sleep(wait)
+
+        async def async_before(args, kwargs):
+            acquired, wait = func_limiter._reserve(1, max_wait)
+            if not acquired:
+                raise RateLimitExceeded(wait)
+            if wait > 0:
+                await func_limiter._wait_async(1, wait)
+
+        wrapped_f = _wrap(func, before, async_before=async_before)
+        wrapped_f.rate_limiter = func_limiter
+        return wrapped_f
+
+    return decorator_rate_limit
+
+
+class BulkheadFull(RuntimeError):
+    """Exception raised by bulkhead when the call can not be executed."""
+
+
+# asyncio.get_running_loop() is new in Python 3.7
+_get_running_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+
+
+def _set_future_result(future):
+    """Set asyncio future result, if it was not cancelled."""
+    if not future.done():
+        future.set_result(True)
+
+
+class Bulkhead:
+    """
+    Thread safe concurrency limiter (bulkhead), for threads and asyncio.
+
+    Up to "max_concurrent" calls run at the same time. Other calls wait in
+    a FIFO queue of up to "max_queue" calls and, when the queue is full,
+    they are rejected at once with BulkheadFull. When a call finishes its
+    slot is given to the first waiting call (thread or asyncio task).
+
+    Keyword arguments (opt):
+        max_concurrent    (int): max calls running at once. default 10
+        max_queue         (int): max calls waiting. default 0 (no wait)
+        timeout         (float): max seconds waiting in the queue.
+                                 default None (wait forever)
+        name              (str): name used in errors. default bulkhead
+
+    Example:
+    >>> bulkhead = Bulkhead(max_concurrent=1)
+    >>> bulkhead.acquire()
+    >>> bulkhead.stats()
+    {'in_flight': 1, 'queued': 0, 'rejected': 0}
+    >>> bulkhead.release()
+    """
+
+    def __init__(
+        self, max_concurrent=10, *, max_queue=0, timeout=None, name="bulkhead"
+    ):
+        """Initialize bulkhead."""
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.name = name
+        self._lock = threading.Lock()
+        # function called to wake up each waiting call (its slot is ready)
+        self._waiters = collections.deque()
+        self._in_flight = 0
+        self._rejected = 0
+
+    def _try_acquire(self, wake):
+        """
+        Take a slot or add "wake" to the waiters queue. Lock must be held.
+
+        Return:
+            (bool)  : True if the slot was taken
+        """
+        if self._in_flight < self.max_concurrent and not self._waiters:
+            self._in_flight += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            self._rejected += 1
+            raise BulkheadFull("bulkhead '{}' is full".format(self.name))
+        self._waiters.append(wake)
+        return False
+
+    def _give_up(self, wake):
+        """
+        Remove waiter after timeout.
+
+        Return:
+            (bool)  : True if the waiter was removed, False if the slot was
+                      given to it meanwhile
+        """
+        with self._lock:
+            try:
+                self._waiters.remove(wake)
+            except ValueError:
+                return False
+            self._rejected += 1
+            return True
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if needed, or raise BulkheadFull."""
+        waiter = threading.Lock()
+        waiter.acquire()
+        with self._lock:
+            if self._try_acquire(waiter.release):
+                return
+        timeout = self.timeout if self.timeout is not None else -1
+        try:
+            acquired = waiter.acquire(timeout=timeout)
+        except BaseException:
+            # interrupted (KeyboardInterrupt...) while waiting
+            if not self._give_up(waiter.release):
+                # the slot was given to this call, give it to the next one
+                self.release()
+            raise
+        if not acquired and self._give_up(waiter.release):
+            raise BulkheadFull(
+                "bulkhead '{}' timeout waiting {}s".format(self.name, self.timeout)
+            )
+
+    async def acquire_async(self):
+        """Take a slot as acquire(), but waiting with asyncio."""
+        loop = _get_running_loop()
+        future = loop.create_future()
+        wake = functools.partial(loop.call_soon_threadsafe, _set_future_result, future)
+        with self._lock:
+            if self._try_acquire(wake):
+                return
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            if self._give_up(wake):
+                raise BulkheadFull(
+                    "bulkhead '{}' timeout waiting {}s".format(self.name, self.timeout)
+                )
+        except asyncio.CancelledError:
+            if not self._give_up(wake):
+                # the slot was given to this call, give it to the next one
+                self.release()
+            raise
+
+    def release(self):
+        """Release a slot taken by acquire()."""
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft()()
+            else:
+                self._in_flight -= 1
+
+    def stats(self):
+        """
+        Return bulkhead gauges.
+
+        Return:
+            (dict)  : in_flight (calls running), queued (calls waiting) and
+                      rejected (calls rejected since creation)
+        """
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "queued": len(self._waiters),
+                "rejected": self._rejected,
+            }
+
+
+def bulkhead(_func=None, *, max_concurrent=10, max_queue=0, timeout=None, limiter=None):
+    """
+    Limit the number of concurrent calls of a function (bulkhead).
+
+    Decorator keyword arguments (optional):
+        max_concurrent    (int): max calls running at once (default 10)
+        max_queue         (int): max calls waiting for a slot. When the
+                                 queue is full calls raise BulkheadFull
+                                 at once (default 0 - no wait)
+        timeout         (float): max seconds waiting in the queue, then
+                                 raise BulkheadFull
+                                 (default None - wait forever)
+        limiter      (Bulkhead): bulkhead used instead of the options above.
+                                 The same bulkhead can be shared by several
+                                 functions (e.g. all database calls)
+
+    Threads and asyncio tasks can share the same bulkhead. Generators keep
+    the slot until they are exhausted or closed. The bulkhead is in the
+    function attribute "bulkhead" (see Bulkhead.stats() for the gauges).
+
+    Example:
+    @bulkhead(max_concurrent=4, max_queue=20, timeout=10)
+    def query(sql):
+        ...
+
+    query.bulkhead.stats()
+    {'in_flight': 4, 'queued': 7, 'rejected': 0}
+
+    db_bulkhead = Bulkhead(max_concurrent=10, name="db")
+
+    @bulkhead(limiter=db_bulkhead)
+    async def async_query(sql):
+        ...
+    """
+
+    def decorator_bulkhead(func):
+        func_bulkhead = limiter
+        if func_bulkhead is None:
+            func_bulkhead = Bulkhead(
+                max_concurrent, max_queue=max_queue, timeout=timeout, name=func.__name__
+            )
+
+        def before(args, kwargs):
+            func_bulkhead.acquire()
+
+        async def async_before(args, kwargs):
+            await func_bulkhead.acquire_async()
+
+        def after(state, args, kwargs, result):
+            func_bulkhead.release()
+
+        def failed(state, error):
+            func_bulkhead.release()
+
+        wrapped_f = _wrap(func, before, after, failed, async_before)
+        wrapped_f.bulkhead = func_bulkhead
+        return wrapped_f
+
+    # wrapper to decorator, so it can be used with and without parameter
+    if _func is None:
+        return decorator_bulkhead
+    else:
+        return decorator_bulkhead(_func)
+
+
+class CallTimeoutError(TimeoutError):
+    """
+    Exception raised by timeout when the function takes too long.
+
+    Attribute "seconds" has the timeout.
+    """
+
+    def __init__(self, name, seconds):
+        """Initialize exception."""
+        super().__init__("function {} timed out after {}s".format(name, seconds))
+        self.seconds = seconds
+
+
+def _timeout_signal(func, seconds, args, kwargs):
+    """Call func and interrupt it with SIGALRM after seconds (main thread)."""
+
+    def handler(signum, frame):
+        raise CallTimeoutError(func.__name__, seconds)
+
+    previous_handler = signal.signal(signal.SIGALRM, handler)
+    previous_delay, _ = signal.setitimer(signal.ITIMER_REAL, seconds)
+    start_time = time.monotonic()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if previous_delay:
+            # restore timer of an outer timeout
+            remaining = previous_delay - (time.monotonic() - start_time)
+            signal.setitimer(signal.ITIMER_REAL, max(remaining, 0.001))
+
+
+def _timeout_thread(func, seconds, args, kwargs):
+    """Call func in a worker thread and wait at most seconds."""
+    outcome = []
+
+    def target():
+        try:
+            outcome.append((True, func(*args, **kwargs)))
+        except BaseException as error:
+            outcome.append((False, error))
+
+    worker = threading.Thread(
+        target=target, name="timeout-{}".format(func.__name__), daemon=True
+    )
+    worker.start()
+    worker.join(seconds)
+    if worker.is_alive():
+        raise CallTimeoutError(func.__name__, seconds)
+    success, value = outcome[0]
+    if success:
+        return value
+    raise value
+
+
+def _timeout_process_target(writer, func, args, kwargs):  # pragma: no cover
+    """Call func (in a child process) and send the outcome to the parent."""
+    try:
+        outcome = (True, func(*args, **kwargs))
+    except BaseException as error:
+        outcome = (False, error)
+    try:
+        writer.send(outcome)
+    except Exception as error:
+        # result or exception can not be pickled
+        writer.send((False, RuntimeError(repr(error))))
+    writer.close()
+
+
+def _timeout_process(func, seconds, args, kwargs):
+    """Call func in a child process, killed after seconds."""
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:  # pragma: no cover
+        context = multiprocessing.get_context()
+    reader, writer = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_timeout_process_target, args=(writer, func, args, kwargs), daemon=True
+    )
+    process.start()
+    writer.close()
+    try:
+        if not reader.poll(seconds):
+            process.terminate()
+            raise CallTimeoutError(func.__name__, seconds)
+        try:
+            success, value = reader.recv()
+        except EOFError:
+            raise RuntimeError(
+                "function {} process exited without result".format(func.__name__)
+            )
+    finally:
+        reader.close()
+        process.join()
+    if success:
+        return value
+    raise value
+
+
+_TIMEOUT_MODES = {
+    "signal": _timeout_signal,
+    "thread": _timeout_thread,
+    "process": _timeout_process,
+}
+
+
+def timeout(seconds, *, mode="auto"):
+    """
+    Limit the time a function call may take.
+
+    Decorator arguments:
+        seconds         (float): max seconds of each call
+
+    Decorator keyword arguments (optional):
+        mode              (str): how the call is interrupted:
+                                 signal: SIGALRM interrupts the function.
+                                     Only in the main thread (Unix)
+                                 thread: the function runs in a new worker
+                                     thread. On timeout the caller gets the
+                                     exception but the worker thread can
+                                     not be stopped, it keeps running
+                                 process: the function runs in a child
+                                     process, killed on timeout. Arguments
+                                     and result must be picklable
+                                 auto: signal in the main thread, else thread
+                                 (default auto)
+
+    It raises CallTimeoutError (a TimeoutError), so it can be combined with
+    retry_on_exception(exception=(TimeoutError,)).
+
+    Coroutine functions run in a task that is cancelled on timeout (mode is
+    not used). Generators are not supported.
+
+    Example:
+    @timeout(5)
+    def get_status(url):
+        return requests.get(url)
+
+    @retry_on_exception(exception=(TimeoutError,), max_retry=3)
+    @timeout(30, mode="process")
+    def parse(data):
+        ...
+
+    @timeout(2)
+    async def async_get_status(url):
+        ...
+    """
+    if mode != "auto" and mode not in _TIMEOUT_MODES:
+        raise ValueError("Invalid mode")
+    if mode == "signal" and not hasattr(signal, "setitimer"):  # pragma: no cover
+        raise ValueError("signal mode is not available")
+
+    def decorator_timeout(func):
+        if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+            raise TypeError("timeout does not support generators")
+
+        if inspect.iscoroutinefunction(func):
+
+            async def wrapped_f(*args, **kwargs):
+                # not wait_for: the TimeoutError of the coroutine itself
+                # (asyncio.TimeoutError on Python 3.11+) is not a timeout
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                try:
+                    done, _ = await asyncio.wait([task], timeout=seconds)
+                except asyncio.CancelledError:
+                    task.cancel()
+                    raise
+                if not done:
+                    task.cancel()
+                    await asyncio.wait([task])
+                    if task.cancelled():
+                        raise CallTimeoutError(func.__name__, seconds)
+                return task.result()
+
+        else:
+
+            def wrapped_f(*args, **kwargs):
+                if mode != "auto":
+                    call_timeout = _TIMEOUT_MODES[mode]
+                elif (
+                    hasattr(signal, "setitimer")
+                    and threading.current_thread() is threading.main_thread()
+                ):
+                    call_timeout = _timeout_signal
+                else:
+                    call_timeout = _timeout_thread
+                return call_timeout(func, seconds, args, kwargs)
+
+        return functools.wraps(func)(wrapped_f)
+
+    return decorator_timeout
+
+
+def _sizeof(obj):
+    """Estimate the size in bytes of obj and the objects it contains."""
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(item)
+        elif hasattr(item, "__dict__"):
+            stack.append(vars(item))
+    return size
+
+
+class _CacheShard:
+    """
+    Part of a Cache, with its own lock. Least recently used (LRU) eviction.
+
+    Entries are lists: [value, expiration time or None, size in bytes, uses]
+    """
+
+    def __init__(self, maxsize, max_bytes):
+        """Initialize empty shard."""
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key, now):
+        """Return (True, value) or (False, None) if key is missing/expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > now:
+                    self.hits += 1
+                    self._touch(key, entry)
+                    return True, entry[0]
+                self._remove(key)
+                self.expired += 1
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, expires, nbytes, bytes_over=None):
+        """
+        Add entry, evicting others if the shard is full.
+
+        bytes_over(nbytes) returns how many bytes the whole cache would be
+        over its max_bytes limit with the new entry (None: no limit).
+        """
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if self.maxsize == 0 or (
+                self.max_bytes is not None and nbytes > self.max_bytes
+            ):
+                # it would evict everything and still not fit
+                return
+            while self.entries and (
+                (self.maxsize is not None and len(self.entries) >= self.maxsize)
+                or (bytes_over is not None and bytes_over(nbytes) > 0)
+            ):
+                self._evict()
+            self._insert(key, [value, expires, nbytes, 1])
+            self.nbytes += nbytes
+
+    def evict(self):
+        """Remove the entry chosen by the eviction policy, if any."""
+        with self.lock:
+            if not self.entries:
+                return False
+            self._evict()
+            return True
+
+    def _evict(self):
+        self._remove(self._victim())
+        self.evictions += 1
+
+    def pop(self, key):
+        """Remove entry, if it exists."""
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock:
+            while self.entries:
+                self._remove(self._victim())
+
+    def _touch(self, key, entry):
+        self.entries.move_to_end(key)
+
+    def _insert(self, key, entry):
+        self.entries[key] = entry
+
+    def _remove(self, key):
+        self.nbytes -= self.entries.pop(key)[2]
+
+    def _victim(self):
+        return next(iter(self.entries))
+
+
+class _LFUCacheShard(_CacheShard):
+    """
+    Cache shard with least frequently used (LFU) eviction.
+
+    Keys are kept in buckets by number of uses, so finding the entry to
+    evict does not scan all entries. Ties are broken by least recent use.
+    """
+
+    def __init__(self, maxsize, max_bytes):
+        """Initialize empty shard."""
+        super().__init__(maxsize, max_bytes)
+        self.entries = {}
+        # {uses: OrderedDict with the keys used "uses" times}
+        self.buckets = {}
+        self.min_uses = 1
+
+    def _touch(self, key, entry):
+        self._unlink(key, entry[3])
+        entry[3] += 1
+        self.buckets.setdefault(entry[3], collections.OrderedDict())[key] = None
+
+    def _insert(self, key, entry):
+        self.entries[key] = entry
+        self.buckets.setdefault(1, collections.OrderedDict())[key] = None
+        self.min_uses = 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.nbytes -= entry[2]
+        self._unlink(key, entry[3])
+
+    def _unlink(self, key, uses):
+        bucket = self.buckets[uses]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[uses]
+            if self.min_uses == uses:
+                self.min_uses = uses + 1
+
+    def _victim(self):
+        if self.min_uses not in self.buckets:
+            self.min_uses = min(self.buckets)
+        return next(iter(self.buckets[self.min_uses]))
+
+
+class Cache:
+    """
+    Thread safe in memory cache with LRU/LFU eviction, TTL and size bound.
+
+    Keys are distributed by hash in "shards", each one with its own lock,
+    so concurrent callers using different keys rarely wait for each other.
+    maxsize is divided among the shards. max_bytes applies to the whole
+    cache: entries of the same shard are evicted first, then entries of
+    the other shards.
+
+    Keyword arguments (opt):
+        maxsize           (int): max number of entries. None for no limit,
+                                 0 to store nothing. default 1024
+        max_bytes         (int): max total size of the values in bytes,
+                                 estimated by "sizeof". default None (no limit)
+        ttl             (float): seconds an entry is valid. default None
+        policy            (str): eviction policy: lru (least recently used)
+                                 or lfu (least frequently used). default lru
+        shards            (int): number of shards. default 16
+        sizeof       (function): return value size in bytes.
+                                 default estimate with sys.getsizeof of the
+                                 value and objects it contains
+
+    Example:
+    >>> cache = Cache(maxsize=2, policy="lfu", shards=1)
+    >>> cache.set("a", 1)
+    >>> cache.get("a")
+    1
+    >>> cache.set("b", 2)
+    >>> cache.set("c", 3)
+    >>> cache.get("b", "missing")
+    'missing'
+    >>> cache.stats()
+    {'hits': 1, 'misses': 1, 'evictions': 1, 'expired': 0, 'entries': 2, 'bytes': 0}
+    """
+
+    def __init__(
+        self,
+        *,
+        maxsize=1024,
+        max_bytes=None,
+        ttl=None,
+        policy="lru",
+        shards=16,
+        sizeof=None
+    ):
+        """Initialize empty cache."""
+        if policy not in ("lru", "lfu"):
+            raise ValueError("Invalid policy")
+        if maxsize is not None:
+            shards = max(1, min(shards, maxsize))
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof if sizeof is not None else _sizeof
+        shard_class = _LFUCacheShard if policy == "lfu" else _CacheShard
+        self._shards = [
+            shard_class(
+                None if maxsize is None else maxsize // shards + (i < maxsize % shards),
+                max_bytes,
+            )
+            for i in range(shards)
+        ]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def lookup(self, key):
+        """Return (True, value) or (False, None) if key is not in the cache."""
+        return self._shard(key).get(key, time.monotonic())
+
+    def get(self, key, default=None):
+        """Return cached value of key or default."""
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def set(self, key, value, ttl=None):
+        """
+        Add value to the cache.
+
+        Arguments (opt):
+            ttl        (float): seconds the value is valid. default cache ttl
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        shard = self._shard(key)
+        if self.max_bytes is None:
+            shard.set(key, value, expires, 0)
+            return
+
+        shard.set(key, value, expires, self._sizeof(value), self._bytes_over)
+        # the shard had not enough bytes to evict: evict from other shards
+        for other in self._shards:
+            if self._bytes_over(0) <= 0:
+                break
+            if other is not shard:
+                while self._bytes_over(0) > 0 and other.evict():
+                    pass
+
+    def _bytes_over(self, nbytes):
+        """Return bytes over max_bytes if nbytes are added (approximate)."""
+        # shards are read without their locks, other shards may be changing
+        return sum(shard.nbytes for shard in self._shards) + nbytes - self.max_bytes
+
+    def delete(self, key):
+        """Remove key from the cache."""
+        self._shard(key).pop(key)
+
+    def clear(self):
+        """Remove all entries (statistics are kept)."""
+        for shard in self._shards:
+            shard.clear()
+
+    def __len__(self):
+        """Return number of entries (including expired not removed yet)."""
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def stats(self):
+        """
+        Return cache statistics.
+
+        Return:
+            (dict)  : hits, misses, evictions (entries removed to free
+                      space), expired (entries removed by ttl), entries and
+                      bytes (only calculated with max_bytes)
+        """
+        stats = dict.fromkeys(
+            ("hits", "misses", "evictions", "expired", "entries", "bytes"), 0
+        )
+        for shard in self._shards:
+            with shard.lock:
+                stats["hits"] += shard.hits
+                stats["misses"] += shard.misses
+                stats["evictions"] += shard.evictions
+                stats["expired"] += shard.expired
+                stats["entries"] += len(shard.entries)
+                stats["bytes"] += shard.nbytes
+        return stats
+
+
+# separate positional from keyword arguments in the cache key
+_KWARGS_MARK = object()
+
+
+def _key_function(func, key_args):
+    """
+    Return function make_key(args, kwargs) that returns a cache key.
+
+    The key has all arguments or, if key_args is set, the value of the
+    arguments with these names (including default values).
+    """
+    if key_args is None:
+
+        def make_key(args, kwargs):
+            if not kwargs:
+                return args
+            return args + (_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+
+    else:
+        signature = inspect.signature(func)
+
+        def make_key(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return tuple(bound.arguments[name] for name in key_args)
+
+    return make_key
+
+
+def cache(
+    _func=None,
+    *,
+    maxsize=1024,
+    max_bytes=None,
+    ttl=None,
+    policy="lru",
+    key_args=None,
+    shards=16
+):
+    """
+    Cache function results (memoization).
+
+    Decorator keyword arguments (optional):
+        maxsize           (int): max number of cached results. None for no
+                                 limit, 0 caches nothing (default 1024)
+        max_bytes         (int): max total size of cached results in bytes
+                                 (estimated) (default None - no limit)
+        ttl             (float): seconds a result is valid
+                                 (default None - forever)
+        policy            (str): eviction policy: lru (least recently used)
+                                 or lfu (least frequently used)
+                                 (default lru)
+        key_args         (list): names of the arguments used as cache key
+                                 (default None - all arguments)
+        shards            (int): number of independent parts of the cache,
+                                 each one with its own lock (default 16)
+
+    Arguments must be hashable. Exceptions are not cached. Coroutine
+    functions cache the awaited result. Generators are not supported.
+
+    The cache is in the function attribute "cache" (see Cache), with
+    statistics (cache.stats()) and cache.clear().
+
+    Example:
+    @cache(maxsize=10000, ttl=300)
+    def get_user(user_id):
+        ...
+
+    # "conn" is not part of the key
+    @cache(key_args=["sql"], max_bytes=100 * 1024 * 1024, policy="lfu")
+    def query(conn, sql):
+        ...
+
+    get_user.cache.stats()
+    {'hits': 120, 'misses': 15, 'evictions': 0, 'expired': 3, 'entries': 12,
+     'bytes': 0}
+    """
+
+    def decorator_cache(func):
+        if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+            raise TypeError("cache does not support generators")
+
+        func_cache = Cache(
+            maxsize=maxsize,
+            max_bytes=max_bytes,
+            ttl=ttl,
+            policy=policy,
+            shards=shards,
+        )
+
+        make_key = _key_function(func, key_args)
+        if inspect.iscoroutinefunction(func):
+
+            async def wrapped_f(*args, **kwargs):
+                key = make_key(args, kwargs)
+                found, result = func_cache.lookup(key)
+                if not found:
+                    result = await func(*args, **kwargs)
+                    func_cache.set(key, result)
+                return result
+
+        else:
+
+            def wrapped_f(*args, **kwargs):
+                key = make_key(args, kwargs)
+                found, result = func_cache.lookup(key)
+                if not found:
+                    result = func(*args, **kwargs)
+                    func_cache.set(key, result)
+                return result
+
+        wrapped_f = functools.wraps(func)(wrapped_f)
+        wrapped_f.cache = func_cache
+        return wrapped_f
+
+    # wrapper to decorator, so it can be used with and without parameter
+    if _func is None:
+        return decorator_cache
+    else:
+        return decorator_cache(_func)
+
+
+def _hash_update(digest, obj):
+    """Add obj to the digest, in a representation stable across runs."""
+    if obj is None or isinstance(obj, (bool, int, float, complex, str)):
+        digest.update("{}:{!r};".format(type(obj).__name__, obj).encode())
+    elif isinstance(obj, bytes):
+        digest.update("bytes:{}:".format(len(obj)).encode() + obj)
+    elif isinstance(obj, (tuple, list)):
+        digest.update("{}:{}:".format(type(obj).__name__, len(obj)).encode())
+        for item in obj:
+            _hash_update(digest, item)
+    elif isinstance(obj, (dict, set, frozenset)):
+        # order of dict/set items may change between runs: sort item hashes
+        items = obj.items() if isinstance(obj, dict) else obj
+        digest.update("{}:{}:".format(type(obj).__name__, len(obj)).encode())
+        for item_hash in sorted(_stable_hash(item) for item in items):
+            digest.update(item_hash.encode())
+    else:
+        digest.update(b"pickle:" + pickle.dumps(obj, protocol=4))
+
+
+def _stable_hash(obj):
+    """
+    Return a hash of obj that is the same in all runs and processes.
+
+    Unlike hash(), it does not change with the string hash randomization.
+    Objects other than None, numbers, str, bytes, tuple, list, dict, set
+    and frozenset are hashed by their pickle representation.
+
+    Example:
+    >>> _stable_hash({"a": 1, "b": {2, 3}}) == _stable_hash({"b": {3, 2}, "a": 1})
+    True
+    >>> len(_stable_hash(("host", 22)))
+    64
+    """
+    digest = hashlib.sha256()
+    _hash_update(digest, obj)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Persistent cache in a sqlite database, shared by threads and processes.
+
+    Values are stored pickled. Writes are sqlite transactions, so they are
+    atomic and safe for concurrent processes (the database uses WAL mode,
+    so readers do not wait for the writer).
+
+    Arguments:
+        path              (str): database file name
+
+    Keyword arguments (opt):
+        ttl             (float): seconds an entry is valid. default None
+        max_bytes         (int): max total size of the pickled values. The
+                                 least recently used entries are removed
+                                 when it is exceeded. default None (no limit)
+
+    Example:
+    cache = DiskCache("~/.cache/myapp.sqlite", ttl=3600)
+    cache.set("inventory", hosts)
+    cache.get("inventory")
+    """
+
+    # min seconds between updates of an entry access time (reads are not
+    # writes every time)
+    _TOUCH_INTERVAL = 60
+
+    def __init__(self, path, *, ttl=None, max_bytes=None):
+        """Initialize cache, the database is opened when used."""
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = ShardedCounter()
+        self.misses = ShardedCounter()
+        self.evictions = ShardedCounter()
+        self.errors = ShardedCounter()
+        self._local = threading.local()
+
+    def _connection(self):
+        """Return database connection of the current thread (and process)."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # autocommit, transactions are started explicitly
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, "
+                "value BLOB NOT NULL, expires REAL, size INTEGER NOT NULL, "
+                "accessed REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+            )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def lookup(self, key):
+        """Return (True, value) or (False, None) if key is not in the cache."""
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute(
+            "SELECT value, expires, accessed FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None:
+            data, expires, accessed = row
+            if expires is None or expires > now:
+                if now - accessed > self._TOUCH_INTERVAL:
+                    connection.execute(
+                        "UPDATE cache SET accessed = ? WHERE key = ?", (now, key)
+                    )
+                self.hits.add()
+                return True, pickle.loads(data)
+            connection.execute(
+                "DELETE FROM cache WHERE key = ? AND expires <= ?", (key, now)
+            )
+        self.misses.add()
+        return False, None
+
+    def get(self, key, default=None):
+        """Return cached value of key or default."""
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def set(self, key, value, ttl=None):
+        """
+        Add value to the cache.
+
+        Arguments (opt):
+            ttl        (float): seconds the value is valid. default cache ttl
+        """
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return
+        ttl = ttl if ttl is not None else self.ttl
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (key, data, expires, len(data), now),
+            )
+            if self.max_bytes is not None:
+                self._evict(connection, key, now)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _evict(self, connection, key, now):
+        """Remove entries until total size is below max_bytes."""
+        (total,) = connection.execute("SELECT SUM(size) FROM cache").fetchone()
+        if total <= self.max_bytes:
+            return
+        connection.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+        (total,) = connection.execute("SELECT SUM(size) FROM cache").fetchone()
+        excess = total - self.max_bytes
+        victims = []
+        for victim, size in connection.execute(
+            "SELECT key, size FROM cache WHERE key != ? ORDER BY accessed", (key,)
+        ):
+            if excess <= 0:
+                break
+            victims.append((victim,))
+            excess -= size
+        connection.executemany("DELETE FROM cache WHERE key = ?", victims)
+        self.evictions.add(len(victims))
+
+    def delete(self, key):
+        """Remove key from the cache."""
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def purge(self):
+        """Remove expired entries."""
+        self._connection().execute(
+            "DELETE FROM cache WHERE expires <= ?", (time.time(),)
+        )
+
+    def clear(self):
+        """Remove all entries."""
+        self._connection().execute("DELETE FROM cache")
+
+    def __len__(self):
+        """Return number of entries (including expired not removed yet)."""
+        return self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self):
+        """
+        Return cache statistics.
+
+        Return:
+            (dict)  : hits, misses, evictions and errors of this process,
+                      entries and bytes in the database
+        """
+        entries, nbytes = (
+            self._connection()
+            .execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache")
+            .fetchone()
+        )
+        return {
+            "hits": self.hits.value(),
+            "misses": self.misses.value(),
+            "evictions": self.evictions.value(),
+            "errors": self.errors.value(),
+            "entries": entries,
+            "bytes": nbytes,
+        }
+
+    def close(self):
+        """Close database connection of the current thread."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def _default_disk_cache_path():
+    """Return default disk_cache database file name."""
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join("~", ".cache")
+    return os.path.join(cache_dir, "pcof", "disk_cache.sqlite")
+
+
+def disk_cache(
+    _func=None,
+    *,
+    path=None,
+    ttl=None,
+    max_bytes=None,
+    version=None,
+    key_args=None,
+    cache=None
+):
+    """
+    Cache function results on disk, so they are reused by the next runs.
+
+    Decorator keyword arguments (optional):
+        path              (str): sqlite database file name
+                                 (default $XDG_CACHE_HOME/pcof/disk_cache.sqlite
+                                 or ~/.cache/pcof/disk_cache.sqlite)
+        ttl             (float): seconds a result is valid
+                                 (default None - forever)
+        max_bytes         (int): max total size of the database entries
+                                 (default None - no limit)
+        version           (str): salt added to the keys. Change it when the
+                                 function code changes and old results are
+                                 not valid anymore (default None)
+        key_args         (list): names of the arguments used as cache key
+                                 (default None - all arguments)
+        cache       (DiskCache): cache used instead of path/ttl/max_bytes
+
+    The key is a stable hash (sha256) of the function module and name,
+    version and arguments, so it is the same in all runs. Return values
+    must be picklable. Exceptions are not cached. Coroutine functions cache
+    the awaited result. Generators are not supported.
+
+    Cache errors (e.g. database locked for too long, value can not be
+    pickled) are logged, counted in stats()["errors"] and the function is
+    executed as without cache.
+
+    The cache is in the function attribute "cache" (see DiskCache).
+
+    Example:
+    @disk_cache(ttl=3600, version="2")
+    def scan_inventory(datacenter):
+        ...
+
+    @disk_cache(path="/var/tmp/api.sqlite", key_args=["url"], max_bytes=10**8)
+    def api_pull(session, url):
+        ...
+    """
+
+    def decorator_disk_cache(func):
+        if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+            raise TypeError("disk_cache does not support generators")
+
+        func_cache = cache
+        if func_cache is None:
+            func_cache = DiskCache(
+                path if path is not None else _default_disk_cache_path(),
+                ttl=ttl,
+                max_bytes=max_bytes,
+            )
+        namespace = "{}.{}".format(func.__module__, func.__qualname__)
+        make_key = _key_function(func, key_args)
+
+        def lookup(args, kwargs):
+            """Return (key, found, value)."""
+            try:
+                key = _stable_hash((namespace, version, make_key(args, kwargs)))
+                return (key,) + func_cache.lookup(key)
+            except Exception as error:
+                func_cache.errors.add()
+                LOG.warning(
+                    "Decorator disk_cache: %s lookup error: %r", namespace, error
+                )
+                return None, False, None
+
+        def store(key, result):
+            if key is None:
+                return
+            try:
+                func_cache.set(key, result)
+            except Exception as error:
+                func_cache.errors.add()
+                LOG.warning(
+                    "Decorator disk_cache: %s store error: %r", namespace, error
+                )
+
+        if inspect.iscoroutinefunction(func):
+
+            async def wrapped_f(*args, **kwargs):
+                key, found, result = lookup(args, kwargs)
+                if not found:
+                    result = await func(*args, **kwargs)
+                    store(key, result)
+                return result
+
+        else:
+
+            def wrapped_f(*args, **kwargs):
+                key, found, result = lookup(args, kwargs)
+                if not found:
+                    result = func(*args, **kwargs)
+                    store(key, result)
+                return result
+
+        wrapped_f = functools.wraps(func)(wrapped_f)
+        wrapped_f.cache = func_cache
+        return wrapped_f
+
+    # wrapper to decorator, so it can be used with and without parameter
+    if _func is None:
+        return decorator_disk_cache
+    else:
+        return decorator_disk_cache(_func)
+
+
+def singleflight(_func=None, *, key_args=None):
+    """
+    Coalesce concurrent calls with the same arguments into one execution.
+
+    While a call is running, other calls with equal arguments (threads or
+    asyncio tasks) wait for it and get the same result or exception,
+    instead of calling the function (e.g. backend) again.
+
+    Decorator keyword arguments (optional):
+        key_args         (list): names of the arguments that must be equal
+                                 (default None - all arguments)
+
+    Arguments must be hashable. Calls are coalesced only while they run at
+    the same time, results are not cached (see cache decorator).
+    A coroutine function runs in its own task: if a waiting task is
+    cancelled the execution continues for the others. Generators are not
+    supported.
+
+    Counters (ShardedCounter) are in the function attributes "executions"
+    (function executed) and "coalesced" (calls that waited for another
+    call).
+
+    Example:
+    # cache misses at the same moment call the backend only once
+    @cache(ttl=60)
+    @singleflight
+    def get_config(name):
+        return requests.get(CONFIG_URL + name).json()
+
+    get_config.__wrapped__.coalesced
+    199
+    """
+
+    def decorator_singleflight(func):
+        if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+            raise TypeError("singleflight does not support generators")
+
+        make_key = _key_function(func, key_args)
+        lock = threading.Lock()
+        # {key: running call}
+        flights = {}
+
+        if inspect.iscoroutinefunction(func):
+
+            async def run(key, args, kwargs):
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    with lock:
+                        del flights[key]
+
+            async def wrapped_f(*args, **kwargs):
+                # futures belong to a loop: calls are coalesced per loop
+                key = (_get_running_loop(), make_key(args, kwargs))
+                with lock:
+                    task = flights.get(key)
+                    if task is None:
+                        task = flights[key] = asyncio.ensure_future(
+                            run(key, args, kwargs)
+                        )
+                        wrapped_f.executions.add()
+                    else:
+                        wrapped_f.coalesced.add()
+                return await asyncio.shield(task)
+
+        else:
+
+            def wrapped_f(*args, **kwargs):
+                key = make_key(args, kwargs)
+                with lock:
+                    # [finished event, result, exception]
+                    flight = flights.get(key)
+                    leader = flight is None
+                    if leader:
+                        flight = flights[key] = [threading.Event(), None, None]
+
+                if not leader:
+                    wrapped_f.coalesced.add()
+                    flight[0].wait()
+                    if flight[2] is not None:
+                        raise flight[2]
+                    return flight[1]
+
+                wrapped_f.executions.add()
+                try:
+                    flight[1] = func(*args, **kwargs)
+                    return flight[1]
+                except BaseException as error:
+                    flight[2] = error
+                    raise
+                finally:
+                    with lock:
+                        del flights[key]
+                    flight[0].set()
+
+        wrapped_f = functools.wraps(func)(wrapped_f)
+        wrapped_f.executions = ShardedCounter()
+        wrapped_f.coalesced = ShardedCounter()
+        return wrapped_f
+
+    # wrapper to decorator, so it can be used with and without parameter
+    if _func is None:
+        return decorator_singleflight
+    else:
+        return decorator_singleflight(_func)
+
+
+def _set_batch_results(futures, results):
+    """
+    Set the result of each key future from the batch function results.
+
+    Arguments:
+        futures        (dict): {key: future} in the order of the batch keys
+        results  (list/dict) : list with a result for each key (same order)
+                               or dict {key: result}. Keys missing in the
+                               dict get KeyError.
+    """
+    if isinstance(results, collections.abc.Mapping):
+        for key, future in futures.items():
+            if key in results:
+                future.set_result(results[key])
+            else:
+                future.set_exception(KeyError(key))
+    else:
+        results = list(results)
+        if len(results) != len(futures):
+            raise ValueError(
+                "batch function returned {} results for {} keys".format(
+                    len(results), len(futures)
+                )
+            )
+        for future, result in zip(futures.values(), results):
+            future.set_result(result)
+
+
+def batch(_func=None, *, max_batch_size=100, window=0.005):
+    """
+    Batch calls of a function that receives a list of keys (DataLoader).
+
+    The decorated function is called with one key and returns its result.
+    Calls made within "window" seconds (or until "max_batch_size" keys) are
+    collected and the original function is called once with the list of
+    keys. It must return a list with one result for each key (same order)
+    or a dict {key: result} (keys missing in the dict raise KeyError).
+    If it raises an exception, all calls in the batch raise it.
+
+    Decorator keyword arguments (optional):
+        max_batch_size    (int): max keys in a batch (default 100)
+        window          (float): seconds to wait for more keys after the
+                                 first one (default 0.005)
+
+    Equal keys in a batch are sent once. Keys must be hashable.
+
+    Threads: the first thread of a batch waits the window and calls the
+    function (or the thread that fills the batch), no extra thread is used.
+    Coroutine functions: calls of the same event loop are batched and the
+    function runs in a new task.
+
+    Counters (ShardedCounter) are in the function attributes "batches"
+    (function executions) and "batched_keys" (keys sent).
+
+    Example:
+    @batch(max_batch_size=500, window=0.01)
+    def get_users(user_ids):
+        rows = db.query("SELECT * FROM users WHERE id IN %s", user_ids)
+        return {row["id"]: row for row in rows}
+
+    # called by many threads, each one with one user id
+    user = get_users(42)
+
+    @batch
+    async def get_items(item_ids):
+        return await api.bulk_get(item_ids)
+
+    item = await get_items("item-1")
+    """
+
+    def decorator_batch(func):
+        lock = threading.Lock()
+
+        if inspect.iscoroutinefunction(func):
+            # {event loop: [{key: future}, timer handle]}
+            pending = {}
+
+            async def run_batch(futures):
+                try:
+                    _set_batch_results(futures, await func(list(futures)))
+                except asyncio.CancelledError:
+                    for future in futures.values():
+                        future.cancel()
+                    raise
+                except Exception as error:
+                    for future in futures.values():
+                        if not future.done():
+                            future.set_exception(error)
+
+            def dispatch(loop, current):
+                # called by the timer or when the batch is full (timer cancelled)
+                with lock:
+                    del pending[loop]
+                current[1].cancel()
+                wrapped_f.batches.add()
+                wrapped_f.batched_keys.add(len(current[0]))
+                loop.create_task(run_batch(current[0]))
+
+            async def wrapped_f(key):
+                loop = _get_running_loop()
+                with lock:
+                    current = pending.get(loop)
+                    if current is None:
+                        current = pending[loop] = [{}, None]
+                        current[1] = loop.call_later(window, dispatch, loop, current)
+                    future = current[0].get(key)
+                    if future is None:
+                        future = current[0][key] = loop.create_future()
+                    full = len(current[0]) >= max_batch_size
+                if full:
+                    dispatch(loop, current)
+                # a cancelled caller does not cancel the result of the others
+                return await asyncio.shield(future)
+
+        else:
+            # current batch: [{key: future}, batch dispatched event]
+            state = [None]
+
+            def run_batch(futures):
+                wrapped_f.batches.add()
+                wrapped_f.batched_keys.add(len(futures))
+                try:
+                    _set_batch_results(futures, func(list(futures)))
+                except BaseException as error:
+                    for future in futures.values():
+                        if not future.done():
+                            future.set_exception(error)
+
+            def wrapped_f(key):
+                with lock:
+                    current = state[0]
+                    leader = current is None
+                    if leader:
+                        current = state[0] = [{}, threading.Event()]
+                    future = current[0].get(key)
+                    if future is None:
+                        future = current[0][key] = concurrent.futures.Future()
+                    full = len(current[0]) >= max_batch_size
+                    if full:
+                        state[0] = None
+                        current[1].set()
+
+                if full:
+                    run_batch(current[0])
+                elif leader:
+                    # wait more keys, unless another thread fills the batch
+                    current[1].wait(window)
+                    with lock:
+                        dispatch = state[0] is current
+                        if dispatch:
+                            state[0] = None
+                    if dispatch:
+                        run_batch(current[0])
+                return future.result()
+
+        wrapped_f = functools.wraps(func)(wrapped_f)
+        wrapped_f.batches = ShardedCounter()
+        wrapped_f.batched_keys = ShardedCounter()
+        return wrapped_f
+
+    # wrapper to decorator, so it can be used with and without parameter
+    if _func is None:
+        return decorator_batch
+    else:
+        return decorator_batch(_func)
+
+
+def _run_chunk(func, items):  # pragma: no cover
+    """
+    Call func for each item (in a worker process).
+
+    Return:
+        (tuple)  : (elapsed seconds, [(True, result) or (False, exception)])
+    """
+    start_time = time.perf_counter()
+    outcomes = []
+    for item in items:
+        try:
+            outcomes.append((True, func(item)))
+        except Exception as error:
+            outcomes.append((False, error))
+    return time.perf_counter() - start_time, outcomes
+
+
+# target seconds of work in each chunk when chunksize is "auto"
+_CHUNK_SECONDS = 0.05
+_MAX_CHUNKSIZE = 10000
+
+
+def _map_results(executor, func, iterable, max_workers, chunksize, ordered, errors):
+    """
+    Submit chunks of items to the executor and yield results (parallel.map).
+
+    Up to 2 chunks per worker are in the pool at once, so the items are
+    consumed lazily. If chunksize is None, it is adjusted after each chunk
+    from the measured time per item.
+    """
+    try:
+        # enough chunks to balance the work among the workers
+        max_size = max(1, -(-len(iterable) // (max_workers * 4)))
+    except TypeError:
+        max_size = _MAX_CHUNKSIZE
+    size = chunksize or 1
+    items = iter(iterable)
+    in_flight = collections.deque()
+    exhausted = False
+
+    def submit():
+        chunk = list(itertools.islice(items, size))
+        if chunk:
+            in_flight.append(executor.submit(_run_chunk, func, chunk))
+        return not chunk
+
+    try:
+        while True:
+            while not exhausted and len(in_flight) < max_workers * 2:
+                exhausted = submit()
+            if not in_flight:
+                return
+
+            if ordered:
+                future = in_flight.popleft()
+            else:
+                done, _ = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                future = next(iter(done))
+                in_flight.remove(future)
+            elapsed, outcomes = future.result()
+
+            if chunksize is None:
+                per_item = elapsed / len(outcomes)
+                size = int(_CHUNK_SECONDS / per_item) if per_item > 0 else max_size
+                size = max(1, min(size, max_size))
+
+            for success, value in outcomes:
+                if success or errors == "return":
+                    yield value
+                else:
+                    raise value
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def parallel(_func=None, *, workers=None):
+    """
+    Add method "map" to run the function in parallel in a process pool.
+
+    Decorator keyword arguments (optional):
+        workers           (int): default number of worker processes
+                                 (default os.cpu_count())
+
+    The function is not changed, calling it runs in the current process.
+    func.map(iterable, ...) calls the function with each item in worker
+    processes and returns a generator with the results.
+
+    map arguments:
+        iterable                 : items (it is consumed lazily, so it can
+                                   be a generator)
+        workers             (int): max processes used (default decorator
+                                   workers)
+        chunksize      (int/str) : items sent to a worker at once. "auto"
+                                   adjusts it from the measured time per item,
+                                   so each chunk has about 50ms of work
+                                   (default auto)
+        ordered      (True/False): results in the same order of the items.
+                                   If False, results are returned as soon as
+                                   they are ready (default True)
+        errors              (str): "raise": the exception of an item is raised
+                                   when its result is reached (results of
+                                   previous items are returned). "return":
+                                   the exception object is returned as the
+                                   result of the item (default raise)
+
+    The pool is created by the first map and reused by the next ones
+    (func.shutdown() stops it). A map with more workers creates a new
+    pool; the old one is stopped when the maps using it finish. The
+    function must be defined at module level and items and results must
+    be picklable.
+
+    Example:
+    @parallel
+    def checksum(filename):
+        ...
+
+    for result in checksum.map(filenames, workers=8):
+        print(result)
+
+    results = list(checksum.map(filenames, ordered=False, errors="return"))
+    """
+
+    def decorator_parallel(func):
+        lock = threading.Lock()
+        # [executor, number of workers]
+        pool = [None, 0]
+        # executor -> number of map generators using it
+        users = {}
+
+        def acquire_pool(max_workers):
+            with lock:
+                if pool[0] is None or pool[1] < max_workers:
+                    # a smaller pool is stopped when it is not used anymore
+                    old_executor = pool[0]
+                    pool[0] = concurrent.futures.ProcessPoolExecutor(max_workers)
+                    pool[1] = max_workers
+                    if old_executor is not None and old_executor not in users:
+                        old_executor.shutdown(wait=False)
+                users[pool[0]] = users.get(pool[0], 0) + 1
+                return pool[0]
+
+        def release_pool(executor):
+            with lock:
+                users[executor] -= 1
+                if users[executor]:
+                    return
+                del users[executor]
+                if executor is pool[0]:
+                    return
+            executor.shutdown(wait=False)
+
+        def shutdown(wait=True):
+            """
+            Stop the process pool (it is created again by the next map).
+
+            A pool still used by a map generator is stopped when the
+            generator finishes.
+            """
+            with lock:
+                executor, pool[0] = pool[0], None
+                if executor in users:
+                    return
+            if executor is not None:
+                executor.shutdown(wait=wait)
+
+        def pool_results(max_workers, *map_args):
+            executor = acquire_pool(max_workers)
+            try:
+                yield from _map_results(executor, wrapped_f, *map_args)
+            finally:
+                release_pool(executor)
+
+        def map_items(
+            iterable, workers=None, chunksize="auto", ordered=True, errors="raise"
+        ):
+            """Call the function for each item in worker processes."""
+            if errors not in ("raise", "return"):
+                raise ValueError("Invalid errors")
+            max_workers = workers or default_workers
+            return pool_results(
+                max_workers,
+                iterable,
+                max_workers,
+                None if chunksize == "auto" else chunksize,
+                ordered,
+                errors,
+            )
+
+        # the pool pickles the wrapper: it is the module attribute with the
+        # function name, func is not
+        @functools.wraps(func)
+        def wrapped_f(*args, **kwargs):
+            return func(*args, **kwargs)
+
+        default_workers = workers or os.cpu_count() or 1
+        wrapped_f.map = map_items
+        wrapped_f.shutdown = shutdown
+        return wrapped_f
+
+    # wrapper to decorator, so it can be used with and without parameter
+    if _func is None:
+        return decorator_parallel
+    else:
+        return decorator_parallel(_func)
+
+
+def print_profile(filename, limit=20, sort="cumulative", stream=None):
+    """
+    Print the top functions of a pstats file (e.g. dumped by profile).
+
+    Arguments:
+        filename         (str): pstats file name
+
+    Arguments (opt):
+        limit            (int): number of functions. default 20
+        sort             (str): pstats sort key (cumulative, tottime,
+                                calls, ...). default cumulative
+        stream          (file): output. default sys.stdout
+    """
+    stats = pstats.Stats(filename, stream=stream)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+
+
+class Profiler:
+    """
+    Thread safe aggregation of cProfile statistics.
+
+    Keyword arguments (opt):
+        filename         (str): pstats file where statistics are dumped
+                                on exit (and every dump_interval).
+                                default None (no dump)
+        dump_interval  (float): seconds between dumps. default None (only
+                                on exit)
+
+    Example:
+    profiler = Profiler(filename="/tmp/myapp.pstats")
+    profile = cProfile.Profile()
+    profile.runcall(my_func)
+    profiler.add(profile)
+    profiler.print_top(10)
+    """
+
+    def __init__(self, *, filename=None, dump_interval=None):
+        """Initialize empty statistics."""
+        self.filename = os.path.expanduser(filename) if filename else None
+        self.dump_interval = dump_interval
+        self.samples = 0
+        # errors merging or dumping statistics (logged, never raised by add)
+        self.errors = 0
+        self._stats = None
+        self._lock = threading.Lock()
+        # one dump at a time, without blocking add()
+        self._dump_lock = threading.Lock()
+        self._last_dump = time.monotonic()
+        if self.filename:
+            atexit.register(self.dump)
+
+    def add(self, profile):
+        """
+        Merge statistics of a cProfile.Profile (or pstats.Stats).
+
+        Statistics are dumped if dump_interval seconds passed since the
+        last dump. Errors are logged and counted in "errors", not raised.
+        """
+        try:
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self.samples += 1
+
+                now = time.monotonic()
+                dump_due = (
+                    self.filename
+                    and self.dump_interval is not None
+                    and now - self._last_dump >= self.dump_interval
+                )
+                if dump_due:
+                    # other threads do not dump until the next interval
+                    self._last_dump = now
+            if dump_due:
+                self.dump()
+        except Exception as error:
+            with self._lock:
+                self.errors += 1
+            LOG.warning("Decorator profile: statistics error: %r", error)
+
+    def stats(self, stream=None):
+        """Return a copy of the statistics (pstats.Stats)."""
+        stats = pstats.Stats(stream=stream)
+        with self._lock:
+            if self._stats is not None:
+                stats.add(self._stats)
+        return stats
+
+    def dump(self, filename=None):
+        """
+        Write statistics to a pstats file (atomically).
+
+        Arguments (opt):
+            filename     (str): file name. default Profiler filename
+        """
+        filename = filename or self.filename
+        if not filename:
+            raise ValueError("No filename to dump statistics")
+        with self._dump_lock:
+            with self._lock:
+                self._last_dump = time.monotonic()
+                empty = self._stats is None
+            if empty:
+                return
+            # copy, so add() is not blocked while the file is written
+            stats = self.stats()
+            temp_fd, temp_filename = tempfile.mkstemp(
+                prefix=os.path.basename(filename) + ".",
+                dir=os.path.dirname(os.path.abspath(filename)),
+            )
+            try:
+                os.close(temp_fd)
+                stats.dump_stats(temp_filename)
+                os.replace(temp_filename, filename)
+            except BaseException:
+                os.unlink(temp_filename)
+                raise
+
+    def print_top(self, limit=20, sort="cumulative", stream=None):
+        """
+        Print the top functions called by the profiled calls.
+
+        Arguments (opt):
+            limit            (int): number of functions. default 20
+            sort             (str): pstats sort key (cumulative, tottime,
+                                    calls, ...). default cumulative
+            stream          (file): output. default sys.stdout
+        """
+        self.stats(stream).strip_dirs().sort_stats(sort).print_stats(limit)
+
+    def reset(self):
+        """Remove all statistics."""
+        with self._lock:
+            self._stats = None
+            self.samples = 0
+
+
+# thread is running a profiled call (only one profiler per thread)
+_PROFILING = threading.local()
+
+
+def profile(
+    _func=None, *, sample_every=10, filename=None, dump_interval=None, profiler=None
+):
+    """
+    Profile (cProfile) a sample of the function calls.
+
+    Decorator keyword arguments (optional):
+        sample_every      (int): profile one call of every "sample_every"
+                                 calls, the others run without profiler
+                                 overhead. 1 profiles all calls (default 10)
+        filename          (str): pstats file where merged statistics are
+                                 dumped on exit (and every dump_interval)
+                                 (default None - no dump)
+        dump_interval   (float): seconds between dumps
+                                 (default None - only on exit)
+        profiler     (Profiler): profiler used instead of filename and
+                                 dump_interval. It can be shared by several
+                                 functions
+
+    Statistics of all profiled calls (of all threads) are merged in the
+    function attribute "profiler" (see Profiler). A call of a profiled
+    function inside another profiled call is part of the outer profile.
+    Errors merging or dumping statistics are logged, the call result is
+    not affected.
+
+    Coroutine functions and generators are not supported: the profiler
+    would measure everything running in the thread while they are
+    suspended.
+
+    Example:
+    @profile(sample_every=100, filename="/tmp/report.pstats")
+    def build_report(data):
+        ...
+
+    build_report.profiler.print_top(10)
+    print_profile("/tmp/report.pstats", sort="tottime")
+    """
+
+    def decorator_profile(func):
+        if (
+            inspect.iscoroutinefunction(func)
+            or inspect.isgeneratorfunction(func)
+            or inspect.isasyncgenfunction(func)
+        ):
+            raise TypeError("profile does not support coroutines and generators")
+
+        func_profiler = profiler
+        if func_profiler is None:
+            func_profiler = Profiler(filename=filename, dump_interval=dump_interval)
+        calls = itertools.count()
+
+        @functools.wraps(func)
+        def wrapped_f(*args, **kwargs):
+            if next(calls) % sample_every or getattr(_PROFILING, "active", False):
+                return func(*args, **kwargs)
+
+            call_profile = cProfile.Profile()
+            try:
+                call_profile.enable()
+            except ValueError:
+                # another profiler is active in the thread (python >= 3.12)
+                return func(*args, **kwargs)
+
+            _PROFILING.active = True
+            try:
+                return func(*args, **kwargs)
+            finally:
+                call_profile.disable()
+                _PROFILING.active = False
+                func_profiler.add(call_profile)
+
+        wrapped_f.profiler = func_profiler
+        return wrapped_f
+
+    # wrapper to decorator, so it can be used with and without parameter
+    if _func is None:
+        return decorator_profile
+    else:
+        return decorator_profile(_func)
+
+
 # vim: ts=4
@@ -7,14 +7,30 @@ Package with collection of small useful functions.
 Miscellaneous functions
 """
 
-
+import array
+import atexit
 import collections
+import collections.abc
+import datetime
+import email.message
+import gzip
 import hashlib
+import itertools
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import re
+import shutil
 import smtplib
+import socket
 import subprocess
 import sys
-
+import threading
+import time
+import traceback
+import weakref
 
 ##############################################################################
 ##############################################################################
@@ -23,6 +39,21 @@ import sys
 ##############################################################################
 
 
+# color name -> (escape sequence, reset sequence) added around the text
+_COLOR_TEXT = dict.fromkeys(("", "nocolor", None), ("", ""))
+_COLOR_TEXT.update(
+    {
+        "blue": ("\033[0;34m", "\033[0m"),
+        "red": ("\033[1;31m", "\033[0m"),
+        "green": ("\033[0;32m", "\033[0m"),
+        "yellow": ("\033[0;33m", "\033[0m"),
+        "cyan": ("\033[0;36m", "\033[0m"),
+    }
+)
+# same colors names, without escape sequences
+_NO_COLOR_TEXT = dict.fromkeys(_COLOR_TEXT, ("", ""))
+
+
 def msg(color, msg_text, exitcode=0, *, end="\n", flush=True, output=None):
     """
     Print colored text.
@@ -46,35 +77,163 @@ def msg(color, msg_text, exitcode=0, *, end="\n", flush=True, output=None):
     Example:
         msg("blue", "nice text in blue")
         msg("red", "Error in my script. terminating", 1)
-    """
-    color_dic = {
-        "blue": "\033[0;34m",
-        "red": "\033[1;31m",
-        "green": "\033[0;32m",
-        "yellow": "\033[0;33m",
-        "cyan": "\033[0;36m",
-        "resetcolor": "\033[0m",
-    }
 
+    To print many lines, MsgWriter is much faster.
+    """
     if not output:
         output = sys.stdout
 
-    if not color or color == "nocolor":
-        print(msg_text, end=end, file=output, flush=flush)
-    else:
-        if color not in color_dic:
-            raise ValueError("Invalid color")
-        print(
-            "{}{}{}".format(color_dic[color], msg_text, color_dic["resetcolor"]),
-            end=end,
-            file=output,
-            flush=flush,
-        )
+    output.write(_format_msg(_COLOR_TEXT, color, msg_text, end))
+    if flush:
+        output.flush()
 
     if exitcode:
         sys.exit(exitcode)
 
 
+def _format_msg(color_text, color, msg_text, end):
+    """Return msg_text with the color escape sequences and end."""
+    if end is None:
+        # like print()
+        end = "\n"
+    try:
+        # False, None, "" ... no color
+        prefix, suffix = color_text[color or ""]
+    except KeyError:
+        raise ValueError("Invalid color")
+    return "{}{}{}{}".format(prefix, msg_text, suffix, end)
+
+
+# MsgWriter objects to be flushed when the program exits
+_MSG_WRITERS = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_msg_writers():  # pragma: no cover
+    """Flush all MsgWriter objects."""
+    for writer in list(_MSG_WRITERS):
+        writer.flush()
+
+
+class MsgWriter:
+    """
+    Buffered writer for (colored) text.
+
+    It is meant for programs that print a lot of lines. Text is kept in a
+    buffer that is written to the output stream when:
+      - the buffer has more than "buffer_size" chars
+      - more than "flush_interval" seconds passed since the last write to
+        the stream. It is only checked when a new text is written (there is
+        no timer): text written before an idle period stays in the buffer
+        until the next write, flush(), close() or the program exit
+      - flush() or close() is called, the "with" block ends or the
+        program exits
+
+    Arguments (opt):
+        output        (stream): a file-like object (stream).
+                                default sys.stdout
+
+    Keyword arguments (opt):
+        colors    (True/False): add color escape sequences to the text.
+                                default None - only if output is a TTY
+        buffer_size      (int): max number of chars kept in the buffer.
+                                0 writes each text immediately.
+                                default 65536
+        flush_interval (float): max seconds text is kept in the buffer
+                                (checked on write).
+                                default 1
+
+    Example:
+        with MsgWriter() as writer:
+            for num in range(1000000):
+                writer.write("blue", "processing item {}".format(num))
+            writer.write("green", "done")
+
+        writer = MsgWriter(sys.stderr, colors=False)
+        writer.write("red", "error")
+        writer.flush()
+    """
+
+    def __init__(
+        self, output=None, *, colors=None, buffer_size=65536, flush_interval=1
+    ):
+        """Initialize writer."""
+        self.output = output if output else sys.stdout
+        if colors is None:
+            isatty = getattr(self.output, "isatty", None)
+            colors = bool(isatty and isatty())
+        self.colors = colors
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+
+        self._color_text = _COLOR_TEXT if colors else _NO_COLOR_TEXT
+        self._buffer = []
+        self._buffer_len = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        _MSG_WRITERS.add(self)
+
+    def write(self, color, msg_text, *, end="\n"):
+        """
+        Write colored text.
+
+        Arguments:
+            color     (str): color name (blue, red, green, yellow,
+                             cyan or nocolor)
+            msg_text  (str): text to be written
+
+        Keyword arguments (optional):
+            end       (str): string appended after the last char in
+                             "msg_text". default a newline
+        """
+        text = _format_msg(self._color_text, color, msg_text, end)
+        with self._lock:
+            self._buffer.append(text)
+            self._buffer_len += len(text)
+            if (
+                self._buffer_len > self.buffer_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self._flush()
+
+    def flush(self):
+        """Write buffered text to the output stream."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        """Write buffered text to the output stream (lock must be held)."""
+        if self._buffer:
+            self.output.write("".join(self._buffer))
+            self._buffer = []
+            self._buffer_len = 0
+        self.output.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Flush the buffer. Output stream is not closed."""
+        self.flush()
+        _MSG_WRITERS.discard(self)
+
+    def __enter__(self):
+        """Enter context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Flush the buffer when context manager exits."""
+        self.close()
+
+    def __del__(self):
+        """Flush the buffer when the writer is garbage collected."""
+        # no other reference exists, so the lock is not needed (and it
+        # could be held by the code interrupted by the garbage collector)
+        if getattr(self, "_buffer", None):
+            try:
+                self._flush()
+            except Exception:  # pragma: no cover
+                pass
+
+
 ##############################################################################
 ##############################################################################
 # Email
@@ -94,27 +253,555 @@ def send_email(
         subject          (str): mail subject
         mail_server (str, opt): mail server address. Default is localhost
     """
-    mail_msg = """\
-From: %s
-To: %s
-Subject: %s
-
-%s
-""" % (
-        mail_from,
-        mail_to,
-        subject,
-        body,
-    )
+    mail_msg = _build_email(mail_from, mail_to, subject, body)
 
     # send the email
     try:
         smtpobj = smtplib.SMTP(mailserver)
-        smtpobj.sendmail(mail_from, mail_to, mail_msg)
+        smtpobj.send_message(mail_msg, mail_from, mail_to)
     finally:
         smtpobj.quit()
 
 
+def _build_email(mail_from, mail_to, subject, body):
+    """Return email message (email.message.EmailMessage)."""
+    if not isinstance(mail_to, str):
+        mail_to = ", ".join(mail_to)
+    mail_msg = email.message.EmailMessage()
+    mail_msg["From"] = mail_from
+    mail_msg["To"] = mail_to
+    mail_msg["Subject"] = subject
+    # non-ASCII text is encoded (utf-8)
+    mail_msg.set_content(str(body))
+    return mail_msg
+
+
+class SMTPPool:
+    """
+    Send emails reusing SMTP connections.
+
+    Up to "size" connections are opened (and authenticated) on demand and
+    reused by the next messages, so the TCP connection, EHLO, STARTTLS and
+    login are done once per connection instead of once per message.
+    send_many() sends a batch of messages back to back in one connection.
+    If the connection is lost, the message is sent again on a new
+    connection. It is thread safe.
+
+    Arguments (opt):
+        mailserver      (str): mail server address. default localhost
+        port            (int): mail server port. default 0 (smtplib default)
+
+    Keyword arguments (opt):
+        size            (int): max number of connections. default 4
+        username        (str): login username. default no login
+        password        (str): login password
+        starttls (True/False): use STARTTLS. default False
+        timeout         (int): connection timeout in seconds. default 60
+        max_messages    (int): messages sent on a connection before it is
+                               reopened (some servers limit it).
+                               default 100
+
+    Example:
+        with SMTPPool("smtp.example.com", size=2) as pool:
+            pool.send("me@example.com", "you@example.com", "subject", "body")
+            failed = pool.send_many(
+                ("me@example.com", user, "alert", "disk full") for user in users
+            )
+            print(pool.stats())
+    """
+
+    def __init__(
+        self,
+        mailserver="localhost",
+        port=0,
+        *,
+        size=4,
+        username=None,
+        password=None,
+        starttls=False,
+        timeout=60,
+        max_messages=100,
+    ):
+        """Initialize pool. Connections are opened when needed."""
+        self.mailserver = mailserver
+        self.port = port
+        self.size = size
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.max_messages = max_messages
+
+        # idle connections: [smtplib.SMTP, number of messages sent].
+        # [None, 0] is a free slot, the connection is opened when needed.
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put([None, 0])
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = dict.fromkeys(
+            ("sent", "failed", "connections", "reconnects", "send_time"), 0
+        )
+
+    def _connect(self):
+        """Open and return a new SMTP connection."""
+        conn = smtplib.SMTP(self.mailserver, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                conn.starttls()
+            if self.username:
+                conn.login(self.username, self.password)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def _acquire(self):
+        """Return an idle connection (wait for one if all are in use)."""
+        if self._closed:
+            raise RuntimeError("SMTPPool is closed")
+        pooled = self._idle.get()
+        if pooled[0] is None:
+            try:
+                pooled[0] = self._connect()
+            except BaseException:
+                self._idle.put(pooled)
+                raise
+            pooled[1] = 0
+            with self._lock:
+                self._stats["connections"] += 1
+        return pooled
+
+    def _release(self, pooled):
+        """Put connection back in the pool."""
+        if pooled[0] is not None and (self._closed or pooled[1] >= self.max_messages):
+            self._quit(pooled[0])
+            pooled[0] = None
+        self._idle.put(pooled)
+
+    @staticmethod
+    def _quit(conn):
+        """Close SMTP connection, ignoring errors."""
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def _send(self, pooled, mail_from, mail_to, mail_msg):
+        """Send message, reconnecting once if connection is lost."""
+        if pooled[0] is not None and pooled[1] >= self.max_messages:
+            # messages per connection limit, also in a send_many batch
+            self._quit(pooled[0])
+            # no connection if _connect fails
+            pooled[0] = None
+            pooled[0] = self._connect()
+            pooled[1] = 0
+            with self._lock:
+                self._stats["connections"] += 1
+
+        for attempt in (1, 2):
+            if pooled[0] is None:
+                # connection lost
+                pooled[0] = self._connect()
+                pooled[1] = 0
+                with self._lock:
+                    self._stats["connections"] += 1
+                    self._stats["reconnects"] += 1
+            try:
+                pooled[0].send_message(mail_msg, mail_from, mail_to)
+                pooled[1] += 1
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout):
+                pooled[0].close()
+                pooled[0] = None
+                if attempt == 2:
+                    raise
+
+    def send_many(self, messages):
+        """
+        Send many messages using the same connection.
+
+        Arguments:
+            messages   (iter): iterable with messages:
+                               (mail_from, mail_to, subject, body)
+
+        Return:
+            (list)           : [(message, exception), ...] messages that
+                               could not be sent
+        """
+        failed = []
+        sent = 0
+        start_time = time.perf_counter()
+        pooled = self._acquire()
+        try:
+            for message in messages:
+                mail_from, mail_to, subject, body = message
+                try:
+                    self._send(
+                        pooled,
+                        mail_from,
+                        mail_to,
+                        _build_email(mail_from, mail_to, subject, body),
+                    )
+                    sent += 1
+                # ValueError: invalid message (e.g. newline in subject)
+                except (smtplib.SMTPException, OSError, ValueError) as error:
+                    failed.append((message, error))
+        finally:
+            self._release(pooled)
+            with self._lock:
+                self._stats["sent"] += sent
+                self._stats["failed"] += len(failed)
+                self._stats["send_time"] += time.perf_counter() - start_time
+        return failed
+
+    def send(self, mail_from, mail_to, subject, body):
+        """
+        Send an email.
+
+        Arguments:
+            mail_from        (str): send email from this address
+            mail_to   (str, list): send email to this address(es)
+            subject          (str): mail subject
+            body             (str): mail body
+        """
+        failed = self.send_many([(mail_from, mail_to, subject, body)])
+        if failed:
+            raise failed[0][1]
+
+    def stats(self):
+        """
+        Return pool statistics.
+
+        Return:
+            (dict): sent               - messages sent
+                    failed             - messages not sent
+                    connections        - connections opened
+                    reconnects         - connections reopened after an error
+                    send_time          - seconds spent sending messages
+                    messages_per_second - sent / send_time
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["messages_per_second"] = (
+            stats["sent"] / stats["send_time"] if stats["send_time"] else 0.0
+        )
+        return stats
+
+    def close(self):
+        """Close all connections. The pool can not be used anymore."""
+        self._closed = True
+        # connections in use are closed when they are released
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for pooled in idle:
+            if pooled[0] is not None:
+                self._quit(pooled[0])
+                pooled[0] = None
+            self._idle.put(pooled)
+
+    def __enter__(self):
+        """Enter context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close connections when context manager exits."""
+        self.close()
+
+
+class EmailOutbox:
+    """
+    Send emails in background threads.
+
+    send() puts the message in a bounded queue and returns immediately.
+    Worker threads send the messages (using SMTPPool), retrying with
+    exponential backoff when it fails.
+
+    Optionally, identical messages (same from, to, subject and body) sent
+    within "coalesce_window" seconds are coalesced: the first one is sent
+    right away and the repeated ones are counted and sent as one digest
+    email when the window ends.
+
+    Call close() (or use it as a context manager) to send the queued
+    messages before the program exits.
+
+    Arguments (opt):
+        mailserver        (str): mail server address. default localhost
+        port              (int): mail server port. default 0
+
+    Keyword arguments (opt):
+        workers           (int): number of worker threads. default 2
+        queue_size        (int): max number of messages in the queue.
+                                 default 1000
+        max_retry         (int): max number of attempts to send a message.
+                                 default 3
+        retry_delay     (float): seconds to wait before the first retry. It
+                                 doubles on each retry. default 1
+        coalesce_window (float): seconds to coalesce identical messages.
+                                 default 0 - no coalescing
+        pool          (SMTPPool): pool used to send the messages.
+                                  default SMTPPool(mailserver, port,
+                                                   size=workers)
+
+    Example:
+        with EmailOutbox("smtp.example.com", coalesce_window=300) as outbox:
+            outbox.send("me@example.com", "ops@example.com", "disk full", "...")
+    """
+
+    def __init__(
+        self,
+        mailserver="localhost",
+        port=0,
+        *,
+        workers=2,
+        queue_size=1000,
+        max_retry=3,
+        retry_delay=1,
+        coalesce_window=0,
+        pool=None,
+    ):
+        """Initialize outbox and start worker threads."""
+        self.pool = pool if pool else SMTPPool(mailserver, port, size=workers)
+        self.max_retry = max_retry
+        self.retry_delay = retry_delay
+        self.coalesce_window = coalesce_window
+        # [(message, exception), ...] last messages that could not be sent
+        self.failed = collections.deque(maxlen=100)
+
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            ("queued", "sent", "failed", "retries", "coalesced", "digests"), 0
+        )
+        # message -> [end of window, repeated messages], in window start order
+        self._coalesced = collections.OrderedDict()
+        self._digest_cond = threading.Condition(self._lock)
+        self._closed = False
+
+        self._workers = [
+            threading.Thread(target=self._worker, name="EmailOutbox", daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in self._workers:
+            thread.start()
+        self._digest_thread = None
+        if coalesce_window:
+            self._digest_thread = threading.Thread(
+                target=self._digest_worker, name="EmailOutbox-digest", daemon=True
+            )
+            self._digest_thread.start()
+
+    def send(self, mail_from, mail_to, subject, body, *, block=True, timeout=None):
+        """
+        Put a message in the queue to be sent.
+
+        Arguments:
+            mail_from        (str): send email from this address
+            mail_to   (str, list): send email to this address(es)
+            subject          (str): mail subject
+            body             (str): mail body
+
+        Keyword arguments (opt):
+            block     (True/False): wait for space if the queue is full.
+                                    default True
+            timeout        (float): max seconds to wait for space
+
+        Return:
+            (True/False): True if queued, False if coalesced with a
+                          message already sent
+
+        Raise:
+            queue.Full if the queue is full (block False or timeout)
+        """
+        if not isinstance(mail_to, str):
+            mail_to = tuple(mail_to)
+        message = (mail_from, mail_to, subject, body)
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("EmailOutbox is closed")
+            if self.coalesce_window:
+                coalesced = self._coalesced.get(message)
+                if coalesced:
+                    coalesced[1] += 1
+                    self._stats["coalesced"] += 1
+                    return False
+                self._coalesced[message] = [time.monotonic() + self.coalesce_window, 0]
+                self._digest_cond.notify()
+
+        try:
+            self._queue.put(message, block, timeout)
+        except queue.Full:
+            with self._lock:
+                self._coalesced.pop(message, None)
+            raise
+        with self._lock:
+            self._stats["queued"] += 1
+        return True
+
+    def _worker(self):
+        """Send messages from the queue (worker thread)."""
+        while True:
+            message = self._queue.get()
+            try:
+                if message is None:
+                    return
+                self._deliver(message)
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, message):
+        """
+        Send a message, retrying with exponential backoff.
+
+        Any error is counted as failed (the worker thread must not die),
+        but only SMTP and network errors are retried.
+        """
+        for attempt in range(1, self.max_retry + 1):
+            try:
+                self.pool.send(*message)
+            except Exception as error:
+                if attempt == self.max_retry or not isinstance(
+                    error, (smtplib.SMTPException, OSError)
+                ):
+                    with self._lock:
+                        self._stats["failed"] += 1
+                    self.failed.append((message, error))
+                    return
+                with self._lock:
+                    self._stats["retries"] += 1
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            else:
+                with self._lock:
+                    self._stats["sent"] += 1
+                return
+
+    def _digest_worker(self):
+        """Queue digest messages when coalesce windows end (thread)."""
+        while True:
+            with self._lock:
+                message = self._next_window_end()
+                if message is None:
+                    return
+                repeated = self._coalesced.pop(message)[1]
+            if repeated:
+                self._queue_digest(message, repeated)
+
+    def _next_window_end(self):
+        """
+        Wait for the next coalesce window to end (lock must be held).
+
+        Return the message of the window or None if outbox is closed.
+        Windows end immediately when the outbox is closed.
+        """
+        while True:
+            if not self._coalesced:
+                if self._closed:
+                    return None
+                self._digest_cond.wait()
+                continue
+            message, (window_end, _) = next(iter(self._coalesced.items()))
+            wait = window_end - time.monotonic()
+            if wait <= 0 or self._closed:
+                return message
+            self._digest_cond.wait(wait)
+
+    def _queue_digest(self, message, repeated):
+        """Queue digest email for a repeated message."""
+        mail_from, mail_to, subject, body = message
+        self._queue.put(
+            (
+                mail_from,
+                mail_to,
+                "{} (repeated {} times)".format(subject, repeated),
+                "{}\n\nThis message was repeated {} times in {} seconds.\n".format(
+                    body, repeated, self.coalesce_window
+                ),
+            )
+        )
+        with self._lock:
+            self._stats["digests"] += 1
+            self._stats["queued"] += 1
+
+    def flush(self, timeout=None):
+        """
+        Wait until all queued messages are sent (or failed).
+
+        Keyword arguments (opt):
+            timeout    (float): max seconds to wait. default wait forever
+
+        Return:
+            (True/False): True if the queue is empty
+        """
+        end_time = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                if end_time is None:
+                    self._queue.all_tasks_done.wait()
+                else:
+                    remaining = end_time - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Send pending digests and queued messages and stop the threads.
+
+        Keyword arguments (opt):
+            timeout    (float): max seconds to wait for the queued messages
+
+        Return:
+            (True/False): True if all messages were processed
+        """
+        with self._lock:
+            self._closed = True
+            self._digest_cond.notify()
+        if self._digest_thread:
+            self._digest_thread.join()
+
+        done = self.flush(timeout)
+        if done:
+            for _ in self._workers:
+                self._queue.put(None)
+            for thread in self._workers:
+                thread.join()
+            self._workers = []
+            self.pool.close()
+        return done
+
+    def stats(self):
+        """
+        Return outbox statistics.
+
+        Return:
+            (dict): queued    - messages put in the queue (digests included)
+                    sent      - messages sent
+                    failed    - messages not sent after max_retry attempts
+                    retries   - attempts that failed and were retried
+                    coalesced - messages coalesced with a previous one
+                    digests   - digest messages queued
+                    pending   - messages in the queue
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pending"] = self._queue.qsize()
+        return stats
+
+    def __enter__(self):
+        """Enter context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Send queued messages when context manager exits."""
+        self.close()
+
+
 ##############################################################################
 ##############################################################################
 # Log
@@ -123,11 +810,29 @@ Subject: %s
 
 
 def setup_logging(
-    logfile=None, *, filemode="a", date_format=None, log_level="DEBUG"
-):  # pragma: no cover
+    logfile=None,
+    *,
+    filemode="a",
+    date_format=None,
+    log_level="DEBUG",
+    log_format="text",
+    use_queue=False,
+    queue_size=10000,
+    queue_overflow="block",
+    max_bytes=0,
+    rotate_when=None,
+    rotate_interval=1,
+    backup_count=0,
+    max_total_bytes=0,
+    compress=False,
+    filters=None,
+):
     """
     Configure logging.
 
+    Like logging.basicConfig, it does nothing if the root logger already
+    has handlers (the log file is not opened).
+
     Arguments (opt):
         logfile     (str): log file to write the log messages
                                If not specified, it shows log messages
@@ -140,6 +845,35 @@ def setup_logging(
         log_level   (str): specifies the lowest-severity log message
                            DEBUG, INFO, WARNING, ERROR or CRITICAL
                            default is DEBUG
+        log_format  (str): text - "date module function level message" lines
+                                  (default)
+                           json - one JSON object per line (see JsonFormatter)
+        use_queue (True/False): log messages are put in a queue and written
+                                (file/stderr) by a background thread, so
+                                the caller does not wait for the I/O.
+                                Use shutdown_logging() to write pending
+                                messages (it is also called on exit).
+                                default False
+        queue_size  (int): max number of messages in the queue. default 10000
+        queue_overflow (str): what to do when the queue is full:
+                              block - wait for space in the queue (default)
+                              drop  - discard the message
+                              count - discard the message and log how many
+                                      messages were discarded
+        Log file rotation (see RotatingLogFileHandler):
+        max_bytes   (int): rotate the log file when it reaches this size
+        rotate_when (str): rotate the log file every "rotate_interval"
+                           S (seconds), M (minutes), H (hours), D (days) or
+                           midnight
+        rotate_interval (int): default 1
+        backup_count    (int): max number of rotated files to keep
+        max_total_bytes (int): max total size of the rotated files
+        compress (True/False): gzip rotated files in a background thread
+                               default False
+        filters    (list): logging.Filter objects added to the handler,
+                           e.g. RateLimitFilter, SamplingFilter or
+                           DuplicateFilter. In queue mode, they run before
+                           the message is put in the queue.
     """
     dict_level = {
         "DEBUG": logging.DEBUG,
@@ -153,23 +887,580 @@ def setup_logging(
         raise ValueError("Invalid log_level")
     if filemode not in ["a", "w"]:
         raise ValueError("Invalid filemode")
+    if log_format not in ["text", "json"]:
+        raise ValueError("Invalid log_format")
+    if (max_bytes or rotate_when) and not logfile:
+        raise ValueError("Log rotation requires logfile")
+
+    # logging is already configured (logging.basicConfig would do nothing):
+    # do not open (and truncate) the log file
+    if logging.getLogger().handlers:
+        return logging.getLogger(__name__)
 
     if not date_format:
         date_format = "%m/%d/%Y %H:%M:%S"
 
     log_fmt = "%(asctime)s %(module)s %(funcName)s %(levelname)s %(message)s"
 
-    logging.basicConfig(
-        level=dict_level[log_level],
-        format=log_fmt,
-        datefmt=date_format,
-        filemode=filemode,
-        filename=logfile,
-    )
+    if max_bytes or rotate_when:
+        handler = RotatingLogFileHandler(
+            logfile,
+            filemode,
+            max_bytes=max_bytes,
+            when=rotate_when,
+            interval=rotate_interval,
+            backup_count=backup_count,
+            max_total_bytes=max_total_bytes,
+            compress=compress,
+        )
+    elif logfile:
+        handler = logging.FileHandler(logfile, mode=filemode)
+    else:
+        handler = logging.StreamHandler()
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter(datefmt=date_format))
+    else:
+        handler.setFormatter(logging.Formatter(log_fmt, date_format))
+
+    if use_queue:
+        queue_handler = LogQueueHandler(queue_size, overflow=queue_overflow)
+        listener = LogQueueListener(queue_handler.queue, handler)
+        handler = queue_handler
+
+    for log_filter in filters or []:
+        handler.addFilter(log_filter)
+
+    logging.basicConfig(level=dict_level[log_level], handlers=[handler])
+
+    if use_queue:
+        if not _LOG_LISTENERS:
+            atexit.register(shutdown_logging)
+        listener.start()
+        _LOG_LISTENERS.append((listener, handler))
 
     return logging.getLogger(__name__)
 
 
+# (QueueListener, LogQueueHandler) started by setup_logging
+_LOG_LISTENERS = []
+
+
+def shutdown_logging():
+    """
+    Stop background logging threads started by setup_logging.
+
+    It waits until all messages in the queue are written.
+    It is automatically called when the program exits.
+
+    The queue handler is replaced by the real handler (file/stderr) in
+    the root logger, so messages logged afterwards are written directly.
+    """
+    root_logger = logging.getLogger()
+    while _LOG_LISTENERS:
+        listener, queue_handler = _LOG_LISTENERS.pop()
+        root_logger.removeHandler(queue_handler)
+        listener.stop()
+        for handler in listener.handlers:
+            for log_filter in queue_handler.filters:
+                handler.addFilter(log_filter)
+            root_logger.addHandler(handler)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler with a bounded queue.
+
+    Log records are put in the queue and a logging.handlers.QueueListener
+    (running in a background thread) sends them to the real handlers.
+
+    Arguments:
+        queue_size   (int): max number of records in the queue
+
+    Keyword arguments (opt):
+        overflow     (str): what to do when the queue is full:
+                            block - wait for space in the queue (default)
+                            drop  - discard the record
+                            count - discard the record and, as soon as the
+                                    queue has space, put a WARNING record
+                                    with the number of discarded records
+
+    Attributes:
+        dropped      (int): number of records discarded
+    """
+
+    def __init__(self, queue_size, *, overflow="block"):
+        """Initialize handler."""
+        if overflow not in ("block", "drop", "count"):
+            raise ValueError("Invalid overflow")
+        super().__init__(queue.Queue(queue_size))
+        # only the message is formatted in the caller thread, the real
+        # handlers format the record (logging.basicConfig does not replace it)
+        self.setFormatter(logging.Formatter("%(message)s"))
+        self.overflow = overflow
+        self.dropped = 0
+        # dropped records not logged yet (overflow count)
+        self._not_reported = 0
+
+    def enqueue(self, record):
+        """Put record in the queue (handler lock is held by the caller)."""
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+
+        try:
+            if self._not_reported:
+                self.queue.put_nowait(
+                    logging.LogRecord(
+                        record.name,
+                        logging.WARNING,
+                        __file__,
+                        0,
+                        "%d log records dropped, logging queue is full",
+                        (self._not_reported,),
+                        None,
+                        "LogQueueHandler",
+                    )
+                )
+                self._not_reported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.overflow == "count":
+                self._not_reported += 1
+
+
+class LogQueueListener(logging.handlers.QueueListener):
+    """QueueListener that waits for space in a full queue to stop."""
+
+    def enqueue_sentinel(self):
+        """Put the stop marker in the queue, even if it is full."""
+        self.queue.put(self._sentinel)
+
+
+class RotatingLogFileHandler(logging.handlers.BaseRotatingHandler):
+    """
+    Log file handler that rotates the file by size and/or time.
+
+    The log file is renamed to "<logfile>.<date>-<time>-<microseconds>"
+    when it is rotated. Compressing (gzip) the rotated files and removing
+    old ones (retention) are done by a background thread, so the thread
+    that logs only closes, renames and opens the log file.
+
+    Arguments:
+        filename     (str): log file
+        mode         (a/w): file mode. default a
+
+    Keyword arguments (opt):
+        max_bytes       (int): rotate the file when it reaches this size.
+                               default 0 - no size rotation
+        when            (str): rotate the file every "interval"
+                               S (seconds), M (minutes), H (hours),
+                               D (days) or midnight.
+                               default None - no time rotation
+        interval        (int): default 1
+        backup_count    (int): max number of rotated files to keep
+                               default 0 - no limit
+        max_total_bytes (int): max total size of rotated files to keep
+                               default 0 - no limit
+        compress (True/False): gzip rotated files. default False
+        encoding        (str): log file encoding
+        delay    (True/False): open the log file on the first message
+    """
+
+    _WHEN_SECONDS = {"S": 1, "M": 60, "H": 3600, "D": 86400, "midnight": 86400}
+
+    def __init__(
+        self,
+        filename,
+        mode="a",
+        *,
+        max_bytes=0,
+        when=None,
+        interval=1,
+        backup_count=0,
+        max_total_bytes=0,
+        compress=False,
+        encoding=None,
+        delay=False,
+    ):
+        """Initialize handler."""
+        if when is not None and when not in self._WHEN_SECONDS:
+            raise ValueError("Invalid when")
+        super().__init__(filename, mode, encoding=encoding, delay=delay)
+        self.max_bytes = max_bytes
+        self.when = when
+        self.interval = interval
+        self.backup_count = backup_count
+        self.max_total_bytes = max_total_bytes
+        self.compress = compress
+        self.rollover_at = self._next_rollover(time.time())
+        # background thread to compress and remove rotated files
+        self._jobs = queue.Queue()
+        self._worker = None
+
+    def _next_rollover(self, now):
+        """Return time (epoch) of the next time rotation."""
+        if self.when is None:
+            return float("inf")
+        if self.when == "midnight":
+            day = datetime.date.fromtimestamp(now)
+            day += datetime.timedelta(days=self.interval)
+            return time.mktime(day.timetuple())
+        return now + self.interval * self._WHEN_SECONDS[self.when]
+
+    def shouldRollover(self, record):  # noqa: N802
+        """Return True if the log file must be rotated."""
+        if time.time() >= self.rollover_at:
+            return True
+        if self.max_bytes > 0:
+            if self.stream is None:
+                self.stream = self._open()
+            return self.stream.tell() >= self.max_bytes
+        return False
+
+    def doRollover(self):  # noqa: N802
+        """Rotate the log file."""
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        if os.path.exists(self.baseFilename):
+            rotated = "{}.{}".format(
+                self.baseFilename,
+                datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f"),
+            )
+            os.rename(self.baseFilename, rotated)
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._process_rotated,
+                    name="RotatingLogFileHandler",
+                    daemon=True,
+                )
+                self._worker.start()
+            self._jobs.put(rotated)
+
+        self.rollover_at = self._next_rollover(time.time())
+        if not self.delay:
+            self.stream = self._open()
+
+    def _process_rotated(self):
+        """Compress rotated files and apply retention (background thread)."""
+        while True:
+            rotated = self._jobs.get()
+            if rotated is None:
+                break
+            try:
+                if self.compress:
+                    with open(rotated, "rb") as f_in:
+                        with gzip.open(rotated + ".gz.tmp", "wb") as f_out:
+                            shutil.copyfileobj(f_in, f_out)
+                    os.replace(rotated + ".gz.tmp", rotated + ".gz")
+                    os.remove(rotated)
+                self._remove_old_files()
+            except OSError:
+                # same behavior as logging.Handler.handleError
+                if logging.raiseExceptions:
+                    traceback.print_exc()
+
+    def rotated_files(self):
+        """Return rotated files (full path), oldest first."""
+        dirname, basename = os.path.split(self.baseFilename)
+        pattern = re.compile(re.escape(basename) + r"\.\d{8}-\d{6}-\d{6}(\.gz)?$")
+        return sorted(
+            os.path.join(dirname, name)
+            for name in os.listdir(dirname)
+            if pattern.match(name)
+        )
+
+    def _remove_old_files(self):
+        """Remove the oldest rotated files above the retention limits."""
+        files = self.rotated_files()
+        if self.backup_count > 0:
+            while len(files) > self.backup_count:
+                os.remove(files.pop(0))
+        if self.max_total_bytes > 0:
+            sizes = [os.path.getsize(name) for name in files]
+            total = sum(sizes)
+            while files and total > self.max_total_bytes:
+                total -= sizes.pop(0)
+                os.remove(files.pop(0))
+
+    def close(self):
+        """Close the log file and wait for the background thread."""
+        super().close()
+        worker = self._worker
+        if worker is not None:
+            self._worker = None
+            self._jobs.put(None)
+            worker.join()
+
+
+def _add_suppressed_summary(record, suppressed):
+    """Append the number of suppressed messages to the record message."""
+    record.msg = "{} (suppressed {} similar messages)".format(record.msg, suppressed)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limit the number of log messages per second from each call site.
+
+    Each call site (source file and line) has its own token bucket with
+    "burst" tokens, refilled at "rate" tokens per second. A message is
+    discarded when the bucket is empty. The next message that is logged
+    from the call site tells how many messages were discarded.
+
+    Arguments (opt):
+        rate     (float): messages per second. default 10
+
+    Keyword arguments (opt):
+        burst      (int): max number of messages logged at once
+                          default: rate (at least 1)
+        summary (True/False): add "(suppressed N similar messages)" to the
+                              next message logged. default True
+
+    Example:
+        misc.setup_logging(filters=[misc.RateLimitFilter(5, burst=20)])
+    """
+
+    def __init__(self, rate=10, *, burst=None, summary=True):
+        """Initialize filter."""
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst else max(1, rate)
+        self.summary = summary
+        # (pathname, lineno) -> [tokens, last update, suppressed messages]
+        self._buckets = {}
+
+    def filter(self, record):
+        """Return True if record must be logged."""
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now, 0]
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            return False
+
+        bucket[0] = tokens - 1
+        if bucket[2]:
+            if self.summary:
+                _add_suppressed_summary(record, bucket[2])
+            bucket[2] = 0
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Log only 1 of every N messages.
+
+    Messages are counted per logger and log level, and only messages with
+    level up to "max_level" are sampled (higher levels are always logged).
+
+    Arguments (opt):
+        rate         (int): log 1 of every "rate" messages. default 10
+
+    Keyword arguments (opt):
+        max_level    (int): highest log level sampled. default logging.INFO
+        loggers     (list): name of the loggers (and their children) that are
+                            sampled. default None - all loggers
+
+    Example:
+        misc.setup_logging(filters=[misc.SamplingFilter(100, loggers=["app"])])
+    """
+
+    def __init__(self, rate=10, *, max_level=logging.INFO, loggers=None):
+        """Initialize filter."""
+        super().__init__()
+        self.rate = rate
+        self.max_level = max_level
+        self.loggers = tuple(loggers) if loggers else None
+        # (logger name, level) -> counter
+        self._counters = {}
+        # logger name -> True if it is sampled
+        self._sampled = {}
+
+    def _is_sampled(self, name):
+        """Return True if messages from logger "name" are sampled."""
+        sampled = self._sampled.get(name)
+        if sampled is None:
+            sampled = self.loggers is None or any(
+                name == logger or name.startswith(logger + ".")
+                for logger in self.loggers
+            )
+            self._sampled[name] = sampled
+        return sampled
+
+    def filter(self, record):
+        """Return True if record must be logged."""
+        if record.levelno > self.max_level or not self._is_sampled(record.name):
+            return True
+        counter = self._counters.get((record.name, record.levelno))
+        if counter is None:
+            counter = self._counters.setdefault(
+                (record.name, record.levelno), itertools.count()
+            )
+        return next(counter) % self.rate == 0
+
+
+class DuplicateFilter(logging.Filter):
+    """
+    Discard repeated log messages.
+
+    After a message is logged, the same message (logger, level and message
+    format string) is discarded during "interval" seconds. The first message
+    logged after that tells how many messages were discarded.
+
+    Arguments (opt):
+        interval   (float): seconds to discard repeated messages. default 60
+
+    Keyword arguments (opt):
+        summary (True/False): add "(suppressed N similar messages)" to the
+                              next message logged. default True
+        max_entries    (int): max number of different messages tracked.
+                              default 10000
+
+    Example:
+        misc.setup_logging(filters=[misc.DuplicateFilter(30)])
+    """
+
+    def __init__(self, interval=60, *, summary=True, max_entries=10000):
+        """Initialize filter."""
+        super().__init__()
+        self.interval = interval
+        self.summary = summary
+        self.max_entries = max_entries
+        # (name, levelno, msg) -> [end of interval, suppressed messages]
+        self._seen = {}
+
+    def filter(self, record):
+        """Return True if record must be logged."""
+        now = time.monotonic()
+        key = (record.name, record.levelno, record.msg)
+        try:
+            entry = self._seen.get(key)
+        except TypeError:  # msg is not hashable
+            return True
+
+        if entry is not None and now < entry[0]:
+            entry[1] += 1
+            return False
+
+        if entry is None:
+            if len(self._seen) >= self.max_entries:
+                self._purge(now)
+            self._seen[key] = [now + self.interval, 0]
+        else:
+            if entry[1] and self.summary:
+                _add_suppressed_summary(record, entry[1])
+            entry[0] = now + self.interval
+            entry[1] = 0
+        return True
+
+    def _purge(self, now):
+        """Remove expired messages (or all of them, if none expired)."""
+        # filters run without lock: other threads can add (or purge)
+        # messages, so iterate over a copy and ignore missing keys
+        expired = [key for key, entry in list(self._seen.items()) if entry[0] <= now]
+        if expired:
+            for key in expired:
+                self._seen.pop(key, None)
+        else:
+            self._seen.clear()
+
+
+# LogRecord attributes that are not extra fields
+_LOG_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "asctime",
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as JSON objects (one per line).
+
+    The JSON keys are encoded only once, when the formatter is created, and
+    the date is formatted (strftime) at most once per second.
+    Extra fields (logger.info("msg", extra={"user": "x"})) are added to the
+    JSON object. Extra fields values that are callable are called only when
+    the record is formatted, i.e., if the message is not discarded by the
+    log level. Values that are not JSON serializable are converted to str.
+
+    Keyword arguments (opt):
+        fields    (tuple): LogRecord attributes added to the JSON object
+                           default: asctime, module, funcName, levelname
+                           and message
+        datefmt     (str): date format in strftime format
+                           default is %m/%d/%Y %H:%M:%S
+
+    Example:
+    >>> formatter = JsonFormatter(fields=("levelname", "message"))
+    >>> record = logging.makeLogRecord(
+    ...     {"levelname": "INFO", "msg": "user %s", "args": ("x",), "id": 1}
+    ... )
+    >>> formatter.format(record)
+    '{"levelname":"INFO","message":"user x","id":1}'
+    """
+
+    def __init__(
+        self,
+        *,
+        fields=("asctime", "module", "funcName", "levelname", "message"),
+        datefmt=None,
+    ):
+        """Initialize formatter."""
+        super().__init__(datefmt=datefmt if datefmt else "%m/%d/%Y %H:%M:%S")
+        self._encode = json.JSONEncoder(
+            ensure_ascii=False, separators=(",", ":"), default=str
+        ).encode
+        # [(attribute, '"attribute":'), ...]
+        self._fields = [(field, self._encode(field) + ":") for field in fields]
+        self._uses_time = "asctime" in fields
+        # (second, datefmt, formatted time) of the last formatted record
+        self._time_cache = (None, None, None)
+
+    def formatTime(self, record, datefmt=None):  # noqa: N802
+        """Return record creation time, formatted once per second."""
+        second = int(record.created)
+        datefmt = datefmt or self.datefmt
+        cache = self._time_cache
+        if cache[0] != second or cache[1] != datefmt:
+            cache = (second, datefmt, time.strftime(datefmt, self.converter(second)))
+            self._time_cache = cache
+        return cache[2]
+
+    def format(self, record):
+        """Return record as a JSON string."""
+        record.message = record.getMessage()
+        if self._uses_time:
+            record.asctime = self.formatTime(record, self.datefmt)
+
+        encode = self._encode
+        parts = [
+            key + encode(getattr(record, attr, None)) for attr, key in self._fields
+        ]
+
+        for attr, value in vars(record).items():
+            if attr not in _LOG_RECORD_ATTRS:
+                if callable(value):
+                    value = value()
+                parts.append(encode(attr) + ":" + encode(value))
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            parts.append(encode("exc_info") + ":" + encode(record.exc_text))
+        if record.stack_info:
+            parts.append(encode("stack_info") + ":" + encode(record.stack_info))
+
+        return "{" + ",".join(parts) + "}"
+
+
 ##############################################################################
 ##############################################################################
 # Dictionary
@@ -207,6 +1498,156 @@ def nested_dict():  # pragma: no cover
     return collections.defaultdict(nested_dict)
 
 
+class FrozenDict(collections.abc.Mapping):
+    """
+    Compact, hashable and read-only mapping.
+
+    Keys are stored once in an index (key -> position) that is shared by
+    all FrozenDict created by the same freeze() call with the same keys.
+    Each instance only keeps a reference to that index and a tuple with its
+    values, which is much smaller than a dict/defaultdict per node.
+
+    Example:
+    >>> fd = FrozenDict({"a": 1, "b": 2})
+    >>> fd["a"]
+    1
+    >>> fd == {"a": 1, "b": 2}
+    True
+    >>> hash(fd) == hash(FrozenDict(b=2, a=1))
+    True
+    >>> fd["c"] = 3
+    Traceback (most recent call last):
+    ...
+    TypeError: 'FrozenDict' object does not support item assignment
+    """
+
+    __slots__ = ("_index", "_values", "_hash")
+
+    def __init__(self, *args, **kwargs):
+        """Create a FrozenDict with the same arguments accepted by dict()."""
+        data = dict(*args, **kwargs)
+        self._index = {key: pos for pos, key in enumerate(data)}
+        self._values = tuple(data.values())
+        self._hash = None
+
+    @classmethod
+    def _from_index(cls, index, values):
+        """Create a FrozenDict reusing an already built (shared) index."""
+        obj = cls.__new__(cls)
+        obj._index = index
+        obj._values = values
+        obj._hash = None
+        return obj
+
+    def __getitem__(self, key):
+        """Return the value for key."""
+        return self._values[self._index[key]]
+
+    def __iter__(self):
+        """Iterate over keys in insertion order."""
+        return iter(self._index)
+
+    def __len__(self):
+        """Return the number of items."""
+        return len(self._values)
+
+    def __contains__(self, key):
+        """Return True if key is in the mapping."""
+        return key in self._index
+
+    def values(self):
+        """Return a view of the values, like the dict method."""
+        return _FrozenDictValues(self)
+
+    def __eq__(self, other):
+        """Compare with other mapping."""
+        if isinstance(other, FrozenDict) and self._index is other._index:
+            return self._values == other._values
+        return super().__eq__(other)
+
+    def __hash__(self):
+        """Return hash (computed once). Values must be hashable."""
+        if self._hash is None:
+            self._hash = hash(frozenset(zip(self._index, self._values)))
+        return self._hash
+
+    def __repr__(self):
+        """Return FrozenDict representation."""
+        return "FrozenDict({!r})".format(dict(zip(self._index, self._values)))
+
+    def __reduce__(self):
+        """Support pickle/copy."""
+        return (FrozenDict, (dict(zip(self._index, self._values)),))
+
+
+class _FrozenDictValues(collections.abc.ValuesView):
+    """FrozenDict values view, iterating over the values tuple."""
+
+    __slots__ = ()
+
+    def __iter__(self):
+        """Return iterator over the values."""
+        return iter(self._mapping._values)
+
+
+def freeze(obj):
+    """
+    Convert a nested dictionary into an immutable and compact structure.
+
+    Dictionaries (dict, defaultdict, nested_dict(), ...) are converted to
+    FrozenDict, lists and tuples to tuples and sets to frozensets.
+    Other values are kept as is. String keys are interned and nodes that
+    have the same keys (in the same order) share one key index, similar to
+    CPython's key-sharing dictionaries.
+
+    The result is hashable as long as the leaf values are hashable.
+
+    Arguments:
+        obj           (obj): a dictionary (or list) to freeze
+
+    Return:
+        FrozenDict, tuple, frozenset or the obj itself
+
+    Example:
+    >>> mydict = nested_dict()
+    >>> mydict['a1']['b1']['c1'] = 'test_1'
+    >>> mydict['a1']['b2'] = ['test_2']
+    >>> frozen = freeze(mydict)
+    >>> frozen['a1']['b1']['c1']
+    'test_1'
+    >>> frozen['a1']['b2']
+    ('test_2',)
+    >>> frozen['a1']['b3']
+    Traceback (most recent call last):
+    ...
+    KeyError: 'b3'
+    >>> isinstance(hash(frozen), int)
+    True
+    """
+    # Shared key indexes for this freeze call: keys tuple -> {key: position}
+    indexes = {}
+    intern = sys.intern
+
+    def _freeze(value):
+        if isinstance(value, FrozenDict):
+            return value
+        if isinstance(value, collections.abc.Mapping):
+            keys = tuple(intern(k) if type(k) is str else k for k in value)
+            index = indexes.get(keys)
+            if index is None:
+                index = indexes[keys] = {key: pos for pos, key in enumerate(keys)}
+            return FrozenDict._from_index(
+                index, tuple(_freeze(v) for v in value.values())
+            )
+        if isinstance(value, (list, tuple)):
+            return tuple(_freeze(v) for v in value)
+        if isinstance(value, (set, frozenset)):
+            return frozenset(_freeze(v) for v in value)
+        return value
+
+    return _freeze(obj)
+
+
 def find_key(dict_obj, key):
     """
     Return a value for a key in a dictionary.
@@ -323,6 +1764,301 @@ def return_dict_value(dictionary, keys, *, ignore_key_error=False):  # pragma: n
             raise
 
 
+# Marker for missing keys in deep_merge and deep_diff
+_MISSING = object()
+
+DiffItem = collections.namedtuple("DiffItem", ["op", "path", "old", "new"])
+
+
+def deep_merge(*dicts):
+    """
+    Deep merge dictionaries.
+
+    Dictionaries are merged from left to right, i.e., values from the last
+    dictionary have precedence. Nested dictionaries are merged key by key,
+    any other value (list, str, ...) is replaced.
+
+    Only the dictionaries on the path of a changed key are copied.
+    Subtrees that are not changed by the next dictionaries are shared by
+    reference with the input dictionaries (they are not copied) and values
+    that are the same object ("is") are skipped. So, do not change the
+    result in place if the input dictionaries must not be changed
+    (use copy.deepcopy() on the result if needed).
+    It does not use recursion, so it works with deeply nested dictionaries.
+
+    Arguments:
+        *dicts      (dict): dictionaries to merge
+
+    Return:
+        (dict)            : merged dictionary
+
+    Example:
+    >>> defaults = {"log": {"level": "INFO", "file": "app.log"}, "port": 80}
+    >>> site = {"log": {"level": "DEBUG"}}
+    >>> host = {"port": 8080}
+    >>> deep_merge(defaults, site, host)
+    {'log': {'level': 'DEBUG', 'file': 'app.log'}, 'port': 8080}
+    """
+    if not dicts:
+        return {}
+
+    result = dict(dicts[0])
+    # dictionaries created by this merge (id -> dict). They can be changed
+    # in place, the others belong to the input dictionaries.
+    owned = {id(result): result}
+
+    for override in dicts[1:]:
+        stack = [(result, override)]
+        while stack:
+            node, override_node = stack.pop()
+            for key, value in override_node.items():
+                current = node.get(key, _MISSING)
+                if current is value:
+                    continue
+                if isinstance(current, collections.abc.Mapping) and isinstance(
+                    value, collections.abc.Mapping
+                ):
+                    if id(current) not in owned:
+                        current = node[key] = dict(current)
+                        owned[id(current)] = current
+                    stack.append((current, value))
+                else:
+                    node[key] = value
+
+    return result
+
+
+def deep_diff(old, new):
+    """
+    Return the differences between two nested dictionaries.
+
+    It is a generator, so the differences can be processed (streamed) while
+    the dictionaries are compared. Subtrees that are the same object ("is")
+    in both dictionaries are skipped without comparing their content.
+    It does not use recursion, so it works with deeply nested dictionaries.
+
+    Arguments:
+        old         (dict): dictionary
+        new         (dict): dictionary to compare with old
+
+    Return:
+        (generator)       : DiffItem(op, path, old, new) for each difference
+                            op   (str): added, removed or changed
+                            path (tuple): keys to the value
+                            old  (obj): old value (None if added)
+                            new  (obj): new value (None if removed)
+
+    Example:
+    >>> old = {"a": 1, "b": {"c": 2, "d": 3}, "e": 4}
+    >>> new = {"a": 1, "b": {"c": 20}, "f": 5}
+    >>> for item in deep_diff(old, new):
+    ...     print(item)
+    DiffItem(op='removed', path=('e',), old=4, new=None)
+    DiffItem(op='removed', path=('b', 'd'), old=3, new=None)
+    DiffItem(op='changed', path=('b', 'c'), old=2, new=20)
+    DiffItem(op='added', path=('f',), old=None, new=5)
+    """
+    if old is new:
+        return
+
+    stack = [((), old, iter(new.items()))]
+    # removed keys of the first dictionary
+    for key, value in old.items():
+        if key not in new:
+            yield DiffItem("removed", (key,), value, None)
+
+    while stack:
+        path, old_node, items = stack[-1]
+        for key, new_value in items:
+            old_value = old_node.get(key, _MISSING)
+            if old_value is new_value:
+                continue
+            key_path = path + (key,)
+            if old_value is _MISSING:
+                yield DiffItem("added", key_path, None, new_value)
+            elif isinstance(old_value, collections.abc.Mapping) and isinstance(
+                new_value, collections.abc.Mapping
+            ):
+                for old_key, value in old_value.items():
+                    if old_key not in new_value:
+                        yield DiffItem("removed", key_path + (old_key,), value, None)
+                # go deeper, continue with current items when it is done
+                stack.append((key_path, old_value, iter(new_value.items())))
+                break
+            elif old_value != new_value:
+                yield DiffItem("changed", key_path, old_value, new_value)
+        else:
+            stack.pop()
+
+
+def flatten(dict_obj, *, sep="."):
+    """
+    Flatten a nested dictionary into a one level dictionary.
+
+    Nested keys are joined with "sep". Lists and empty dictionaries are
+    kept as values. It walks the dictionary only once and does not use
+    recursion, so it works with deeply nested dictionaries.
+
+    Arguments:
+        dict_obj    (dict): dictionary to flatten
+
+    Keyword arguments (opt):
+        sep          (str): separator used to join keys. default "."
+
+    Return:
+        (dict)            : {"key.nested_key": value, ...}
+
+    Example:
+    >>> flatten({"a": 1, "b": {"c": 2, "d": {"e": 3}}, "f": [1, 2]})
+    {'a': 1, 'b.c': 2, 'b.d.e': 3, 'f': [1, 2]}
+    >>> flatten({"a": {"b": 1}}, sep="/")
+    {'a/b': 1}
+    """
+    result = {}
+    stack = [("", iter(dict_obj.items()))]
+
+    while stack:
+        prefix, items = stack[-1]
+        for key, value in items:
+            full_key = prefix + str(key)
+            if isinstance(value, collections.abc.Mapping) and value:
+                # go deeper, continue with current items when it is done
+                stack.append((full_key + sep, iter(value.items())))
+                break
+            result[full_key] = value
+        else:
+            stack.pop()
+
+    return result
+
+
+def unflatten(flat_dict, *, sep="."):
+    """
+    Convert a flattened dictionary back to a nested dictionary.
+
+    It is the reverse of flatten().
+
+    Arguments:
+        flat_dict   (dict): dictionary with keys joined by "sep"
+
+    Keyword arguments (opt):
+        sep          (str): separator used to split keys. default "."
+
+    Return:
+        (dict)            : nested dictionary
+
+    Example:
+    >>> unflatten({'a': 1, 'b.c': 2, 'b.d.e': 3})
+    {'a': 1, 'b': {'c': 2, 'd': {'e': 3}}}
+    """
+    result = {}
+    # ids of the dictionaries created here (values can be dictionaries too)
+    nodes = {id(result)}
+
+    for flat_key, value in flat_dict.items():
+        *parents, last = flat_key.split(sep)
+        node = result
+        for key in parents:
+            if key not in node:
+                node[key] = {}
+                nodes.add(id(node[key]))
+            child = node[key]
+            if id(child) not in nodes:
+                raise ValueError("Conflicting key: {}".format(flat_key))
+            node = child
+        if last in node:
+            # a value where a nested dictionary was already created
+            raise ValueError("Conflicting key: {}".format(flat_key))
+        node[last] = value
+
+    return result
+
+
+def flatten_columns(records, *, sep=".", column_type="auto"):
+    """
+    Flatten an iterable of nested dictionaries into columns.
+
+    Each record is flattened (see flatten()) and its values are appended to
+    one column per flattened key. The schema (columns) is inferred while
+    reading the records: a key that shows up only in some records gets
+    None for the other ones.
+
+    Arguments:
+        records     (iter): iterable with (nested) dictionaries
+
+    Keyword arguments (opt):
+        sep          (str): separator used to join keys. default "."
+        column_type  (str): auto  - columns with only int or only float
+                                    values are returned as array.array,
+                                    other columns as list (default)
+                            list  - all columns are returned as list
+                            numpy - all columns are returned as numpy
+                                    arrays (requires numpy)
+
+    Return:
+        (dict)            : {"key.nested_key": column, ...}
+
+    Example:
+    >>> records = [{"host": "h1", "cpu": {"user": 1.5, "idle": 90}},
+    ...            {"host": "h2", "cpu": {"user": 2.5, "idle": 80}},
+    ...            {"host": "h3", "cpu": {"user": 0.5}}]
+    >>> columns = flatten_columns(records)
+    >>> columns["host"]
+    ['h1', 'h2', 'h3']
+    >>> columns["cpu.user"]
+    array('d', [1.5, 2.5, 0.5])
+    >>> columns["cpu.idle"]
+    [90, 80, None]
+    >>> flatten_columns(records, column_type="list")["cpu.user"]
+    [1.5, 2.5, 0.5]
+    """
+    if column_type not in ("auto", "list", "numpy"):
+        raise ValueError("Invalid column_type")
+
+    columns = {}
+    num_records = 0
+
+    for record in records:
+        for key, value in flatten(record, sep=sep).items():
+            column = columns.get(key)
+            if column is None:
+                # new key, previous records do not have it
+                column = columns[key] = [None] * num_records
+            column.append(value)
+        num_records += 1
+        # records that do not have all the keys
+        for column in columns.values():
+            if len(column) < num_records:
+                column.append(None)
+
+    if column_type == "numpy":  # pragma: no cover
+        import numpy  # pylint: disable=import-outside-toplevel
+
+        return {key: numpy.asarray(column) for key, column in columns.items()}
+
+    if column_type == "auto":
+        for key, column in columns.items():
+            columns[key] = _column_to_array(column)
+
+    return columns
+
+
+def _column_to_array(column):
+    """Return column as array.array if all values are int or float."""
+    value_types = set(map(type, column))
+    if value_types == {int}:
+        typecode = "q"
+    elif value_types == {float}:
+        typecode = "d"
+    else:
+        return column
+
+    try:
+        return array.array(typecode, column)
+    except OverflowError:
+        return column
+
+
 ##############################################################################
 ##############################################################################
 # Execute command
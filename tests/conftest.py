@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""Shared test fixtures."""
+
+import asyncio
+import contextlib
+import logging
+import socketserver
+import threading
+import pytest
+from pcof import decorators, misc
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server (enough for smtplib)."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply("220 localhost test SMTP")
+        mail = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                if server.disconnect_after and (
+                    len(server.messages) >= server.disconnect_after
+                ):
+                    server.disconnect_after = 0
+                    return
+                mail = {"from": command[10:].strip("<>"), "to": [], "data": []}
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                rcpt = command[8:].strip("<>")
+                if rcpt in server.reject:
+                    self.reply("550 rejected")
+                else:
+                    mail["to"].append(rcpt)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while True:
+                    data = self.rfile.readline().decode()
+                    if data in (".\r\n", ".\n"):
+                        break
+                    mail["data"].append(data)
+                mail["data"] = "".join(mail["data"])
+                with server.lock:
+                    server.messages.append(mail)
+                self.reply("250 OK")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 not implemented")
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+        # close the connection when this number of messages is received
+        self.disconnect_after = 0
+        self.reject = set()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+@pytest.fixture
+def smtp_server():
+    server = SMTPServer()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@contextlib.contextmanager
+def _isolated_root_logger():
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    root.handlers = []
+    try:
+        yield root
+    finally:
+        misc.shutdown_logging()
+        for handler in root.handlers:
+            handler.close()
+        root.handlers = saved_handlers
+        root.setLevel(saved_level)
+
+
+@pytest.fixture
+def isolated_root_logger():
+    """
+    Return a context manager: the root logger has no handlers inside it.
+
+    pytest adds its own handlers to the root logger when the test runs
+    (after the fixtures are set up), so they are removed inside the test.
+    """
+    return _isolated_root_logger
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def run():
+    """Return function that runs a coroutine in a new event loop."""
+    return _run
+
+
+class FakeTime:
+    """time module replacement: the clock advances only when changed."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    perf_counter = time = monotonic
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    """Replace the time module used by pcof.decorators with a FakeTime."""
+    clock = FakeTime()
+    monkeypatch.setattr(decorators, "time", clock)
+    return clock
+
+
+class ListHandler(logging.Handler):
+    """Logging handler that keeps the formatted messages in a list."""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+@pytest.fixture
+def list_handler():
+    """Return a new ListHandler."""
+    return ListHandler()
+
+
+def _make_logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.handlers = [handler]
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+@pytest.fixture
+def make_logger():
+    """Return function that creates a logger using only the given handler."""
+    return _make_logger
+
+
+# vim: ts=4
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""Test decorators with coroutine functions, generators and async generators."""
+
+import asyncio
+import inspect
+import logging
+import pytest
+from pcof import decorators
+
+
+async def collect(agen):
+    return [value async for value in agen]
+
+
+DECORATORS = [
+    decorators.num_calls,
+    decorators.time_elapsed,
+    decorators.debug,
+    decorators.retry_on_exception,
+]
+
+
+@pytest.mark.parametrize("decorator", DECORATORS)
+def test_decorator_keeps_function_kind(decorator):
+    async def coro():
+        pass
+
+    async def agen():
+        yield 1
+
+    def gen():
+        yield 1
+
+    assert inspect.iscoroutinefunction(decorator(coro))
+    assert inspect.isasyncgenfunction(decorator(agen))
+    assert inspect.isgeneratorfunction(decorator(gen))
+    assert decorator(gen).__name__ == "gen"
+
+
+@pytest.mark.parametrize("decorator", DECORATORS)
+def test_decorator_stacked(decorator, run):
+    @decorators.time_elapsed
+    @decorator
+    async def coro(value):
+        await asyncio.sleep(0)
+        return value * 2
+
+    @decorator
+    @decorators.num_calls
+    async def agen(count):
+        for i in range(count):
+            yield i
+
+    @decorators.debug
+    @decorator
+    def gen(count):
+        yield from range(count)
+        return "done"
+
+    assert run(coro(2)) == 4
+    assert run(collect(agen(3))) == [0, 1, 2]
+    assert list(gen(3)) == [0, 1, 2]
+
+
+def test_time_elapsed_coroutine(run):
+    @decorators.time_elapsed
+    async def coro():
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    assert run(coro()) == "ok"
+    assert coro.elapsed >= 0.05
+    assert coro.latency.count() == 1
+
+
+def test_time_elapsed_async_generator(run):
+    @decorators.time_elapsed
+    async def agen():
+        for i in range(2):
+            await asyncio.sleep(0.03)
+            yield i
+
+    assert run(collect(agen())) == [0, 1]
+    assert agen.elapsed >= 0.06
+    assert agen.latency.count() == 1
+
+
+def test_time_elapsed_generator_not_consumed():
+    @decorators.time_elapsed
+    def gen():
+        yield 1
+
+    generator = gen()
+    assert gen.latency.count() == 0
+    assert list(generator) == [1]
+    assert gen.latency.count() == 1
+
+
+def test_num_calls_coroutine(run):
+    @decorators.num_calls
+    async def coro():
+        return 1
+
+    coroutine = coro()
+    assert coro.numcalls == 0
+    run(coroutine)
+    assert coro.numcalls == 1
+
+
+def test_debug_generator_return(caplog):
+    caplog.set_level(logging.DEBUG)
+
+    @decorators.debug
+    def gen():
+        yield 1
+        return "result"
+
+    assert list(gen()) == [1]
+    assert "function: gen returns: result" in caplog.text
+
+
+def test_debug_coroutine_return(caplog, run):
+    caplog.set_level(logging.DEBUG)
+
+    @decorators.debug
+    async def coro(value):
+        return value
+
+    assert run(coro("coro result")) == "coro result"
+    assert "function: coro returns: coro result" in caplog.text
+
+
+def test_generator_send_throw():
+    def gen():
+        received = []
+        try:
+            while True:
+                received.append((yield len(received)))
+        except KeyError:
+            yield received
+
+    for decorator in DECORATORS:
+        generator = decorator(gen)()
+        assert next(generator) == 0
+        assert generator.send("a") == 1
+        assert generator.send("b") == 2
+        assert generator.throw(KeyError) == ["a", "b"]
+        generator.close()
+
+
+def test_async_generator_asend_athrow(run):
+    async def agen():
+        received = []
+        try:
+            while True:
+                received.append((yield len(received)))
+        except KeyError:
+            yield received
+
+    async def check(generator):
+        assert await generator.__anext__() == 0
+        assert await generator.asend("a") == 1
+        assert await generator.athrow(KeyError) == ["a"]
+        await generator.aclose()
+
+    for decorator in DECORATORS:
+        run(check(decorator(agen)()))
+
+
+def test_retry_coroutine_uses_asyncio_sleep(monkeypatch, run):
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+
+    def blocking_sleep(seconds):
+        raise AssertionError("time.sleep called")
+
+    monkeypatch.setattr(decorators.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(decorators.time, "sleep", blocking_sleep)
+    calls = []
+
+    @decorators.retry_on_exception(max_retry=3, sleep_retry=2)
+    async def coro():
+        calls.append(1)
+        if len(calls) < 3:
+            raise TimeoutError
+        return "ok"
+
+    assert run(coro()) == "ok"
+    assert len(calls) == 3
+    assert sleeps == [2, 2]
+
+
+def test_retry_coroutine_max_retry(run):
+    @decorators.retry_on_exception(max_retry=2, sleep_retry=0)
+    async def coro():
+        raise TimeoutError
+
+    with pytest.raises(TimeoutError):
+        run(coro())
+
+
+def test_retry_generator():
+    calls = []
+
+    @decorators.retry_on_exception(max_retry=3, sleep_retry=0)
+    def gen():
+        calls.append(1)
+        if len(calls) < 2:
+            raise TimeoutError
+        yield 1
+        raise KeyError
+
+    generator = gen()
+    assert next(generator) == 1
+    # exceptions after the first value are not retried
+    with pytest.raises(KeyError):
+        next(generator)
+    assert len(calls) == 2
+
+
+def test_retry_generator_empty():
+    @decorators.retry_on_exception(sleep_retry=0)
+    def gen():
+        return "empty"
+        yield
+
+    generator = gen()
+    with pytest.raises(StopIteration) as stop:
+        next(generator)
+    assert stop.value.value == "empty"
+
+
+def test_retry_async_generator(run):
+    calls = []
+
+    @decorators.retry_on_exception(max_retry=3, sleep_retry=0)
+    async def agen():
+        calls.append(1)
+        if len(calls) < 3:
+            raise TimeoutError
+        yield 1
+        yield 2
+
+    @decorators.retry_on_exception(sleep_retry=0)
+    async def empty():
+        return
+        yield
+
+    assert run(collect(agen())) == [1, 2]
+    assert len(calls) == 3
+    assert run(collect(empty())) == []
+
+
+# vim: ts=4
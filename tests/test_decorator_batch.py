@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Test batch decorator."""
+
+import asyncio
+import threading
+import pytest
+from pcof import decorators
+
+
+def run_threads(target, args_list):
+    results = [None] * len(args_list)
+
+    def call(index, args):
+        try:
+            results[index] = target(*args)
+        except Exception as error:
+            results[index] = error
+
+    threads = [
+        threading.Thread(target=call, args=(index, args))
+        for index, args in enumerate(args_list)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batch_threads_window():
+    batches = []
+
+    @decorators.batch(window=0.2)
+    def double(keys):
+        batches.append(keys)
+        return [key * 2 for key in keys]
+
+    results = run_threads(double, [(i % 10,) for i in range(30)])
+    assert results == [(i % 10) * 2 for i in range(30)]
+    # equal keys are sent once
+    assert len(batches) == 1
+    assert sorted(batches[0]) == list(range(10))
+    assert double.batches == 1
+    assert double.batched_keys == 10
+
+
+def test_batch_threads_max_batch_size():
+    batches = []
+
+    @decorators.batch(max_batch_size=5, window=5)
+    def double(keys):
+        batches.append(len(keys))
+        return [key * 2 for key in keys]
+
+    results = run_threads(double, [(i,) for i in range(20)])
+    assert results == [i * 2 for i in range(20)]
+    # all batches full: nobody waited the 5 seconds window
+    assert batches == [5, 5, 5, 5]
+
+
+def test_batch_single_call():
+    @decorators.batch
+    def upper(keys):
+        return {key: key.upper() for key in keys}
+
+    assert upper("a") == "A"
+    assert upper.batches == 1
+
+
+def test_batch_dict_missing_key():
+    @decorators.batch(window=0.1)
+    def lookup(keys):
+        return {key: key for key in keys if key != "missing"}
+
+    results = run_threads(lookup, [("a",), ("missing",)])
+    assert results[0] == "a"
+    assert isinstance(results[1], KeyError)
+
+
+def test_batch_exception():
+    @decorators.batch(window=0.1)
+    def fail(keys):
+        raise ConnectionError("backend down")
+
+    results = run_threads(fail, [(1,), (2,), (3,)])
+    assert all(isinstance(result, ConnectionError) for result in results)
+
+
+def test_batch_wrong_number_of_results():
+    @decorators.batch
+    def wrong(keys):
+        return []
+
+    with pytest.raises(ValueError, match="returned 0 results for 1 keys"):
+        wrong(1)
+
+
+def test_batch_async(run):
+    batches = []
+
+    @decorators.batch(window=0.01, max_batch_size=4)
+    async def double(keys):
+        batches.append(keys)
+        await asyncio.sleep(0)
+        return [key * 2 for key in keys]
+
+    async def main():
+        return await asyncio.gather(*[double(i % 6) for i in range(10)])
+
+    assert run(main()) == [(i % 6) * 2 for i in range(10)]
+    # keys 0-3 are sent again after the first batch was dispatched
+    assert batches == [[0, 1, 2, 3], [4, 5, 0, 1], [2, 3]]
+    assert double.batches == 3
+    assert double.batched_keys == 10
+
+
+def test_batch_async_exception(run):
+    @decorators.batch
+    async def fail(keys):
+        return {}
+
+    @decorators.batch
+    async def fail_all(keys):
+        raise ConnectionError
+
+    async def main():
+        return await asyncio.gather(
+            fail("a"), fail_all("a"), fail_all("b"), return_exceptions=True
+        )
+
+    results = run(main())
+    assert isinstance(results[0], KeyError)
+    assert isinstance(results[1], ConnectionError)
+    assert isinstance(results[2], ConnectionError)
+
+
+def test_batch_async_cancelled(run):
+    # asyncio.current_task is new in Python 3.7
+    current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+    batch_tasks = []
+
+    @decorators.batch(window=0)
+    async def slow(keys):
+        batch_tasks.append(current_task())
+        await asyncio.sleep(10)
+
+    async def main():
+        caller = asyncio.ensure_future(slow("a"))
+        while not batch_tasks:
+            await asyncio.sleep(0.001)
+        assert batch_tasks[0] is not caller
+        batch_tasks[0].cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+
+    run(main())
+
+
+def test_batch_async_full_after_timer(run):
+    @decorators.batch(window=0.01, max_batch_size=2)
+    async def identity(keys):
+        return keys
+
+    async def main():
+        first = asyncio.ensure_future(identity(1))
+        await asyncio.sleep(0.05)
+        # the timer of the first batch already fired
+        return await first, await identity(2)
+
+    assert run(main()) == (1, 2)
+
+
+# vim: ts=4
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Test Bulkhead class and bulkhead decorator."""
+
+import asyncio
+import signal
+import threading
+import time
+import pytest
+from pcof import decorators
+
+
+def wait_until(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.001)
+
+
+def test_bulkhead_reject_when_full():
+    release = threading.Event()
+
+    @decorators.bulkhead(max_concurrent=2)
+    def func():
+        release.wait()
+
+    threads = [threading.Thread(target=func) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: func.bulkhead.stats()["in_flight"] == 2)
+    with pytest.raises(decorators.BulkheadFull, match="bulkhead 'func' is full"):
+        func()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert func.bulkhead.stats() == {"in_flight": 0, "queued": 0, "rejected": 1}
+
+
+def test_bulkhead_queue_fifo():
+    release = threading.Event()
+    order = []
+
+    @decorators.bulkhead(max_concurrent=1, max_queue=3)
+    def func(value):
+        order.append(value)
+        release.wait()
+
+    first = threading.Thread(target=func, args=(0,))
+    first.start()
+    wait_until(lambda: func.bulkhead.stats()["in_flight"] == 1)
+    threads = []
+    for value in range(1, 4):
+        thread = threading.Thread(target=func, args=(value,))
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: func.bulkhead.stats()["queued"] == value)
+    with pytest.raises(decorators.BulkheadFull):
+        func(4)
+    release.set()
+    for thread in [first] + threads:
+        thread.join()
+    assert order == [0, 1, 2, 3]
+    assert func.bulkhead.stats() == {"in_flight": 0, "queued": 0, "rejected": 1}
+
+
+def test_bulkhead_timeout():
+    bulkhead = decorators.Bulkhead(1, max_queue=1, timeout=0.05, name="db")
+    bulkhead.acquire()
+    with pytest.raises(decorators.BulkheadFull, match="bulkhead 'db' timeout"):
+        bulkhead.acquire()
+    assert bulkhead.stats() == {"in_flight": 1, "queued": 0, "rejected": 1}
+    bulkhead.release()
+
+
+def test_bulkhead_timeout_race():
+    bulkhead = decorators.Bulkhead(1, max_queue=1, timeout=0.05)
+    # slot given to the waiter just after its timeout expired
+    assert not bulkhead._give_up(object())
+
+
+def test_bulkhead_max_concurrent_threads():
+    lock = threading.Lock()
+    running = [0, 0]
+
+    @decorators.bulkhead(max_concurrent=3, max_queue=100)
+    def func():
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.001)
+        with lock:
+            running[0] -= 1
+
+    def call():
+        for _ in range(10):
+            func()
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert running[1] == 3
+    assert func.bulkhead.stats() == {"in_flight": 0, "queued": 0, "rejected": 0}
+
+
+def test_bulkhead_releases_on_exception():
+    @decorators.bulkhead(max_concurrent=1)
+    def func():
+        raise KeyError
+
+    for _ in range(3):
+        with pytest.raises(KeyError):
+            func()
+    assert func.bulkhead.stats()["in_flight"] == 0
+
+
+def test_bulkhead_generator_keeps_slot():
+    @decorators.bulkhead(max_concurrent=1)
+    def gen():
+        yield 1
+        yield 2
+
+    generator = gen()
+    assert next(generator) == 1
+    assert gen.bulkhead.stats()["in_flight"] == 1
+    generator.close()
+    assert gen.bulkhead.stats()["in_flight"] == 0
+    assert list(gen()) == [1, 2]
+    assert gen.bulkhead.stats()["in_flight"] == 0
+
+
+def test_bulkhead_async(run):
+    running = [0, 0]
+
+    @decorators.bulkhead(max_concurrent=2, max_queue=10)
+    async def coro(value):
+        running[0] += 1
+        running[1] = max(running)
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        return value
+
+    async def main():
+        return await asyncio.gather(*[coro(i) for i in range(6)])
+
+    assert run(main()) == list(range(6))
+    assert running[1] == 2
+    assert coro.bulkhead.stats() == {"in_flight": 0, "queued": 0, "rejected": 0}
+
+
+def test_bulkhead_async_reject_and_timeout(run):
+    limiter = decorators.Bulkhead(1, max_queue=1, timeout=0.02)
+
+    @decorators.bulkhead(limiter=limiter)
+    async def coro():
+        await asyncio.sleep(0.1)
+
+    async def main():
+        return await asyncio.gather(coro(), coro(), coro(), return_exceptions=True)
+
+    results = run(main())
+    assert results[0] is None
+    # queue full and timeout in the queue
+    assert all(isinstance(r, decorators.BulkheadFull) for r in results[1:])
+    assert limiter.stats() == {"in_flight": 0, "queued": 0, "rejected": 2}
+
+
+def test_bulkhead_async_cancelled(run):
+    limiter = decorators.Bulkhead(1, max_queue=2)
+
+    async def main():
+        await limiter.acquire_async()
+        waiter = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0)
+        assert limiter.stats()["queued"] == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.stats()["queued"] == 0
+
+        # cancelled after the slot was given to it: slot goes to the next
+        waiter1 = asyncio.ensure_future(limiter.acquire_async())
+        waiter2 = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0)
+        limiter.release()
+        waiter1.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter1
+        await waiter2
+        assert limiter.stats()["in_flight"] == 1
+
+    run(main())
+
+
+@pytest.mark.parametrize("slot_given", [False, True])
+def test_bulkhead_acquire_interrupted(slot_given):
+    limiter = decorators.Bulkhead(1, max_queue=1)
+    limiter.acquire()
+
+    def interrupt(signum, frame):
+        if slot_given:
+            limiter.release()
+        raise KeyboardInterrupt
+
+    previous_handler = signal.signal(signal.SIGALRM, interrupt)
+    signal.setitimer(signal.ITIMER_REAL, 0.05)
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            limiter.acquire()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+    assert limiter.stats()["queued"] == 0
+    assert limiter.stats()["in_flight"] == (0 if slot_given else 1)
+
+
+def test_bulkhead_shared_by_threads_and_asyncio(run):
+    limiter = decorators.Bulkhead(1, max_queue=5)
+    limiter.acquire()
+
+    async def main():
+        await limiter.acquire_async()
+        return "async got slot"
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(run(main())))
+    thread.start()
+    wait_until(lambda: limiter.stats()["queued"] == 1)
+    limiter.release()
+    thread.join()
+    assert result == ["async got slot"]
+    assert limiter.stats()["in_flight"] == 1
+
+
+def test_bulkhead_no_options():
+    @decorators.bulkhead
+    def func():
+        return 1
+
+    assert func() == 1
+    assert func.bulkhead.max_concurrent == 10
+
+
+# vim: ts=4
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""Test Cache class and cache decorator."""
+
+import asyncio
+import threading
+import pytest
+from pcof import decorators
+
+
+def test_cache_invalid_policy():
+    with pytest.raises(ValueError, match="Invalid policy"):
+        decorators.Cache(policy="fifo")
+
+
+def test_cache_lru_eviction():
+    cache = decorators.Cache(maxsize=3, shards=1)
+    for key in "abc":
+        cache.set(key, key.upper())
+    assert cache.get("a") == "A"
+    cache.set("d", "D")
+    # "b" is the least recently used
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["A", "C", "D"]
+    assert cache.stats()["evictions"] == 1
+    assert len(cache) == 3
+
+
+def test_cache_lfu_eviction():
+    cache = decorators.Cache(maxsize=3, shards=1, policy="lfu")
+    for key in "abc":
+        cache.set(key, key)
+    for key in "aabbbc":
+        cache.get(key)
+    cache.set("d", "d")
+    # "c" used once, "d" is new
+    assert cache.get("c") is None
+    cache.set("e", "e")
+    assert cache.get("d") is None
+    assert [cache.get(key) for key in "abe"] == ["a", "b", "e"]
+
+
+def test_cache_lfu_remove_min_bucket():
+    cache = decorators.Cache(
+        maxsize=None, max_bytes=10, shards=1, policy="lfu", sizeof=len
+    )
+    for key in "abc":
+        cache.set(key, "xxx")
+    for key in "ccbb":
+        cache.get(key)
+    # "a" (1 use) removed: there is no key with 1 or 2 uses
+    cache.delete("a")
+    cache.set("d", "x" * 7)
+    # "c" and "b" have 3 uses, "c" is the least recently used
+    assert cache.get("c") is None
+    assert cache.get("b") == "xxx"
+    assert cache.get("d") == "x" * 7
+
+
+def test_cache_set_existing_key():
+    for policy in ("lru", "lfu"):
+        cache = decorators.Cache(maxsize=2, shards=1, policy=policy)
+        cache.set("a", 1)
+        cache.set("a", 2)
+        assert cache.get("a") == 2
+        assert len(cache) == 1
+
+
+def test_cache_ttl(fake_time):
+    cache = decorators.Cache(ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=100)
+    fake_time.now += 10
+    assert cache.get("a", "expired") == "expired"
+    assert cache.get("b") == 2
+    assert cache.stats()["expired"] == 1
+    assert len(cache) == 1
+
+
+def test_cache_max_bytes():
+    cache = decorators.Cache(max_bytes=1000, shards=1, sizeof=len)
+    cache.set("a", "x" * 400)
+    cache.set("b", "x" * 400)
+    cache.set("c", "x" * 400)
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 800
+    # bigger than the cache is not stored
+    cache.set("d", "x" * 1001)
+    assert cache.get("d") is None
+    assert cache.stats()["entries"] == 2
+
+
+def test_cache_max_bytes_whole_cache():
+    cache = decorators.Cache(max_bytes=1000000)
+    cache.set("big", "x" * 100000)
+    assert cache.get("big") == "x" * 100000
+    assert cache.stats()["entries"] == 1
+
+    cache = decorators.Cache(maxsize=None, max_bytes=1000, sizeof=len)
+    for key in range(20):
+        cache.set(key, "x" * 100)
+    stats = cache.stats()
+    assert stats["bytes"] == 1000
+    assert stats["entries"] == 10
+    assert stats["evictions"] == 10
+    # the new entry is kept, even when its shard has nothing to evict
+    cache.set("last", "x" * 1000)
+    assert cache.get("last") == "x" * 1000
+    assert cache.stats()["entries"] == 1
+
+
+def test_cache_maxsize_zero():
+    for policy in ("lru", "lfu"):
+        cache = decorators.Cache(maxsize=0, policy=policy)
+        cache.set("a", 1)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+        assert cache._shards[0].evict() is False
+
+    calls = []
+
+    @decorators.cache(maxsize=0)
+    def func(value):
+        calls.append(value)
+        return value
+
+    assert func(1) == 1
+    assert func(1) == 1
+    assert calls == [1, 1]
+
+
+def test_cache_sizeof_estimate():
+    class Obj:
+        def __init__(self):
+            self.data = [1] * 1000
+
+    value = {"key": ["x" * 1000, ("y" * 1000,)], "set": {1, 2}}
+    value["self"] = value
+    assert decorators._sizeof(value) > 2000
+    assert decorators._sizeof(Obj()) > 8000
+
+
+def test_cache_no_maxsize():
+    cache = decorators.Cache(maxsize=None)
+    for i in range(5000):
+        cache.set(i, i)
+    assert len(cache) == 5000
+    assert len(cache._shards) == 16
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_cache_maxsize_divided_among_shards():
+    cache = decorators.Cache(maxsize=100, shards=16)
+    assert sum(shard.maxsize for shard in cache._shards) == 100
+    assert len(decorators.Cache(maxsize=3)._shards) == 3
+
+
+def test_cache_decorator():
+    calls = []
+
+    @decorators.cache
+    def func(a, b=1):
+        calls.append((a, b))
+        return a + b
+
+    assert func(1) == 2
+    assert func(1) == 2
+    assert func(1, b=2) == 3
+    assert func(1, b=2) == 3
+    assert calls == [(1, 1), (1, 2)]
+    assert func.cache.stats()["hits"] == 2
+    assert func.cache.stats()["misses"] == 2
+    func.cache.clear()
+    func(1)
+    assert len(calls) == 3
+
+
+def test_cache_decorator_kwargs_key():
+    @decorators.cache
+    def func(*args, **kwargs):
+        return (args, kwargs)
+
+    assert func((), (("x", 1),)) == (((), (("x", 1),)), {})
+    assert func(x=1) == ((), {"x": 1})
+
+
+def test_cache_decorator_key_args():
+    calls = []
+
+    @decorators.cache(key_args=["sql", "limit"])
+    def query(conn, sql, limit=10):
+        calls.append(conn)
+        return "{} {}".format(sql, limit)
+
+    assert query("conn1", "select") == "select 10"
+    assert query("conn2", sql="select", limit=10) == "select 10"
+    assert query("conn2", "select", 5) == "select 5"
+    assert calls == ["conn1", "conn2"]
+
+
+def test_cache_decorator_exception_not_cached():
+    calls = []
+
+    @decorators.cache
+    def func():
+        calls.append(1)
+        raise KeyError
+
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            func()
+    assert len(calls) == 2
+
+
+def test_cache_decorator_unhashable():
+    @decorators.cache
+    def func(value):
+        return value
+
+    with pytest.raises(TypeError):
+        func([1])
+
+
+def test_cache_decorator_generator():
+    def gen():
+        yield 1
+
+    with pytest.raises(TypeError, match="does not support generators"):
+        decorators.cache(gen)
+
+
+def test_cache_decorator_async():
+    calls = []
+
+    @decorators.cache(ttl=60)
+    async def coro(value):
+        calls.append(value)
+        await asyncio.sleep(0)
+        return value * 2
+
+    async def main():
+        return [await coro(1), await coro(1), await coro(2)]
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(main()) == [2, 2, 4]
+    finally:
+        loop.close()
+    assert calls == [1, 2]
+
+
+def test_cache_decorator_threads():
+    @decorators.cache(maxsize=100, policy="lfu")
+    def func(value):
+        return value * 2
+
+    errors = []
+
+    def call():
+        try:
+            for i in range(2000):
+                assert func(i % 150) == (i % 150) * 2
+        except AssertionError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    stats = func.cache.stats()
+    assert stats["hits"] + stats["misses"] == 16000
+    assert stats["entries"] <= 100
+
+
+# vim: ts=4
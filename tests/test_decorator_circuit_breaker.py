@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""Test CircuitBreaker class and circuit_breaker decorator."""
+
+import asyncio
+import logging
+import threading
+import pytest
+from pcof import decorators
+
+
+def make_func(**kwargs):
+    @decorators.circuit_breaker(**kwargs)
+    def func(fail=False):
+        if fail:
+            raise ConnectionError("down")
+        return "ok"
+
+    return func
+
+
+def test_circuit_breaker_opens_on_failure_rate(fake_time, caplog):
+    func = make_func(min_calls=4, window_size=4, failure_rate=0.5)
+    breaker = func.circuit_breaker
+    assert breaker.name == "func"
+
+    assert func() == "ok"
+    assert func() == "ok"
+    with pytest.raises(ConnectionError):
+        func(fail=True)
+    assert breaker.state == "closed"
+    with pytest.raises(ConnectionError):
+        func(fail=True)
+    # 2 failures in 4 calls
+    assert breaker.state == "open"
+    assert "func state changed from closed to open" in caplog.text
+
+    with pytest.raises(decorators.CircuitOpenError) as error:
+        func()
+    assert error.value.retry_after == 30
+    assert "circuit breaker 'func' is open" in str(error.value)
+    assert breaker.stats() == {
+        "calls": 4,
+        "failures": 2,
+        "rejected": 1,
+        "opened": 1,
+        "failure_rate": 0.5,
+        "state": "open",
+    }
+
+
+def test_circuit_breaker_min_calls(fake_time):
+    func = make_func(min_calls=3, window_size=10, failure_rate=0.5)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            func(fail=True)
+    assert func.circuit_breaker.state == "closed"
+    with pytest.raises(ConnectionError):
+        func(fail=True)
+    assert func.circuit_breaker.state == "open"
+
+
+def test_circuit_breaker_sliding_window(fake_time):
+    func = make_func(min_calls=4, window_size=4, failure_rate=0.75)
+    for fail in (True, True, False, False, False, True, True):
+        try:
+            func(fail=fail)
+        except ConnectionError:
+            pass
+    # window: False, False, True, True
+    assert func.circuit_breaker.stats()["failure_rate"] == 0.5
+    assert func.circuit_breaker.state == "closed"
+
+
+def test_circuit_breaker_half_open_success(fake_time):
+    func = make_func(min_calls=1, reset_timeout=10)
+    with pytest.raises(ConnectionError):
+        func(fail=True)
+    fake_time.sleep(5)
+    with pytest.raises(decorators.CircuitOpenError) as error:
+        func()
+    assert error.value.retry_after == 5
+    fake_time.sleep(5)
+    assert func.circuit_breaker.state == "half_open"
+    assert func() == "ok"
+    assert func.circuit_breaker.state == "closed"
+    assert func.circuit_breaker.stats()["failure_rate"] == 0.0
+
+
+def test_circuit_breaker_half_open_failure(fake_time):
+    func = make_func(min_calls=1, reset_timeout=10)
+    with pytest.raises(ConnectionError):
+        func(fail=True)
+    fake_time.sleep(10)
+    with pytest.raises(ConnectionError):
+        func(fail=True)
+    assert func.circuit_breaker.state == "open"
+    assert func.circuit_breaker.stats()["opened"] == 2
+
+
+def test_circuit_breaker_half_open_probe_limit(fake_time):
+    breaker = decorators.CircuitBreaker(min_calls=1, reset_timeout=1, half_open_calls=2)
+    breaker.after_call(breaker.before_call(), ConnectionError())
+    fake_time.sleep(1)
+    probe1 = breaker.before_call()
+    probe2 = breaker.before_call()
+    assert probe1 == probe2 == "half_open"
+    with pytest.raises(decorators.CircuitOpenError):
+        breaker.before_call()
+    breaker.after_call(probe1)
+    assert breaker.state == "half_open"
+    breaker.after_call(probe2)
+    assert breaker.state == "closed"
+    # probe finished after the circuit changed state is ignored
+    breaker.after_call("half_open", ConnectionError())
+    assert breaker.state == "closed"
+
+
+def test_circuit_breaker_excluded_exception(fake_time):
+    @decorators.circuit_breaker(min_calls=1, exception=(ConnectionError,))
+    def func():
+        raise KeyError
+
+    for _ in range(3):
+        with pytest.raises(KeyError):
+            func()
+    assert func.circuit_breaker.state == "closed"
+    assert func.circuit_breaker.stats()["failures"] == 0
+
+
+def test_circuit_breaker_shared(fake_time):
+    breaker = decorators.CircuitBreaker(name="service", min_calls=2)
+
+    @decorators.circuit_breaker(breaker=breaker)
+    def func1():
+        raise ConnectionError
+
+    @decorators.circuit_breaker(breaker=breaker)
+    def func2():
+        return "ok"
+
+    for func in (func1, func1):
+        with pytest.raises(ConnectionError):
+            func()
+    with pytest.raises(decorators.CircuitOpenError):
+        func2()
+    assert func2.circuit_breaker is breaker
+    breaker.reset()
+    assert func2() == "ok"
+    assert breaker.stats()["calls"] == 1
+
+
+def test_circuit_breaker_decorator_options_per_function():
+    decorator = decorators.circuit_breaker(min_calls=5)
+
+    @decorator
+    def func1():
+        pass
+
+    @decorator
+    def func2():
+        pass
+
+    assert func1.circuit_breaker.name == "func1"
+    assert func2.circuit_breaker.name == "func2"
+    assert decorators.circuit_breaker(func1).circuit_breaker.min_calls == 10
+
+
+def test_circuit_breaker_with_retry(fake_time, caplog):
+    caplog.set_level(logging.DEBUG)
+    calls = []
+
+    @decorators.retry_on_exception(max_retry=10)
+    @decorators.circuit_breaker(min_calls=3, window_size=3)
+    def func():
+        calls.append(1)
+        raise ConnectionError
+
+    with pytest.raises(decorators.CircuitOpenError):
+        func()
+    # retries stop as soon as the circuit opens
+    assert len(calls) == 3
+    assert func.retry_stats.snapshot()["attempts"] == 4
+
+
+def test_circuit_breaker_async(fake_time):
+    @decorators.circuit_breaker(min_calls=1)
+    async def coro(fail):
+        await asyncio.sleep(0)
+        if fail:
+            raise ConnectionError
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(coro(False))
+        with pytest.raises(ConnectionError):
+            loop.run_until_complete(coro(True))
+        with pytest.raises(decorators.CircuitOpenError):
+            loop.run_until_complete(coro(False))
+    finally:
+        loop.close()
+    assert coro.circuit_breaker.stats()["calls"] == 2
+
+
+def test_circuit_breaker_generators(fake_time):
+    @decorators.circuit_breaker(min_calls=1)
+    def gen():
+        yield 1
+        raise ConnectionError
+
+    @decorators.circuit_breaker(min_calls=1)
+    async def agen():
+        yield 1
+        raise ConnectionError
+
+    async def consume():
+        return [value async for value in agen()]
+
+    generator = gen()
+    assert next(generator) == 1
+    assert gen.circuit_breaker.state == "closed"
+    with pytest.raises(ConnectionError):
+        next(generator)
+    assert gen.circuit_breaker.state == "open"
+
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises(ConnectionError):
+            loop.run_until_complete(consume())
+    finally:
+        loop.close()
+    assert agen.circuit_breaker.state == "open"
+
+
+def test_circuit_breaker_interrupted_not_recorded(fake_time):
+    @decorators.circuit_breaker(min_calls=1, exception=(BaseException,))
+    def func():
+        raise KeyboardInterrupt
+
+    @decorators.circuit_breaker(breaker=func.circuit_breaker)
+    def gen():
+        yield 1
+        yield 2
+
+    with pytest.raises(KeyboardInterrupt):
+        func()
+    generator = gen()
+    assert next(generator) == 1
+    generator.close()
+    stats = func.circuit_breaker.stats()
+    assert stats["state"] == "closed"
+    assert stats["calls"] == 2
+    assert stats["failures"] == 0
+    assert not func.circuit_breaker._window
+
+
+def test_circuit_breaker_cancelled_probe(fake_time, run):
+    @decorators.circuit_breaker(min_calls=1, reset_timeout=5)
+    async def coro(fail=False, seconds=0):
+        await asyncio.sleep(seconds)
+        if fail:
+            raise ConnectionError
+        return "ok"
+
+    async def main():
+        with pytest.raises(ConnectionError):
+            await coro(fail=True)
+        fake_time.sleep(5)
+        probe = asyncio.ensure_future(coro(seconds=10))
+        await asyncio.sleep(0)
+        with pytest.raises(decorators.CircuitOpenError):
+            await coro()
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        # the cancelled probe released its slot
+        assert coro.circuit_breaker.state == "half_open"
+        return await coro()
+
+    assert run(main()) == "ok"
+    assert coro.circuit_breaker.state == "closed"
+
+
+def test_circuit_breaker_threads():
+    breaker = decorators.CircuitBreaker(min_calls=1000, window_size=1000)
+
+    @decorators.circuit_breaker(breaker=breaker)
+    def func():
+        pass
+
+    def call():
+        for _ in range(1000):
+            func()
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert breaker.stats()["calls"] == 8000
+    assert len(breaker._window) == 1000
+
+
+# vim: ts=4
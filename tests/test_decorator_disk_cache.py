@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""Test DiskCache class and disk_cache decorator."""
+
+import asyncio
+import datetime
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import pytest
+from pcof import decorators
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "cache" / "test.sqlite")
+
+
+def test_stable_hash_types():
+    values = [
+        None,
+        True,
+        1,
+        1.0,
+        "1",
+        b"1",
+        (1,),
+        [1],
+        {1: 2},
+        {1},
+        frozenset([1]),
+        datetime.date(2020, 1, 1),
+    ]
+    hashes = [decorators._stable_hash(value) for value in values]
+    assert len(set(hashes)) == len(values)
+    assert decorators._stable_hash({"a": [1, {"b"}]}) == decorators._stable_hash(
+        {"a": [1, {"b"}]}
+    )
+
+
+def test_stable_hash_across_processes():
+    code = (
+        "from pcof import decorators;"
+        "print(decorators._stable_hash(({'a', 'b', 'c'}, {'x': 'y', 'z': 1})))"
+    )
+    results = set()
+    for seed in ("1", "2", "3"):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        output = subprocess.check_output([sys.executable, "-c", code], env=env)
+        results.add(output)
+    assert len(results) == 1
+
+
+def test_disk_cache_get_set(db_path):
+    cache = decorators.DiskCache(db_path)
+    assert cache.get("key", "missing") == "missing"
+    cache.set("key", {"value": [1, 2]})
+    assert cache.get("key") == {"value": [1, 2]}
+    cache.set("key", "new")
+    assert cache.get("key") == "new"
+    assert len(cache) == 1
+    cache.delete("key")
+    assert cache.lookup("key") == (False, None)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 2, 0)
+
+
+def test_disk_cache_persistent(db_path):
+    cache = decorators.DiskCache(db_path)
+    cache.set("key", "value")
+    cache.close()
+    cache.close()
+    assert decorators.DiskCache(db_path).get("key") == "value"
+    # connection is reopened after fork (new pid)
+    cache._local.pid = -1
+    assert cache.get("key") == "value"
+
+
+def test_disk_cache_ttl(db_path, fake_time):
+    cache = decorators.DiskCache(db_path, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=100)
+    fake_time.now += 10
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert len(cache) == 1
+    fake_time.now += 100
+    cache.purge()
+    assert len(cache) == 0
+
+
+def test_disk_cache_max_bytes(db_path, fake_time):
+    cache = decorators.DiskCache(db_path, max_bytes=1000)
+    size = len(decorators.pickle.dumps("x" * 300, protocol=-1))
+    for key in "abc":
+        cache.set(key, "x" * 300)
+        fake_time.now += 100
+    assert cache.get("a") == "x" * 300
+    fake_time.now += 100
+    cache.set("d", "x" * 300)
+    # "b" is the least recently used ("a" was read after 60s)
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["x" * 300] * 3
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 3 * size
+    # bigger than max_bytes is not stored
+    cache.set("e", "x" * 2000)
+    assert cache.get("e") is None
+
+
+def test_disk_cache_max_bytes_expired_first(db_path, fake_time):
+    cache = decorators.DiskCache(db_path, max_bytes=1000)
+    cache.set("a", "x" * 400)
+    cache.set("b", "x" * 400, ttl=1)
+    fake_time.now += 10
+    cache.set("c", "x" * 400)
+    assert cache.get("a") == "x" * 400
+    assert cache.stats()["evictions"] == 0
+    assert len(cache) == 2
+
+
+def test_disk_cache_set_rollback(db_path, monkeypatch):
+    cache = decorators.DiskCache(db_path, max_bytes=1000)
+    cache.set("a", 1)
+
+    def fail(*args):
+        raise RuntimeError("evict error")
+
+    monkeypatch.setattr(cache, "_evict", fail)
+    with pytest.raises(RuntimeError):
+        cache.set("b", 2)
+    assert cache.get("b") is None
+    cache.clear()
+    assert len(cache) == 0
+
+
+def _write_entries(path, prefix):
+    cache = decorators.DiskCache(path)
+    for i in range(50):
+        cache.set("{}-{}".format(prefix, i), i)
+
+
+def test_disk_cache_concurrent_processes(db_path):
+    decorators.DiskCache(db_path).clear()
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_write_entries, args=(db_path, i)) for i in range(4)
+    ]
+    for process in processes:
+        process.start()
+    threads = [
+        threading.Thread(target=_write_entries, args=(db_path, "t{}".format(i)))
+        for i in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    for thread in threads:
+        thread.join()
+    assert len(decorators.DiskCache(db_path)) == 300
+
+
+def test_disk_cache_decorator_across_runs(db_path):
+    calls = []
+
+    def scan(datacenter, verbose=False):
+        calls.append(datacenter)
+        return ["host-{}".format(datacenter)]
+
+    run1 = decorators.disk_cache(path=db_path)(scan)
+    assert run1("dc1") == ["host-dc1"]
+    assert run1("dc1") == ["host-dc1"]
+    # new decorated function (next run of the program) uses the stored result
+    run2 = decorators.disk_cache(path=db_path)(scan)
+    assert run2("dc1") == ["host-dc1"]
+    assert run2("dc1", verbose=True) == ["host-dc1"]
+    assert calls == ["dc1", "dc1"]
+    # new version invalidates old results
+    run3 = decorators.disk_cache(path=db_path, version="2")(scan)
+    assert run3("dc1") == ["host-dc1"]
+    assert len(calls) == 3
+
+
+def test_disk_cache_decorator_key_args(db_path):
+    cache = decorators.DiskCache(db_path)
+
+    @decorators.disk_cache(cache=cache, key_args=["url"])
+    def pull(session, url):
+        return url.upper()
+
+    assert pull(object(), "a") == "A"
+    assert pull(object(), url="a") == "A"
+    assert pull.cache is cache
+    assert cache.stats()["hits"] == 1
+
+
+def test_disk_cache_decorator_default_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+
+    @decorators.disk_cache
+    def func():
+        return 1
+
+    assert func() == 1
+    assert os.path.isfile(str(tmp_path / "pcof" / "disk_cache.sqlite"))
+    monkeypatch.delenv("XDG_CACHE_HOME")
+    assert decorators._default_disk_cache_path() == os.path.join(
+        "~", ".cache", "pcof", "disk_cache.sqlite"
+    )
+
+
+def test_disk_cache_decorator_errors(db_path, caplog):
+    @decorators.disk_cache(path=db_path)
+    def func(value):
+        return threading.Lock() if value == "lock" else value
+
+    # result can not be pickled
+    assert isinstance(func("lock"), type(threading.Lock()))
+    assert "store error" in caplog.text
+    # argument can not be hashed (pickled)
+    assert func(lambda: None) is not None
+    assert "lookup error" in caplog.text
+    assert func.cache.stats()["errors"] == 2
+
+
+def test_disk_cache_decorator_exception_not_cached(db_path):
+    calls = []
+
+    @decorators.disk_cache(path=db_path)
+    def func():
+        calls.append(1)
+        raise KeyError
+
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            func()
+    assert len(calls) == 2
+
+
+def test_disk_cache_decorator_async(db_path):
+    calls = []
+
+    @decorators.disk_cache(path=db_path)
+    async def coro(value):
+        calls.append(value)
+        return value * 2
+
+    async def main():
+        return [await coro(1), await coro(1)]
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(main()) == [2, 2]
+    finally:
+        loop.close()
+    assert calls == [1]
+
+
+def test_disk_cache_decorator_generator():
+    def gen():
+        yield 1
+
+    with pytest.raises(TypeError, match="does not support generators"):
+        decorators.disk_cache(gen)
+
+
+# vim: ts=4
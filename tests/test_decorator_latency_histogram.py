@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Test LatencyHistogram class and time_elapsed latency statistics."""
+
+import json
+import random
+import threading
+import pytest
+from pcof import decorators
+
+
+def test_latency_histogram_empty():
+    histogram = decorators.LatencyHistogram()
+    # thread shard without values
+    histogram._shards.get()
+    assert histogram.count() == 0
+    assert histogram.percentile(99) == 0.0
+    assert histogram.snapshot() == {
+        "count": 0,
+        "min": 0.0,
+        "max": 0.0,
+        "mean": 0.0,
+        "p50": 0.0,
+        "p90": 0.0,
+        "p99": 0.0,
+        "p99.9": 0.0,
+    }
+
+
+@pytest.mark.parametrize("scale", [1e-7, 1e-3, 1, 1000])
+def test_latency_histogram_percentiles(scale):
+    values = [random.uniform(1, 10) * scale for _ in range(10000)]
+    histogram = decorators.LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+
+    values.sort()
+    stats = histogram.snapshot(percentiles=(1, 50, 90, 99, 100))
+    assert stats["count"] == 10000
+    assert stats["min"] == values[0]
+    assert stats["max"] == values[-1]
+    assert stats["mean"] == pytest.approx(sum(values) / len(values))
+    for percentile in (1, 50, 90, 99, 100):
+        expected = values[int(percentile / 100 * len(values)) - 1]
+        result = stats["p{}".format(percentile)]
+        assert result == pytest.approx(expected, rel=0.01, abs=1e-9)
+        assert histogram.percentile(percentile) == result
+
+
+def test_latency_histogram_buckets():
+    # small values are exact, the number of buckets is bounded
+    histogram = decorators.LatencyHistogram()
+    for nanoseconds in range(200):
+        histogram.record(nanoseconds / 1e9)
+    for exponent in range(-9, 4):
+        for _ in range(1000):
+            histogram.record(random.random() * 10**exponent)
+    buckets = histogram._merge()[0]
+    assert len(buckets) < 128 * 45
+    assert histogram.percentile(0) == 0.0
+
+
+def test_latency_histogram_threads():
+    histogram = decorators.LatencyHistogram()
+
+    def record():
+        for num in range(1000):
+            histogram.record(num / 1e6)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert histogram.count() == 8000
+    assert histogram.snapshot()["max"] == 999 / 1e6
+
+
+def test_latency_histogram_short_lived_threads():
+    histogram = decorators.LatencyHistogram()
+    for num in range(1, 301):
+        thread = threading.Thread(target=histogram.record, args=(num / 1000,))
+        thread.start()
+        thread.join()
+    # thread without values
+    thread = threading.Thread(target=histogram._shards.get)
+    thread.start()
+    thread.join()
+    assert len(histogram._shards.all()) == 1
+    stats = histogram.snapshot(percentiles=(50,))
+    assert stats["count"] == 300
+    assert stats["min"] == 0.001
+    assert stats["max"] == 0.3
+    assert stats["p50"] == pytest.approx(0.15, rel=0.01)
+
+
+def test_latency_histogram_reset_json():
+    histogram = decorators.LatencyHistogram()
+    histogram.record(0.5)
+    histogram.record(1.5)
+    stats = json.loads(histogram.to_json(percentiles=(50,)))
+    assert stats["count"] == 2
+    assert stats["mean"] == 1.0
+    assert stats["p50"] == pytest.approx(0.5, rel=0.01)
+    histogram.reset()
+    assert histogram.count() == 0
+    histogram.record(2)
+    assert histogram.snapshot()["min"] == 2
+
+
+def test_time_elapsed_latency():
+    decorated_func = decorators.time_elapsed(lambda: None)
+    assert decorated_func.latency.count() == 0
+    for _ in range(10):
+        decorated_func()
+    stats = decorated_func.latency.snapshot()
+    assert stats["count"] == 10
+    assert 0 < stats["min"] <= stats["p50"] <= stats["p99"] <= stats["max"]
+    assert stats["mean"] == pytest.approx(decorated_func.elapsed / 10)
+
+
+# vim: ts=4
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Test decorators do not format log messages when logging is disabled."""
+
+import logging
+import pytest
+from pcof import decorators
+
+
+class ReprCounter:
+    def __init__(self):
+        self.calls = 0
+
+    def __repr__(self):
+        self.calls += 1
+        return "ReprCounter"
+
+    __str__ = __repr__
+
+
+DECORATORS = [
+    decorators.num_calls,
+    decorators.time_elapsed,
+    decorators.debug,
+    decorators.retry_on_exception,
+]
+
+
+@pytest.mark.parametrize("decorator", DECORATORS)
+def test_lazy_logging_disabled(caplog, decorator):
+    caplog.set_level(logging.WARNING, logger=decorators.LOG.name)
+    arg = ReprCounter()
+    decorated_func = decorator(loglevel="DEBUG")(lambda value: value)
+    assert decorated_func(arg) is arg
+    assert arg.calls == 0
+    assert caplog.records == []
+
+
+@pytest.mark.parametrize("decorator", [decorators.time_elapsed, decorators.debug])
+def test_lazy_logging_enabled(caplog, decorator):
+    caplog.set_level(logging.DEBUG, logger=decorators.LOG.name)
+    arg = ReprCounter()
+    decorated_func = decorator(loglevel="INFO")(lambda value: value)
+    decorated_func(arg)
+    assert arg.calls > 0
+    assert "ReprCounter" in caplog.text
+    assert all(record.levelname == "INFO" for record in caplog.records)
+
+
+@pytest.mark.parametrize("decorator", DECORATORS)
+def test_invalid_loglevel(decorator):
+    with pytest.raises(ValueError, match="Invalid loglevel"):
+        decorator(loglevel="xx")
+
+
+# vim: ts=4
@@ -49,6 +49,24 @@ def test_num_calls():
     assert decorated_func.numcalls == 4
 
 
+def test_num_calls_reset():
+    """
+    Check numcalls can be reset by assignment or reset()
+    """
+    decorated_func = decorators.num_calls()(myfunc)
+    decorated_func()
+    decorated_func.numcalls = 0
+    decorated_func()
+    assert decorated_func.numcalls == 1
+    assert isinstance(decorated_func.numcalls, decorators.ShardedCounter)
+    decorated_func.numcalls = 10
+    decorated_func()
+    assert decorated_func.numcalls == 11
+    decorated_func.numcalls.reset()
+    decorated_func()
+    assert decorated_func.numcalls == 1
+
+
 def test_num_calls_share():
     """
     Check decorator does not share num_calls between decorator
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Test parallel decorator."""
+
+import os
+import time
+import pytest
+from pcof import decorators
+
+
+@decorators.parallel(workers=2)
+def square(value):
+    if value == "fail":
+        raise ValueError("invalid value")
+    return value * value
+
+
+@decorators.parallel(workers=2)
+def worker_pid(value):
+    time.sleep(0.01)
+    return os.getpid()
+
+
+@decorators.parallel
+def sleep_value(value):
+    time.sleep(value)
+    return value
+
+
+@pytest.fixture(autouse=True)
+def shutdown_pools():
+    yield
+    for func in (square, worker_pid, sleep_value):
+        func.shutdown()
+
+
+def test_parallel_function_unchanged():
+    assert square(3) == 9
+    assert square.__name__ == "square"
+
+
+def test_parallel_map_ordered():
+    assert list(square.map(range(100))) == [i * i for i in range(100)]
+    # generator (unknown length) and fixed chunksize
+    assert list(square.map((i for i in range(50)), chunksize=7)) == [
+        i * i for i in range(50)
+    ]
+    assert list(square.map([])) == []
+
+
+def test_parallel_map_runs_in_workers():
+    pids = set(worker_pid.map(range(20), workers=2, chunksize=1))
+    assert os.getpid() not in pids
+    assert len(pids) == 2
+
+
+def test_parallel_pool_reused():
+    pids = set(worker_pid.map(range(20), workers=2, chunksize=1))
+    assert set(worker_pid.map(range(20), workers=2, chunksize=1)) == pids
+    # bigger pool is created when more workers are requested
+    pids = set(worker_pid.map(range(40), workers=4, chunksize=1))
+    assert len(pids) == 4
+
+
+def test_parallel_bigger_pool_while_map_in_use():
+    first = square.map(range(20), workers=1, chunksize=1)
+    assert next(first) == 0
+    # new pool with 2 workers, the first map keeps using its pool
+    assert list(square.map(range(10), workers=2)) == [i * i for i in range(10)]
+    assert list(first) == [i * i for i in range(1, 20)]
+    # old pool stopped when the first map finished
+    assert list(square.map(range(5), workers=2)) == [i * i for i in range(5)]
+
+
+def test_parallel_concurrent_maps():
+    first = square.map(range(10), workers=2)
+    second = square.map(range(10), workers=2)
+    assert next(first) == 0
+    assert next(second) == 0
+    first.close()
+    # pool is still used by the second map
+    assert list(second) == [i * i for i in range(1, 10)]
+
+
+def test_parallel_shutdown_while_map_in_use():
+    results = square.map(range(20), workers=2, chunksize=1)
+    assert next(results) == 0
+    square.shutdown()
+    assert list(results) == [i * i for i in range(1, 20)]
+    # a map never started does not create a pool
+    square.map(range(5))
+    square.shutdown()
+    assert list(square.map(range(5))) == [i * i for i in range(5)]
+
+
+def test_parallel_map_unordered():
+    values = [0.3, 0.0, 0.0, 0.0]
+    results = list(sleep_value.map(values, workers=4, chunksize=1, ordered=False))
+    assert sorted(results) == sorted(values)
+    assert results[-1] == 0.3
+
+
+def test_parallel_map_errors_raise():
+    results = square.map([1, 2, "fail", 4], chunksize=1)
+    assert next(results) == 1
+    assert next(results) == 4
+    with pytest.raises(ValueError, match="invalid value"):
+        next(results)
+
+
+def test_parallel_map_errors_return():
+    results = list(square.map([1, "fail", 3], errors="return"))
+    assert results[0] == 1
+    assert isinstance(results[1], ValueError)
+    assert results[2] == 9
+
+
+def test_parallel_map_invalid_errors():
+    with pytest.raises(ValueError, match="Invalid errors"):
+        square.map([1], errors="ignore")
+
+
+def test_parallel_map_auto_chunksize(monkeypatch):
+    submitted = []
+
+    def fake_submit(executor, run_chunk, function, chunk):
+        submitted.append(len(chunk))
+        future = decorators.concurrent.futures.Future()
+        future.set_result(run_chunk(function, chunk))
+        return future
+
+    class FakeExecutor:
+        submit = fake_submit
+
+    # fast items: chunks grow up to len / (workers * 4)
+    results = decorators._map_results(
+        FakeExecutor(), square, list(range(1000)), 2, None, True, "raise"
+    )
+    assert list(results) == [i * i for i in range(1000)]
+    assert submitted[:4] == [1, 1, 1, 1]
+    assert max(submitted) == 125
+
+    # unknown length and no measured time: max chunk size
+    submitted.clear()
+    monkeypatch.setattr(
+        decorators, "_run_chunk", lambda f, c: (0, [(True, 1)] * len(c))
+    )
+    results = decorators._map_results(
+        FakeExecutor(), square, iter(range(30000)), 1, None, True, "raise"
+    )
+    assert len(list(results)) == 30000
+    assert max(submitted) == decorators._MAX_CHUNKSIZE
+
+
+def test_parallel_map_slow_items_small_chunks(monkeypatch):
+    submitted = []
+
+    def fake_submit(executor, run_chunk, function, chunk):
+        submitted.append(len(chunk))
+        future = decorators.concurrent.futures.Future()
+        # 0.1 second per item: more than the chunk target
+        future.set_result((0.1 * len(chunk), [(True, item) for item in chunk]))
+        return future
+
+    class FakeExecutor:
+        submit = fake_submit
+
+    results = decorators._map_results(
+        FakeExecutor(), square, list(range(100)), 1, None, False, "raise"
+    )
+    assert sorted(results) == list(range(100))
+    assert set(submitted) == {1}
+
+
+def test_parallel_map_close_cancels_pending():
+    results = sleep_value.map([0.0] + [0.2] * 20, workers=1, chunksize=1)
+    assert next(results) == 0.0
+    start = time.monotonic()
+    results.close()
+    square.shutdown()
+    assert time.monotonic() - start < 1
+
+
+# vim: ts=4
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""Test profile decorator."""
+
+import io
+import pstats
+import threading
+import pytest
+from pcof import decorators
+
+
+def leaf(value):
+    return value * 2
+
+
+def calls_count(profiler, name):
+    stats = profiler.stats().stats
+    return sum(stat[1] for func_key, stat in stats.items() if func_key[2] == name)
+
+
+def test_profile_sample_every():
+    @decorators.profile(sample_every=3)
+    def work(value):
+        return leaf(value)
+
+    assert [work(i) for i in range(7)] == [0, 2, 4, 6, 8, 10, 12]
+    assert work.__name__ == "work"
+    # calls 0, 3 and 6 are profiled
+    assert work.profiler.samples == 3
+    assert calls_count(work.profiler, "leaf") == 3
+
+
+def test_profile_without_parameter():
+    @decorators.profile
+    def work(value):
+        return leaf(value)
+
+    work(1)
+    assert work.profiler.samples == 1
+
+
+def test_profile_exception():
+    @decorators.profile(sample_every=1)
+    def fail():
+        raise ValueError("fail")
+
+    with pytest.raises(ValueError):
+        fail()
+    assert fail.profiler.samples == 1
+
+    # thread can be profiled again
+    with pytest.raises(ValueError):
+        fail()
+    assert fail.profiler.samples == 2
+
+
+def test_profile_nested_calls():
+    profiler = decorators.Profiler()
+
+    @decorators.profile(sample_every=1, profiler=profiler)
+    def inner(value):
+        return leaf(value)
+
+    @decorators.profile(sample_every=1, profiler=profiler)
+    def outer(value):
+        return inner(value) + 1
+
+    assert outer(2) == 5
+    # inner call is part of the outer profile
+    assert profiler.samples == 1
+    assert calls_count(profiler, "inner") == 1
+    assert calls_count(profiler, "leaf") == 1
+
+
+def test_profile_threads():
+    @decorators.profile(sample_every=1)
+    def work(value):
+        return leaf(value)
+
+    threads = [
+        threading.Thread(target=lambda: [work(i) for i in range(20)]) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert work.profiler.samples == 80
+    assert calls_count(work.profiler, "leaf") == 80
+
+
+def test_profile_unsupported():
+    async def coroutine():
+        pass
+
+    def generator():
+        yield 1
+
+    async def async_generator():
+        yield 1
+
+    for func in (coroutine, generator, async_generator):
+        with pytest.raises(TypeError):
+            decorators.profile(func)
+
+
+def test_profile_dump_interval(tmp_path, monkeypatch, fake_time):
+    registered = []
+    monkeypatch.setattr(decorators.atexit, "register", registered.append)
+    filename = tmp_path / "work.pstats"
+
+    @decorators.profile(sample_every=1, filename=str(filename), dump_interval=10)
+    def work(value):
+        return leaf(value)
+
+    assert registered == [work.profiler.dump]
+    work(1)
+    assert not filename.exists()
+    fake_time.now += 10
+    work(2)
+    assert filename.exists()
+    assert list(tmp_path.iterdir()) == [filename]
+    stats = pstats.Stats(str(filename))
+    assert sum(s[1] for k, s in stats.stats.items() if k[2] == "leaf") == 2
+
+    # on exit dump
+    work(3)
+    registered[0]()
+    stats = pstats.Stats(str(filename))
+    assert sum(s[1] for k, s in stats.stats.items() if k[2] == "leaf") == 3
+
+
+def test_profiler_dump_empty(tmp_path):
+    profiler = decorators.Profiler()
+    filename = tmp_path / "empty.pstats"
+    profiler.dump(str(filename))
+    assert not filename.exists()
+    with pytest.raises(ValueError, match="No filename"):
+        profiler.dump()
+
+
+def test_profile_concurrent_dumps(tmp_path):
+    filename = tmp_path / "work.pstats"
+
+    @decorators.profile(sample_every=1, filename=str(filename), dump_interval=0)
+    def work(value):
+        return leaf(value)
+
+    errors = []
+
+    def call():
+        try:
+            for num in range(100):
+                assert work(num) == num * 2
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert work.profiler.errors == 0
+    assert work.profiler.samples == 800
+    assert list(tmp_path.iterdir()) == [filename]
+    work.profiler.dump()
+    stats = pstats.Stats(str(filename))
+    assert sum(s[1] for k, s in stats.stats.items() if k[2] == "leaf") == 800
+
+
+def test_profile_dump_error(tmp_path, caplog, monkeypatch):
+    monkeypatch.setattr(decorators.atexit, "register", lambda func: None)
+    filename = tmp_path / "missing" / "work.pstats"
+
+    @decorators.profile(sample_every=1, filename=str(filename), dump_interval=0)
+    def work(value):
+        return leaf(value)
+
+    # error is logged, not raised by the call
+    assert work(2) == 4
+    assert work.profiler.errors == 1
+    assert work.profiler.samples == 1
+    assert "statistics error" in caplog.text
+
+
+def test_profile_dump_write_error(tmp_path, monkeypatch):
+    profiler = decorators.Profiler()
+    call_profile = decorators.cProfile.Profile()
+    call_profile.runcall(leaf, 1)
+    profiler.add(call_profile)
+
+    def fail(self, filename):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(decorators.pstats.Stats, "dump_stats", fail)
+    with pytest.raises(OSError, match="disk full"):
+        profiler.dump(str(tmp_path / "work.pstats"))
+    # temporary file removed
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_profile_other_profiler_active(monkeypatch):
+    class ActiveProfile:
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setattr(decorators.cProfile, "Profile", ActiveProfile)
+
+    @decorators.profile(sample_every=1)
+    def work(value):
+        return leaf(value)
+
+    assert work(3) == 6
+    assert work.profiler.samples == 0
+
+
+def test_profiler_print_top_and_reset(tmp_path):
+    profiler = decorators.Profiler()
+
+    @decorators.profile(sample_every=1, profiler=profiler)
+    def work(value):
+        return leaf(value)
+
+    work(1)
+    stream = io.StringIO()
+    profiler.print_top(5, stream=stream)
+    assert "leaf" in stream.getvalue()
+
+    filename = str(tmp_path / "work.pstats")
+    profiler.dump(filename)
+    stream = io.StringIO()
+    decorators.print_profile(filename, limit=5, sort="tottime", stream=stream)
+    assert "leaf" in stream.getvalue()
+
+    profiler.reset()
+    assert profiler.samples == 0
+    assert profiler.stats().stats == {}
+
+
+# vim: ts=4
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Test TokenBucket class and rate_limit decorator."""
+
+import asyncio
+import threading
+import time
+import pytest
+from pcof import decorators
+
+
+def test_token_bucket_invalid():
+    with pytest.raises(ValueError, match="Invalid rate"):
+        decorators.TokenBucket(0)
+    with pytest.raises(ValueError, match="rate or limiter is required"):
+        decorators.rate_limit(block=False)
+
+
+def test_token_bucket_burst_and_refill(fake_time):
+    bucket = decorators.TokenBucket(10, burst=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    fake_time.now += 0.1
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    # refill never goes above burst
+    fake_time.now += 60
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.stats() == {"acquired": 7, "rejected": 3, "wait_time": 0.0}
+
+
+def test_token_bucket_default_burst():
+    assert decorators.TokenBucket(0.5).burst == 1
+    assert decorators.TokenBucket(50).burst == 50
+
+
+def test_token_bucket_acquire_waits(fake_time):
+    bucket = decorators.TokenBucket(10, burst=1)
+    assert bucket.acquire()
+    assert bucket.acquire()
+    assert bucket.acquire(tokens=2)
+    assert fake_time.sleeps == pytest.approx([0.1, 0.2])
+    assert bucket.stats()["wait_time"] == pytest.approx(0.3)
+
+
+def test_token_bucket_acquire_timeout(fake_time):
+    bucket = decorators.TokenBucket(1, burst=1)
+    assert bucket.acquire()
+    assert not bucket.acquire(timeout=0.5)
+    assert fake_time.sleeps == []
+    assert bucket.acquire(timeout=1)
+    assert fake_time.sleeps == pytest.approx([1])
+
+
+def test_rate_limit_non_blocking(fake_time):
+    @decorators.rate_limit(rate=2, burst=2, block=False)
+    def func(value):
+        return value
+
+    assert func(1) == 1
+    assert func(2) == 2
+    with pytest.raises(decorators.RateLimitExceeded) as error:
+        func(3)
+    assert error.value.retry_after == pytest.approx(0.5)
+    assert "rate limit exceeded, retry after 0.500s" in str(error.value)
+    assert func.rate_limiter.stats()["rejected"] == 1
+
+
+def test_rate_limit_blocking(fake_time):
+    @decorators.rate_limit(rate=4, burst=1)
+    def func():
+        return fake_time.now
+
+    assert [func() for _ in range(4)] == [1000.0, 1000.25, 1000.5, 1000.75]
+
+
+def test_rate_limit_timeout(fake_time):
+    @decorators.rate_limit(rate=1, timeout=0.5)
+    def func():
+        pass
+
+    func()
+    with pytest.raises(decorators.RateLimitExceeded):
+        func()
+
+
+def test_rate_limit_shared_limiter(fake_time):
+    limiter = decorators.TokenBucket(1, burst=2)
+
+    @decorators.rate_limit(limiter=limiter, block=False)
+    def func1():
+        pass
+
+    @decorators.rate_limit(limiter=limiter, block=False)
+    def func2():
+        pass
+
+    func1()
+    func2()
+    with pytest.raises(decorators.RateLimitExceeded):
+        func1()
+    assert func1.rate_limiter is func2.rate_limiter is limiter
+
+
+def test_rate_limit_threads_accuracy():
+    limiter = decorators.TokenBucket(200, burst=1)
+
+    @decorators.rate_limit(limiter=limiter)
+    def func():
+        pass
+
+    def call():
+        for _ in range(25):
+            func()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    # 100 calls, the first one uses the burst token: 99 / 200 seconds
+    assert 0.49 <= elapsed < 1
+    assert limiter.stats()["acquired"] == 100
+
+
+def test_rate_limit_async(run):
+    limiter = decorators.TokenBucket(20, burst=1)
+
+    @decorators.rate_limit(limiter=limiter)
+    async def coro(value):
+        return value
+
+    @decorators.rate_limit(limiter=limiter)
+    async def agen():
+        yield 1
+
+    @decorators.rate_limit(limiter=limiter, block=False)
+    async def coro_no_block():
+        pass
+
+    async def main():
+        start = time.monotonic()
+        results = await asyncio.gather(*[coro(i) for i in range(3)])
+        values = [value async for value in agen()]
+        return results, values, time.monotonic() - start
+
+    results, values, elapsed = run(main())
+    assert results == [0, 1, 2]
+    assert values == [1]
+    assert elapsed >= 0.14
+    with pytest.raises(decorators.RateLimitExceeded):
+        run(coro_no_block())
+
+
+def test_rate_limit_async_method(run):
+    bucket = decorators.TokenBucket(50, burst=1)
+    start = time.monotonic()
+    assert run(bucket.acquire_async())
+    assert not run(bucket.acquire_async(timeout=0))
+    assert run(bucket.acquire_async())
+    assert time.monotonic() - start >= 0.015
+
+
+@pytest.mark.parametrize("use_decorator", [False, True])
+def test_rate_limit_async_cancelled(fake_time, run, use_decorator):
+    bucket = decorators.TokenBucket(1, burst=1)
+
+    @decorators.rate_limit(limiter=bucket)
+    async def coro():
+        return True
+
+    acquire = coro if use_decorator else bucket.acquire_async
+
+    async def main():
+        assert await acquire()
+        waiter = asyncio.ensure_future(acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    run(main())
+    assert bucket.stats() == {"acquired": 1, "rejected": 0, "wait_time": 0.0}
+    # the token reserved by the cancelled call was given back
+    fake_time.now += 1
+    assert bucket.try_acquire()
+
+
+# vim: ts=4
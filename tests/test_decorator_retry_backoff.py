@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Test retry_on_exception backoff strategies, deadline, retry_if and stats."""
+
+import logging
+import random
+import pytest
+from pcof import decorators
+
+
+def always_fail(**kwargs):
+    @decorators.retry_on_exception(**kwargs)
+    def func():
+        raise TimeoutError
+
+    return func
+
+
+def test_retry_backoff_invalid():
+    with pytest.raises(ValueError, match="Invalid backoff"):
+        always_fail(backoff="linear")
+
+
+def test_retry_backoff_fixed(fake_time):
+    func = always_fail(max_retry=5)
+    with pytest.raises(TimeoutError):
+        func()
+    assert fake_time.sleeps == [1, 1, 1, 1]
+
+
+@pytest.mark.parametrize(
+    "max_delay, delays", [(None, [0.5, 1, 2, 4, 8]), (1.5, [0.5, 1, 1.5, 1.5, 1.5])]
+)
+def test_retry_backoff_exponential(fake_time, max_delay, delays):
+    func = always_fail(
+        backoff="exponential", sleep_retry=0.5, max_retry=6, max_delay=max_delay
+    )
+    with pytest.raises(TimeoutError):
+        func()
+    assert fake_time.sleeps == delays
+
+
+def test_retry_backoff_exponential_forever_no_overflow():
+    assert decorators._BACKOFF["exponential"](1, 10000, 1) == 2.0**64
+
+
+def test_retry_backoff_full_jitter(fake_time):
+    random.seed(1)
+    func = always_fail(backoff="full_jitter", sleep_retry=1, max_retry=8)
+    with pytest.raises(TimeoutError):
+        func()
+    assert len(fake_time.sleeps) == 7
+    for retry, delay in enumerate(fake_time.sleeps):
+        assert 0 <= delay <= 2**retry
+    assert len(set(fake_time.sleeps)) == 7
+
+
+def test_retry_backoff_decorrelated_jitter(fake_time):
+    random.seed(2)
+    func = always_fail(
+        backoff="decorrelated_jitter", sleep_retry=1, max_retry=10, max_delay=20
+    )
+    with pytest.raises(TimeoutError):
+        func()
+    previous = 1
+    for delay in fake_time.sleeps:
+        assert 1 <= delay <= min(previous * 3, 20)
+        previous = delay
+
+
+def test_retry_deadline(fake_time, caplog):
+    caplog.set_level(logging.DEBUG)
+    func = always_fail(backoff="exponential", max_retry=-1, deadline=5)
+    with pytest.raises(TimeoutError):
+        func()
+    # 1 + 2 seconds waited, next retry after 4 seconds would pass the deadline
+    assert fake_time.sleeps == [1, 2]
+    assert "deadline '5' reached. Giving up" in caplog.text
+    assert func.retry_stats.snapshot() == {
+        "calls": 1,
+        "attempts": 3,
+        "retries": 2,
+        "giveups": 1,
+        "retry_time": 3,
+    }
+
+
+def test_retry_deadline_exception_error(fake_time):
+    class DeadlineReached(Exception):
+        pass
+
+    func = always_fail(deadline=2.5, max_retry=-1, exception_error=DeadlineReached)
+    with pytest.raises(DeadlineReached, match="deadline reached"):
+        func()
+    assert fake_time.sleeps == [1, 1]
+
+
+def test_retry_if_exception(fake_time):
+    calls = []
+
+    @decorators.retry_on_exception(
+        retry_if=lambda result, error: isinstance(error, TimeoutError)
+    )
+    def func(error):
+        calls.append(error)
+        raise error
+
+    with pytest.raises(KeyError):
+        func(KeyError)
+    assert len(calls) == 1
+    with pytest.raises(TimeoutError):
+        func(TimeoutError)
+    assert len(calls) == 6
+    assert func.retry_stats.snapshot()["giveups"] == 1
+
+
+def test_retry_if_result(fake_time, caplog):
+    caplog.set_level(logging.DEBUG)
+    results = [None, None, "ok"]
+
+    @decorators.retry_on_exception(retry_if=lambda result, error: result is None)
+    def func():
+        return results.pop(0)
+
+    assert func() == "ok"
+    assert fake_time.sleeps == [1, 1]
+    assert "function: func - retry result: None" in caplog.text
+    assert func.retry_stats.snapshot() == {
+        "calls": 1,
+        "attempts": 3,
+        "retries": 2,
+        "giveups": 0,
+        "retry_time": 2,
+    }
+
+
+def test_retry_if_result_give_up(fake_time):
+    class MaxRetryReached(Exception):
+        pass
+
+    def retry_if(result, error):
+        return error is not None or result < 10
+
+    @decorators.retry_on_exception(max_retry=3, retry_if=retry_if)
+    def func():
+        return 1
+
+    @decorators.retry_on_exception(
+        max_retry=3, retry_if=retry_if, exception_error=MaxRetryReached
+    )
+    def func_raise():
+        return 1
+
+    assert func() == 1
+    with pytest.raises(MaxRetryReached, match="max retry reached"):
+        func_raise()
+    assert func.retry_stats.giveups == 1
+
+
+def test_retry_stats_success_and_reset(fake_time):
+    @decorators.retry_on_exception
+    def func():
+        return True
+
+    for _ in range(3):
+        func()
+    assert func.retry_stats.snapshot() == {
+        "calls": 3,
+        "attempts": 3,
+        "retries": 0,
+        "giveups": 0,
+        "retry_time": 0,
+    }
+    func.retry_stats.reset()
+    assert func.retry_stats.calls == 0
+
+
+def test_retry_stats_generator(fake_time):
+    calls = []
+
+    @decorators.retry_on_exception(backoff="exponential")
+    def gen():
+        calls.append(1)
+        if len(calls) < 3:
+            raise TimeoutError
+        yield 1
+
+    assert list(gen()) == [1]
+    assert gen.retry_stats.snapshot()["retry_time"] == 3
+
+
+# vim: ts=4
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Test ShardedCounter, HeavyHitters and num_calls counting by argument."""
+
+import threading
+from pcof import decorators
+
+
+def run_threads(target, num_threads=8):
+    threads = [threading.Thread(target=target) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_sharded_counter_threads():
+    counter = decorators.ShardedCounter()
+
+    def add():
+        for _ in range(10000):
+            counter.add()
+
+    run_threads(add)
+    assert counter.value() == 80000
+    # shards of the exited threads are merged
+    assert len(counter._shards.all()) == 1
+
+
+def test_sharded_counter_short_lived_threads():
+    counter = decorators.ShardedCounter()
+    for _ in range(200):
+        run_threads(counter.add, 1)
+    counter.add()
+    assert counter.value() == 201
+    # retired shard and main thread shard
+    assert len(counter._shards.all()) == 2
+
+
+def test_sharded_counter_reset_live_thread():
+    counter = decorators.ShardedCounter()
+    added = threading.Event()
+    finish = threading.Event()
+
+    def add():
+        counter.add(5)
+        added.set()
+        finish.wait()
+
+    thread = threading.Thread(target=add)
+    thread.start()
+    added.wait()
+    counter.reset()
+    finish.set()
+    thread.join()
+    # shard removed by reset is not merged when the thread exits
+    assert counter.value() == 0
+
+
+def test_thread_shards_deleted():
+    shards = []
+
+    def add():
+        counter = decorators.ShardedCounter()
+        counter.add()
+        shards.append(counter._shards)
+
+    run_threads(add, 1)
+    assert shards[0].all() == [[1]]
+
+    def add_and_delete():
+        counter = decorators.ShardedCounter()
+        counter.add()
+        del counter
+
+    # thread exits after the counter is deleted
+    run_threads(add_and_delete, 1)
+
+
+def test_sharded_counter_int_like():
+    counter = decorators.ShardedCounter()
+    counter.add(5)
+    assert counter == 5
+    assert counter != 4
+    assert 4 < counter <= 5
+    assert int(counter) == 5
+    assert [0, 1, 2, 3, 4, 5][counter] == 5
+    assert repr(counter) == "5"
+    assert str(counter) == "5"
+    assert "{:03d}".format(counter) == "005"
+    assert counter + 1 == 6
+    assert 1 + counter == 6
+    assert counter - 1 == 4
+    assert 10 - counter == 5
+    assert sum([counter, counter]) == 10
+    counter.reset()
+    assert counter == 0
+
+
+def test_heavy_hitters_exact():
+    hitters = decorators.HeavyHitters(3)
+    for value in ["a"] * 5 + ["b"] * 3 + ["c"]:
+        hitters.add(value)
+    assert hitters.most_common() == [("a", 5), ("b", 3), ("c", 1)]
+    assert hitters.most_common(2) == [("a", 5), ("b", 3)]
+    hitters.reset()
+    assert hitters.most_common() == []
+
+
+def test_heavy_hitters_bounded():
+    hitters = decorators.HeavyHitters(5)
+    for i in range(10000):
+        hitters.add("hot" if i % 2 else i)
+    counts = hitters._shards.get()
+    assert len(counts) == 5
+    value, count = hitters.most_common(1)[0]
+    assert value == "hot"
+    assert count >= 5000
+
+
+def test_heavy_hitters_threads():
+    hitters = decorators.HeavyHitters(4)
+
+    def add():
+        for i in range(1000):
+            hitters.add("x")
+            hitters.add(i % 2)
+
+    run_threads(add, 4)
+    assert hitters.most_common() == [("x", 4000), (0, 2000), (1, 2000)]
+
+
+def test_heavy_hitters_short_lived_threads():
+    hitters = decorators.HeavyHitters(5)
+    for num in range(500):
+        run_threads(lambda: [hitters.add("hot"), hitters.add(num)], 1)
+    shards = hitters._shards.all()
+    assert len(shards) == 1
+    assert len(shards[0]) == 5
+    assert hitters.most_common(1) == [("hot", 500)]
+
+
+def test_num_calls_threads():
+    @decorators.num_calls
+    def func():
+        pass
+
+    def call():
+        for _ in range(1000):
+            func()
+
+    run_threads(call)
+    assert func.numcalls == 8000
+    assert func.top_calls is None
+
+
+def test_num_calls_count_by():
+    @decorators.num_calls(count_by=lambda host, **kwargs: host, top_k=2)
+    def get_status(host, timeout=10):
+        return host
+
+    for host in ["a", "b", "a", "a", "b", "c"]:
+        assert get_status(host, timeout=1) == host
+    assert get_status.numcalls == 6
+    assert get_status.top_calls.most_common(1) == [("a", 3)]
+    assert len(get_status.top_calls.most_common()) == 2
+
+
+# vim: ts=4
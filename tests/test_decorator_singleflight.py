@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Test singleflight decorator."""
+
+import asyncio
+import threading
+import time
+import pytest
+from pcof import decorators
+
+
+def run_threads(target, args_list):
+    results = [None] * len(args_list)
+
+    def call(index, args):
+        try:
+            results[index] = target(*args)
+        except Exception as error:
+            results[index] = error
+
+    threads = [
+        threading.Thread(target=call, args=(index, args))
+        for index, args in enumerate(args_list)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_singleflight_threads_coalesced():
+    calls = []
+
+    @decorators.singleflight
+    def func(value):
+        calls.append(value)
+        time.sleep(0.1)
+        return [value]
+
+    results = run_threads(func, [(1,)] * 20 + [(2,)] * 5)
+    assert sorted(calls) == [1, 2]
+    assert results[:20] == [[1]] * 20
+    # all callers get the same result object
+    assert all(result is results[0] for result in results[:20])
+    assert results[20:] == [[2]] * 5
+    assert func.executions == 2
+    assert func.coalesced == 23
+
+
+def test_singleflight_threads_exception():
+    @decorators.singleflight
+    def func():
+        time.sleep(0.1)
+        raise KeyError("backend error")
+
+    results = run_threads(func, [()] * 10)
+    assert all(isinstance(result, KeyError) for result in results)
+    assert func.executions == 1
+
+
+def test_singleflight_sequential_calls_not_coalesced():
+    @decorators.singleflight
+    def func(value):
+        return value
+
+    assert [func(1), func(1)] == [1, 1]
+    assert func.executions == 2
+    assert func.coalesced == 0
+    with pytest.raises(ZeroDivisionError):
+        decorators.singleflight(lambda: 1 / 0)()
+
+
+def test_singleflight_key_args():
+    @decorators.singleflight(key_args=["url"])
+    def func(session, url):
+        time.sleep(0.1)
+        return url
+
+    results = run_threads(func, [(object(), "a") for _ in range(5)])
+    assert results == ["a"] * 5
+    assert func.executions == 1
+
+
+def test_singleflight_async(run):
+    calls = []
+
+    @decorators.singleflight
+    async def coro(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return value * 2
+
+    async def main():
+        return await asyncio.gather(*[coro(i % 2) for i in range(10)])
+
+    assert run(main()) == [0, 2] * 5
+    assert sorted(calls) == [0, 1]
+    assert coro.executions == 2
+    assert coro.coalesced == 8
+    # next call executes again
+    assert run(coro(0)) == 0
+    assert coro.executions == 3
+
+
+def test_singleflight_async_exception(run):
+    @decorators.singleflight
+    async def coro():
+        await asyncio.sleep(0.01)
+        raise KeyError
+
+    async def main():
+        return await asyncio.gather(*[coro() for _ in range(3)], return_exceptions=True)
+
+    assert all(isinstance(result, KeyError) for result in run(main()))
+    assert coro.executions == 1
+
+
+def test_singleflight_async_cancelled_waiter(run):
+    @decorators.singleflight
+    async def coro():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def main():
+        first = asyncio.ensure_future(coro())
+        second = asyncio.ensure_future(coro())
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first.cancelled()
+
+    assert run(main()) == ("done", True)
+
+
+def test_singleflight_generator():
+    def gen():
+        yield 1
+
+    with pytest.raises(TypeError, match="does not support generators"):
+        decorators.singleflight(gen)
+
+
+# vim: ts=4
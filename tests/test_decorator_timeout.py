@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Test timeout decorator."""
+
+import asyncio
+import os
+import signal
+import threading
+import time
+import pytest
+from pcof import decorators
+
+
+def slow(seconds, result="done"):
+    time.sleep(seconds)
+    return result
+
+
+def fail():
+    raise KeyError("error")
+
+
+def run_in_thread(function, *args):
+    outcome = []
+
+    def target():
+        try:
+            outcome.append(function(*args))
+        except BaseException as error:
+            outcome.append(error)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    return outcome[0]
+
+
+def test_timeout_invalid():
+    with pytest.raises(ValueError, match="Invalid mode"):
+        decorators.timeout(1, mode="fork")
+
+    def gen():
+        yield 1
+
+    with pytest.raises(TypeError, match="does not support generators"):
+        decorators.timeout(1)(gen)
+
+
+@pytest.mark.parametrize("mode", ["auto", "signal", "thread", "process"])
+def test_timeout_result(mode):
+    func = decorators.timeout(2, mode=mode)(slow)
+    assert func(0, result=[1, 2]) == [1, 2]
+    assert func.__name__ == "slow"
+    with pytest.raises(KeyError, match="error"):
+        decorators.timeout(2, mode=mode)(fail)()
+
+
+@pytest.mark.parametrize("mode", ["auto", "signal", "thread", "process"])
+def test_timeout_expired(mode):
+    func = decorators.timeout(0.1, mode=mode)(slow)
+    start = time.monotonic()
+    with pytest.raises(decorators.CallTimeoutError) as error:
+        func(2)
+    assert time.monotonic() - start < 1
+    assert isinstance(error.value, TimeoutError)
+    assert error.value.seconds == 0.1
+    assert str(error.value) == "function slow timed out after 0.1s"
+
+
+def test_timeout_signal_restores_state():
+    previous = signal.getsignal(signal.SIGALRM)
+    decorators.timeout(1, mode="signal")(slow)(0)
+    assert signal.getsignal(signal.SIGALRM) is previous
+    assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+
+
+def test_timeout_signal_nested():
+    @decorators.timeout(0.2, mode="signal")
+    def outer():
+        decorators.timeout(1, mode="signal")(slow)(0)
+        # outer timer restored after the inner call
+        return slow(1)
+
+    with pytest.raises(decorators.CallTimeoutError, match="outer"):
+        outer()
+    assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+
+
+def test_timeout_auto_uses_thread_outside_main_thread():
+    func = decorators.timeout(0.1)(slow)
+    error = run_in_thread(func, 2)
+    assert isinstance(error, decorators.CallTimeoutError)
+    assert run_in_thread(func, 0) == "done"
+
+
+def test_timeout_process_killed():
+    func = decorators.timeout(0.1, mode="process")(slow)
+    with pytest.raises(decorators.CallTimeoutError):
+        func(10)
+    assert not [
+        child
+        for child in decorators.multiprocessing.active_children()
+        if child.is_alive()
+    ]
+
+
+def test_timeout_process_unpicklable_result():
+    func = decorators.timeout(2, mode="process")(lambda: threading.Lock())
+    with pytest.raises(RuntimeError, match="pickle"):
+        func()
+
+
+def test_timeout_process_exit_without_result():
+    func = decorators.timeout(2, mode="process")(lambda: os._exit(1))
+    with pytest.raises(RuntimeError, match="exited without result"):
+        func()
+
+
+def test_timeout_async():
+    @decorators.timeout(0.1)
+    async def coro(seconds):
+        await asyncio.sleep(seconds)
+        return "done"
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(coro(0)) == "done"
+        with pytest.raises(decorators.CallTimeoutError, match="coro"):
+            loop.run_until_complete(coro(2))
+    finally:
+        loop.close()
+
+
+def test_timeout_async_own_timeout_error(run):
+    @decorators.timeout(1)
+    async def coro():
+        await asyncio.sleep(0)
+        raise asyncio.TimeoutError("own")
+
+    with pytest.raises(asyncio.TimeoutError, match="own") as error:
+        run(coro())
+    assert not isinstance(error.value, decorators.CallTimeoutError)
+
+
+def test_timeout_async_ignores_cancel(run):
+    @decorators.timeout(0.05)
+    async def coro():
+        try:
+            await asyncio.sleep(2)
+        except asyncio.CancelledError:
+            return "cancel ignored"
+
+    assert run(coro()) == "cancel ignored"
+
+
+def test_timeout_async_cancelled(run):
+    cancelled = []
+
+    @decorators.timeout(2)
+    async def coro():
+        try:
+            await asyncio.sleep(2)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def main():
+        caller = asyncio.ensure_future(coro())
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0)
+        return cancelled
+
+    assert run(main()) == [True]
+
+
+def test_timeout_with_retry():
+    calls = []
+
+    @decorators.retry_on_exception(exception=(TimeoutError,), sleep_retry=0)
+    @decorators.timeout(0.05, mode="thread")
+    def func():
+        calls.append(1)
+        return slow(1 if len(calls) < 2 else 0)
+
+    assert func() == "done"
+    assert len(calls) == 2
+
+
+# vim: ts=4
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Test deep_merge and deep_diff functions."""
+
+import copy
+from pcof import misc
+
+DEFAULTS = {
+    "log": {"level": "INFO", "file": "app.log", "rotate": {"size": 10}},
+    "db": {"host": "localhost", "port": 5432},
+    "users": ["admin"],
+}
+SITE = {"log": {"rotate": {"count": 5}}, "users": ["ops"]}
+HOST = {"log": {"level": "DEBUG"}, "db": {"port": 5433}, "new": {"x": 1}}
+
+
+def test_deep_merge():
+    defaults = copy.deepcopy(DEFAULTS)
+    site = copy.deepcopy(SITE)
+    host = copy.deepcopy(HOST)
+
+    result = misc.deep_merge(defaults, site, host)
+    assert result == {
+        "log": {
+            "level": "DEBUG",
+            "file": "app.log",
+            "rotate": {"size": 10, "count": 5},
+        },
+        "db": {"host": "localhost", "port": 5433},
+        "users": ["ops"],
+        "new": {"x": 1},
+    }
+    # inputs are not changed
+    assert defaults == DEFAULTS
+    assert site == SITE
+    assert host == HOST
+
+
+def test_deep_merge_share():
+    defaults = copy.deepcopy(DEFAULTS)
+    result = misc.deep_merge(defaults, {"log": {"level": "DEBUG"}})
+    # unchanged subtrees are shared, changed ones are copied
+    assert result["db"] is defaults["db"]
+    assert result["users"] is defaults["users"]
+    assert result["log"]["rotate"] is defaults["log"]["rotate"]
+    assert result["log"] is not defaults["log"]
+    assert result is not defaults
+
+
+def test_deep_merge_type_change():
+    assert misc.deep_merge({"a": {"b": 1}}, {"a": 2}) == {"a": 2}
+    assert misc.deep_merge({"a": 2}, {"a": {"b": 1}}) == {"a": {"b": 1}}
+
+
+def test_deep_merge_args():
+    assert misc.deep_merge() == {}
+    defaults = copy.deepcopy(DEFAULTS)
+    result = misc.deep_merge(defaults)
+    assert result == defaults
+    assert result is not defaults
+    assert misc.deep_merge(defaults, defaults) == defaults
+
+
+def test_deep_diff():
+    old = copy.deepcopy(DEFAULTS)
+    new = misc.deep_merge(old, SITE, HOST)
+    del new["db"]["host"]
+    new["users"] = ["admin"]
+
+    diff = list(misc.deep_diff(old, new))
+    assert diff == [
+        ("changed", ("log", "level"), "INFO", "DEBUG"),
+        ("added", ("log", "rotate", "count"), None, 5),
+        ("removed", ("db", "host"), "localhost", None),
+        ("changed", ("db", "port"), 5432, 5433),
+        ("added", ("new",), None, {"x": 1}),
+    ]
+    assert diff[0].op == "changed"
+    assert diff[0].path == ("log", "level")
+    assert diff[0].old == "INFO"
+    assert diff[0].new == "DEBUG"
+
+
+def test_deep_diff_removed_and_types():
+    old = {"a": 1, "b": {"c": 1}, "d": {"e": 1}}
+    new = {"b": 2, "d": {"e": {"f": 1}}}
+    assert list(misc.deep_diff(old, new)) == [
+        ("removed", ("a",), 1, None),
+        ("changed", ("b",), {"c": 1}, 2),
+        ("changed", ("d", "e"), 1, {"f": 1}),
+    ]
+
+
+def test_deep_diff_identity():
+    old = copy.deepcopy(DEFAULTS)
+    assert list(misc.deep_diff(old, old)) == []
+    assert list(misc.deep_diff(old, copy.deepcopy(old))) == []
+    new = dict(old)
+    new["users"] = ["other"]
+    assert list(misc.deep_diff(old, new)) == [
+        ("changed", ("users",), ["admin"], ["other"])
+    ]
+
+
+def build_deep_dict(depth):
+    deep = value = {}
+    for _ in range(depth):
+        value["k"] = {}
+        value = value["k"]
+    return deep, value
+
+
+def test_deep_diff_deep():
+    old, _ = build_deep_dict(5000)
+    new, value = build_deep_dict(5000)
+    value["x"] = 1
+    diff = list(misc.deep_diff(old, new))
+    assert diff == [("added", ("k",) * 5000 + ("x",), None, 1)]
+
+
+def test_deep_merge_deep():
+    old, _ = build_deep_dict(5000)
+    new, value = build_deep_dict(5000)
+    value["x"] = 1
+    assert misc.flatten(misc.deep_merge(old, new)) == {
+        ".".join(["k"] * 5000 + ["x"]): 1
+    }
+
+
+# vim: ts=4
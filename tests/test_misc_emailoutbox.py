@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Test EmailOutbox class."""
+
+import queue
+import smtplib
+import threading
+import time
+import pytest
+from pcof import misc
+
+
+class FakePool:
+    """SMTPPool stand-in, fails "failures" times before sending."""
+
+    def __init__(self, failures=0, delay=0):
+        self.failures = failures
+        self.delay = delay
+        self.sent = []
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def send(self, mail_from, mail_to, subject, body):
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise smtplib.SMTPServerDisconnected("down")
+            self.sent.append((mail_from, mail_to, subject, body))
+
+    def close(self):
+        self.closed = True
+
+
+def test_emailoutbox_smtp(smtp_server):
+    with misc.EmailOutbox("127.0.0.1", smtp_server.port, workers=3) as outbox:
+        for num in range(30):
+            assert outbox.send("me@example.com", "you@example.com", "s", str(num))
+    assert len(smtp_server.messages) == 30
+    assert smtp_server.connections <= 3
+    stats = outbox.stats()
+    assert stats["queued"] == 30
+    assert stats["sent"] == 30
+    assert stats["pending"] == 0
+    with pytest.raises(RuntimeError, match="EmailOutbox is closed"):
+        outbox.send("me@example.com", "you@example.com", "s", "b")
+
+
+def test_emailoutbox_non_ascii(smtp_server):
+    with misc.EmailOutbox("127.0.0.1", smtp_server.port, workers=1) as outbox:
+        outbox.send("me@example.com", "you@example.com", "menu", "caf\u00e9")
+        outbox.send("me@example.com", "you@example.com", "s", "b")
+    assert outbox.stats()["sent"] == 2
+    assert len(smtp_server.messages) == 2
+    assert "charset" in smtp_server.messages[0]["data"]
+
+
+def test_emailoutbox_unexpected_error(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(misc.time, "sleep", sleeps.append)
+
+    class BrokenPool(FakePool):
+        def send(self, mail_from, mail_to, subject, body):
+            if body == "broken":
+                raise UnicodeEncodeError("ascii", body, 0, 1, "test")
+            super().send(mail_from, mail_to, subject, body)
+
+    pool = BrokenPool()
+    outbox = misc.EmailOutbox(pool=pool, workers=1)
+    outbox.send("me@example.com", "you@example.com", "s", "broken")
+    outbox.send("me@example.com", "you@example.com", "s", "b")
+    assert outbox.flush(timeout=5)
+    # not retried and the worker keeps sending
+    assert sleeps == []
+    assert pool.sent == [("me@example.com", "you@example.com", "s", "b")]
+    assert isinstance(outbox.failed[0][1], UnicodeEncodeError)
+    stats = outbox.stats()
+    assert stats["failed"] == 1
+    assert stats["sent"] == 1
+    outbox.close()
+
+
+def test_emailoutbox_retry(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(misc.time, "sleep", sleeps.append)
+    pool = FakePool(failures=2)
+    outbox = misc.EmailOutbox(pool=pool, workers=1, retry_delay=0.5)
+    outbox.send("me@example.com", ["a@example.com", "b@example.com"], "s", "b")
+    assert outbox.flush(timeout=5)
+    assert pool.sent == [
+        ("me@example.com", ("a@example.com", "b@example.com"), "s", "b")
+    ]
+    assert sleeps == [0.5, 1.0]
+    assert outbox.stats()["retries"] == 2
+    assert outbox.close()
+    assert outbox.close()
+    assert pool.closed
+
+
+def test_emailoutbox_failed(monkeypatch):
+    monkeypatch.setattr(misc.time, "sleep", lambda seconds: None)
+    pool = FakePool(failures=3)
+    with misc.EmailOutbox(pool=pool, workers=1, max_retry=3) as outbox:
+        outbox.send("me@example.com", "you@example.com", "s", "1")
+        outbox.send("me@example.com", "you@example.com", "s", "2")
+    assert pool.sent == [("me@example.com", "you@example.com", "s", "2")]
+    assert len(outbox.failed) == 1
+    assert outbox.failed[0][0] == ("me@example.com", "you@example.com", "s", "1")
+    assert isinstance(outbox.failed[0][1], smtplib.SMTPServerDisconnected)
+    stats = outbox.stats()
+    assert stats["failed"] == 1
+    assert stats["sent"] == 1
+    assert stats["retries"] == 2
+
+
+def test_emailoutbox_queue_full():
+    pool = FakePool(delay=0.2)
+    outbox = misc.EmailOutbox(pool=pool, workers=1, queue_size=1, coalesce_window=60)
+    outbox.send("me@example.com", "you@example.com", "s", "1")
+    time.sleep(0.05)  # worker is sending message 1
+    outbox.send("me@example.com", "you@example.com", "s", "2")
+    with pytest.raises(queue.Full):
+        outbox.send("me@example.com", "you@example.com", "s", "3", block=False)
+    with pytest.raises(queue.Full):
+        outbox.send("me@example.com", "you@example.com", "s", "3", timeout=0.01)
+    # not coalesced with the message that was not queued
+    assert not outbox.send("me@example.com", "you@example.com", "s", "2")
+    assert outbox.flush(timeout=0.01) is False
+    assert outbox.close(timeout=0.01) is False
+    assert outbox.close()
+    # digest of message 2 is sent when outbox is closed
+    assert [msg[3] for msg in pool.sent] == [
+        "1",
+        "2",
+        "2\n\nThis message was repeated 1 times in 60 seconds.\n",
+    ]
+
+
+def test_emailoutbox_coalesce():
+    pool = FakePool()
+    outbox = misc.EmailOutbox(pool=pool, coalesce_window=0.3)
+    for _ in range(5):
+        outbox.send("me@example.com", "ops@example.com", "disk full", "host1")
+    assert not outbox.send("me@example.com", "ops@example.com", "disk full", "host1")
+    assert outbox.send("me@example.com", "ops@example.com", "disk full", "host2")
+    assert outbox.send("me@example.com", "ops@example.com", "cpu", "host1")
+    assert outbox.flush(timeout=5)
+    assert len(pool.sent) == 3
+
+    # window ends, digest is sent
+    time.sleep(0.5)
+    assert outbox.flush(timeout=5)
+    assert pool.sent[3] == (
+        "me@example.com",
+        "ops@example.com",
+        "disk full (repeated 5 times)",
+        "host1\n\nThis message was repeated 5 times in 0.3 seconds.\n",
+    )
+    assert len(pool.sent) == 4
+
+    # new window
+    assert outbox.send("me@example.com", "ops@example.com", "disk full", "host1")
+    assert not outbox.send("me@example.com", "ops@example.com", "disk full", "host1")
+    stats = outbox.stats()
+    assert stats["coalesced"] == 6
+    assert stats["digests"] == 1
+    outbox.close()
+
+
+def test_emailoutbox_coalesce_close():
+    pool = FakePool()
+    with misc.EmailOutbox(pool=pool, workers=1, coalesce_window=3600) as outbox:
+        for _ in range(3):
+            outbox.send("me@example.com", "ops@example.com", "disk full", "host1")
+    # digest is sent when outbox is closed
+    assert [msg[2] for msg in pool.sent] == [
+        "disk full",
+        "disk full (repeated 2 times)",
+    ]
+
+
+# vim: ts=4
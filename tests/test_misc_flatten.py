@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Test flatten, unflatten and flatten_columns functions."""
+
+import array
+import pytest
+from pcof import misc
+
+# fmt: off
+DICT_1 = {
+          "A1": "A",
+          "B1": {
+                  "A2": "AA",
+                  "B2": {"A3": "AAA", "B3": []},
+                  "C2": {},
+                },
+          "C1": ["C", {"A2": "CC"}],
+          "D1": None,
+         }
+# fmt: on
+
+FLAT_1 = {
+    "A1": "A",
+    "B1.A2": "AA",
+    "B1.B2.A3": "AAA",
+    "B1.B2.B3": [],
+    "B1.C2": {},
+    "C1": ["C", {"A2": "CC"}],
+    "D1": None,
+}
+
+
+def test_flatten():
+    flat = misc.flatten(DICT_1)
+    assert flat == FLAT_1
+    assert list(flat) == list(FLAT_1)
+
+
+def test_flatten_sep():
+    assert misc.flatten({"a": {"b": 1, 2: {"c": 3}}}, sep="/") == {
+        "a/b": 1,
+        "a/2/c": 3,
+    }
+
+
+def test_flatten_deep():
+    deep = value = {}
+    for _ in range(5000):
+        value["k"] = {}
+        value = value["k"]
+    value["k"] = 1
+    assert misc.flatten(deep) == {".".join(["k"] * 5001): 1}
+
+
+def test_unflatten():
+    assert misc.unflatten(FLAT_1) == DICT_1
+    assert misc.unflatten(misc.flatten(DICT_1, sep="/"), sep="/") == DICT_1
+    assert misc.unflatten({"a.b": None, "a.c": 1}) == {"a": {"b": None, "c": 1}}
+
+
+def test_unflatten_conflict():
+    with pytest.raises(ValueError, match="Conflicting key: a.b"):
+        misc.unflatten({"a": 1, "a.b": 2})
+    with pytest.raises(ValueError, match="Conflicting key: a$"):
+        misc.unflatten({"a.b": 1, "a": 2})
+    # a dictionary value is a leaf, not a node
+    with pytest.raises(ValueError, match="Conflicting key: a.b"):
+        misc.unflatten({"a": {}, "a.b": 2})
+    assert misc.unflatten({"a": {}, "b.c": {}}) == {"a": {}, "b": {"c": {}}}
+
+
+RECORDS = [
+    {"host": "h1", "cpu": {"user": 1.5, "idle": 90}, "tags": ["a"]},
+    {"host": "h2", "cpu": {"user": 2.5, "idle": 80}},
+    {"host": "h3", "cpu": {"user": 0.5, "idle": 70}, "up": True},
+    {"host": "h4", "cpu": {"user": 0.0, "idle": 2**70}, "up": False},
+]
+
+
+def test_flatten_columns():
+    columns = misc.flatten_columns(RECORDS[:3])
+    assert list(columns) == ["host", "cpu.user", "cpu.idle", "tags", "up"]
+    assert columns["host"] == ["h1", "h2", "h3"]
+    assert columns["cpu.user"] == array.array("d", [1.5, 2.5, 0.5])
+    assert columns["cpu.idle"] == array.array("q", [90, 80, 70])
+    assert columns["tags"] == [["a"], None, None]
+    assert columns["up"] == [None, None, True]
+
+
+def test_flatten_columns_no_array():
+    columns = misc.flatten_columns(RECORDS)
+    # int that does not fit in array and bool values
+    assert columns["cpu.idle"] == [90, 80, 70, 2**70]
+    assert columns["up"] == [None, None, True, False]
+
+
+def test_flatten_columns_list():
+    columns = misc.flatten_columns(iter(RECORDS[:2]), column_type="list", sep="_")
+    assert columns == {
+        "host": ["h1", "h2"],
+        "cpu_user": [1.5, 2.5],
+        "cpu_idle": [90, 80],
+        "tags": [["a"], None],
+    }
+    assert misc.flatten_columns([]) == {}
+
+
+def test_flatten_columns_numpy():
+    numpy = pytest.importorskip("numpy")
+    columns = misc.flatten_columns(RECORDS[:3], column_type="numpy")
+    assert isinstance(columns["cpu.user"], numpy.ndarray)
+    assert columns["cpu.idle"].tolist() == [90, 80, 70]
+
+
+def test_flatten_columns_error():
+    with pytest.raises(ValueError, match="Invalid column_type"):
+        misc.flatten_columns(RECORDS, column_type="xx")
+
+
+# vim: ts=4
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Test freeze function."""
+
+import collections.abc
+import pickle
+import pytest
+from pcof import misc
+
+
+def build_nested_dict():
+    mydict = misc.nested_dict()
+    mydict["a1"]["b1"]["c1"] = "test_1"
+    mydict["a1"]["b2"] = ["test_2", {"x": 1}]
+    mydict["a1"]["b3"] = {"s1", "s2"}
+    mydict["a2"]["b1"]["c1"] = "test_4"
+    return mydict
+
+
+def test_freeze():
+    frozen = misc.freeze(build_nested_dict())
+    assert isinstance(frozen, misc.FrozenDict)
+    assert frozen["a1"]["b1"]["c1"] == "test_1"
+    assert frozen["a1"]["b2"] == ("test_2", misc.FrozenDict(x=1))
+    assert frozen["a1"]["b3"] == frozenset(["s1", "s2"])
+    assert list(frozen) == ["a1", "a2"]
+    assert len(frozen["a1"]) == 3
+    values = frozen["a2"]["b1"].values()
+    assert isinstance(values, collections.abc.ValuesView)
+    assert list(values) == ["test_4"]
+    assert "test_4" in values
+    assert len(values) == 1
+    assert "b2" in frozen["a1"]
+    assert "b4" not in frozen["a1"]
+    assert frozen == {
+        "a1": {
+            "b1": {"c1": "test_1"},
+            "b2": ("test_2", {"x": 1}),
+            "b3": frozenset(["s1", "s2"]),
+        },
+        "a2": {"b1": {"c1": "test_4"}},
+    }
+
+
+def test_freeze_read_only():
+    frozen = misc.freeze({"a": {"b": 1}})
+    with pytest.raises(TypeError):
+        frozen["a"] = 2
+    with pytest.raises(TypeError):
+        frozen["a"]["c"] = 2
+    with pytest.raises(AttributeError):
+        frozen.x = 1
+    with pytest.raises(KeyError):
+        frozen["c"]
+
+
+def test_freeze_shared_index():
+    frozen = misc.freeze(build_nested_dict())
+    # nodes with the same keys share the key index
+    assert frozen["a1"]["b1"]._index is frozen["a2"]["b1"]._index
+    assert frozen["a1"]["b1"] != frozen["a2"]["b1"]
+    assert frozen["a1"]._index is not frozen["a2"]._index
+
+
+def test_freeze_hash():
+    frozen_1 = misc.freeze({"a": {"b": [1, 2]}, "c": 3})
+    frozen_2 = misc.freeze({"c": 3, "a": {"b": (1, 2)}})
+    assert frozen_1 == frozen_2
+    assert hash(frozen_1) == hash(frozen_2)
+    assert len({frozen_1, frozen_2}) == 1
+    assert misc.freeze({"a": [1]}) != misc.freeze({"a": [2]})
+
+
+def test_freeze_not_dict():
+    assert misc.freeze([1, {"a": 1}]) == (1, misc.FrozenDict(a=1))
+    assert misc.freeze("text") == "text"
+    frozen = misc.FrozenDict(a=1)
+    assert misc.freeze(frozen) is frozen
+
+
+def test_frozendict_repr_pickle():
+    frozen = misc.freeze({"a": {"b": 1}})
+    assert repr(frozen) == "FrozenDict({'a': FrozenDict({'b': 1})})"
+    assert pickle.loads(pickle.dumps(frozen)) == frozen
+
+
+# vim: ts=4
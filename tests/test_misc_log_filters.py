@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""Test RateLimitFilter, SamplingFilter and DuplicateFilter classes."""
+
+import logging
+import threading
+import pytest
+from pcof import misc
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(misc.time, "monotonic", lambda: now[0])
+    return now
+
+
+def log_lines(logger, start, end):
+    # same call site for all messages
+    for num in range(start, end):
+        logger.info("line %d", num)
+
+
+@pytest.fixture
+def filtered_logger(list_handler, make_logger):
+    def _filtered_logger(name, log_filter):
+        list_handler.addFilter(log_filter)
+        return make_logger(name, list_handler), list_handler
+
+    return _filtered_logger
+
+
+def test_rate_limit_filter(clock, filtered_logger):
+    logger, handler = filtered_logger(
+        "test_rate_limit", misc.RateLimitFilter(2, burst=3)
+    )
+    log_lines(logger, 0, 10)
+    for num in range(10, 15):
+        logger.info("other call site %d", num)
+    assert handler.messages == [
+        "line 0",
+        "line 1",
+        "line 2",
+        "other call site 10",
+        "other call site 11",
+        "other call site 12",
+    ]
+
+    # 1 second later: 2 new tokens
+    clock[0] += 1
+    log_lines(logger, 20, 25)
+    assert handler.messages[6:] == [
+        "line 20 (suppressed 7 similar messages)",
+        "line 21",
+    ]
+
+    # bucket is not refilled above burst
+    clock[0] += 100
+    log_lines(logger, 30, 35)
+    assert handler.messages[8:] == [
+        "line 30 (suppressed 3 similar messages)",
+        "line 31",
+        "line 32",
+    ]
+
+
+def test_rate_limit_filter_no_summary(clock, filtered_logger):
+    logger, handler = filtered_logger(
+        "test_rate_limit_no_summary", misc.RateLimitFilter(1, summary=False)
+    )
+    for num in range(3):
+        log_lines(logger, num, num + 2)
+        clock[0] += 1
+    assert handler.messages == ["line 0", "line 1", "line 2"]
+
+
+def test_rate_limit_filter_slow_rate(clock, filtered_logger):
+    log_filter = misc.RateLimitFilter(0.5)
+    assert log_filter.burst == 1
+    logger, handler = filtered_logger("test_rate_limit_slow_rate", log_filter)
+    log_lines(logger, 0, 2)
+    clock[0] += 2
+    log_lines(logger, 2, 3)
+    assert handler.messages == ["line 0", "line 2 (suppressed 1 similar messages)"]
+
+
+def test_sampling_filter(filtered_logger):
+    logger, handler = filtered_logger("test_sampling", misc.SamplingFilter(3))
+    for num in range(7):
+        logger.info("info %d", num)
+        logger.debug("debug %d", num)
+        logger.warning("warning %d", num)
+    assert handler.messages == [
+        "info 0",
+        "debug 0",
+        "warning 0",
+        "warning 1",
+        "warning 2",
+        "info 3",
+        "debug 3",
+        "warning 3",
+        "warning 4",
+        "warning 5",
+        "info 6",
+        "debug 6",
+        "warning 6",
+    ]
+
+
+def test_sampling_filter_loggers(list_handler):
+    log_filter = misc.SamplingFilter(
+        2, max_level=logging.WARNING, loggers=["test_sampling_app"]
+    )
+    handler = list_handler
+    handler.addFilter(log_filter)
+    for name in ("test_sampling_app", "test_sampling_app.db", "test_sampling_other"):
+        logger = logging.getLogger(name)
+        logger.propagate = False
+        logger.handlers = [handler]
+        for num in range(4):
+            logger.warning("%s %d", name, num)
+            logger.error("%s error %d", name, num)
+    assert handler.messages == [
+        "test_sampling_app 0",
+        "test_sampling_app error 0",
+        "test_sampling_app error 1",
+        "test_sampling_app 2",
+        "test_sampling_app error 2",
+        "test_sampling_app error 3",
+        "test_sampling_app.db 0",
+        "test_sampling_app.db error 0",
+        "test_sampling_app.db error 1",
+        "test_sampling_app.db 2",
+        "test_sampling_app.db error 2",
+        "test_sampling_app.db error 3",
+    ] + [
+        msg.format(num)
+        for num in range(4)
+        for msg in ("test_sampling_other {}", "test_sampling_other error {}")
+    ]
+
+
+def test_duplicate_filter(clock, filtered_logger):
+    logger, handler = filtered_logger("test_duplicate", misc.DuplicateFilter(10))
+    for num in range(5):
+        logger.info("same %d", num)
+        logger.error("same %d", num)
+        logger.info("other")
+    clock[0] += 9
+    logger.info("same %d", 5)
+    clock[0] += 1
+    logger.info("same %d", 6)
+    logger.info("same %d", 7)
+    clock[0] += 10
+    logger.info("same %d", 8)
+    assert handler.messages == [
+        "same 0",
+        "same 0",
+        "other",
+        "same 6 (suppressed 5 similar messages)",
+        "same 8 (suppressed 1 similar messages)",
+    ]
+
+
+def test_duplicate_filter_options(clock, filtered_logger):
+    log_filter = misc.DuplicateFilter(10, summary=False, max_entries=2)
+    logger, handler = filtered_logger("test_duplicate_options", log_filter)
+    logger.info("msg 1")
+    logger.info("msg 1")
+    logger.info("msg 2")
+    # max_entries reached, none expired: clear all
+    logger.info("msg 3")
+    assert len(log_filter._seen) == 1
+    clock[0] += 10
+    logger.info("msg 3")
+    clock[0] += 5
+    logger.info("msg 4")
+    # max_entries reached, remove expired (msg 3)
+    clock[0] += 5
+    logger.info("msg 5")
+    assert len(log_filter._seen) == 2
+    # not hashable message
+    logger.info(["msg"])
+    logger.info(["msg"])
+    assert handler.messages == [
+        "msg 1",
+        "msg 2",
+        "msg 3",
+        "msg 3",
+        "msg 4",
+        "msg 5",
+        "['msg']",
+        "['msg']",
+    ]
+
+
+def test_duplicate_filter_threads(filtered_logger):
+    log_filter = misc.DuplicateFilter(60, max_entries=50)
+    logger, handler = filtered_logger("test_duplicate_threads", log_filter)
+    errors = []
+
+    def log_messages(thread_num):
+        try:
+            for num in range(2000):
+                logger.info("thread {} message {}".format(thread_num, num))
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=log_messages, args=(num,)) for num in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(handler.messages) == 16000
+
+
+# vim: ts=4
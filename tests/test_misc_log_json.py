@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Test JsonFormatter class."""
+
+import json
+import logging
+import time
+from pcof import misc
+
+
+def make_record(msg="test %s", args=("x",), level=logging.INFO, **kwargs):
+    record = logging.LogRecord(
+        "test", level, "/tmp/mymodule.py", 10, msg, args, None, "myfunc"
+    )
+    record.__dict__.update(kwargs)
+    return record
+
+
+def test_json_formatter():
+    record = make_record()
+    output = misc.JsonFormatter().format(record)
+    assert json.loads(output) == {
+        "asctime": time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(record.created)),
+        "module": "mymodule",
+        "funcName": "myfunc",
+        "levelname": "INFO",
+        "message": "test x",
+    }
+    assert list(json.loads(output)) == [
+        "asctime",
+        "module",
+        "funcName",
+        "levelname",
+        "message",
+    ]
+
+
+def test_json_formatter_fields():
+    formatter = misc.JsonFormatter(fields=("name", "levelno", "message", "xx"))
+    record = make_record(msg='quote " and ünicode', args=())
+    assert formatter.format(record) == (
+        '{"name":"test","levelno":20,"message":"quote \\" and ünicode","xx":null}'
+    )
+
+
+def test_json_formatter_datefmt():
+    formatter = misc.JsonFormatter(fields=("asctime",), datefmt="%Y")
+    record = make_record()
+    assert json.loads(formatter.format(record)) == {
+        "asctime": time.strftime("%Y", time.localtime(record.created))
+    }
+
+
+def test_json_formatter_time_cache(monkeypatch):
+    calls = []
+
+    def strftime(fmt, timetuple):
+        calls.append(fmt)
+        return "time{}".format(len(calls))
+
+    monkeypatch.setattr(misc.time, "strftime", strftime)
+    formatter = misc.JsonFormatter(fields=("asctime",))
+    for created in (100.1, 100.5, 100.9, 101.0, 101.2):
+        record = make_record()
+        record.created = created
+        output = json.loads(formatter.format(record))
+    assert output == {"asctime": "time2"}
+    assert len(calls) == 2
+    assert formatter.formatTime(record, "%Y") == "time3"
+
+
+def test_json_formatter_extra():
+    calls = []
+
+    def expensive():
+        calls.append(1)
+        return [1, 2]
+
+    formatter = misc.JsonFormatter(fields=("message",))
+    handler = logging.Handler()
+    handler.setFormatter(formatter)
+    handler.emit = lambda record: handler.__dict__.setdefault(
+        "output", handler.format(record)
+    )
+    logger = logging.getLogger("test_json_formatter_extra")
+    logger.propagate = False
+    logger.handlers = [handler]
+    logger.setLevel(logging.INFO)
+
+    logger.debug("discarded", extra={"data": expensive})
+    assert calls == []
+    logger.info("kept", extra={"data": expensive, "obj": {1}})
+    assert calls == [1]
+    assert json.loads(handler.output) == {
+        "message": "kept",
+        "data": [1, 2],
+        "obj": "{1}",
+    }
+
+
+def test_json_formatter_exception():
+    formatter = misc.JsonFormatter(fields=("message",))
+    try:
+        raise KeyError("x")
+    except KeyError:
+        record = logging.getLogger("test").makeRecord(
+            "test", logging.ERROR, "f", 1, "error", (), misc.sys.exc_info()
+        )
+    record.stack_info = "Stack (most recent call last)"
+    output = json.loads(formatter.format(record))
+    assert output["message"] == "error"
+    assert output["exc_info"].startswith("Traceback")
+    assert output["exc_info"].endswith("KeyError: 'x'")
+    assert output["stack_info"] == "Stack (most recent call last)"
+
+
+# vim: ts=4
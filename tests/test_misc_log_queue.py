@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Test LogQueueHandler and LogQueueListener classes."""
+
+import logging
+import pytest
+from pcof import misc
+
+
+def test_log_queue(list_handler, make_logger):
+    queue_handler = misc.LogQueueHandler(100)
+    handler = list_handler
+    handler.setFormatter(logging.Formatter("%(levelname)s %(funcName)s %(message)s"))
+    listener = misc.LogQueueListener(queue_handler.queue, handler)
+    logger = make_logger("test_log_queue", queue_handler)
+
+    listener.start()
+    for num in range(50):
+        logger.info("line %d", num)
+    listener.stop()
+
+    assert handler.messages == [
+        "INFO test_log_queue line {}".format(num) for num in range(50)
+    ]
+    assert queue_handler.dropped == 0
+
+
+@pytest.mark.parametrize("overflow", ["drop", "count"])
+def test_log_queue_overflow(overflow, make_logger):
+    queue_handler = misc.LogQueueHandler(3, overflow=overflow)
+    logger = make_logger("test_log_queue_" + overflow, queue_handler)
+
+    for num in range(10):
+        logger.info("line %d", num)
+    assert queue_handler.dropped == 7
+    assert queue_handler.queue.qsize() == 3
+    records = [queue_handler.queue.get_nowait() for _ in range(3)]
+    assert [record.getMessage() for record in records] == [
+        "line 0",
+        "line 1",
+        "line 2",
+    ]
+
+    # queue has space, dropped records are reported (overflow count)
+    logger.info("line 10")
+    messages = []
+    while not queue_handler.queue.empty():
+        record = queue_handler.queue.get_nowait()
+        messages.append((record.levelname, record.getMessage()))
+    if overflow == "count":
+        assert messages == [
+            ("WARNING", "7 log records dropped, logging queue is full"),
+            ("INFO", "line 10"),
+        ]
+    else:
+        assert messages == [("INFO", "line 10")]
+    assert queue_handler.dropped == 7
+
+
+def test_log_queue_stop_full_queue(list_handler, make_logger):
+    queue_handler = misc.LogQueueHandler(2)
+    handler = list_handler
+    listener = misc.LogQueueListener(queue_handler.queue, handler)
+    logger = make_logger("test_log_queue_stop", queue_handler)
+
+    logger.info("line 1")
+    logger.info("line 2")
+    listener.start()
+    listener.stop()
+    assert handler.messages == ["line 1", "line 2"]
+
+
+def test_log_queue_exception(make_logger):
+    queue_handler = misc.LogQueueHandler(10)
+    logger = make_logger("test_log_queue_exception", queue_handler)
+    try:
+        raise KeyError("x")
+    except KeyError:
+        logger.exception("error")
+    record = queue_handler.queue.get_nowait()
+    assert record.getMessage().startswith("error\nTraceback")
+    assert record.exc_info is None
+
+
+def test_log_queue_error():
+    with pytest.raises(ValueError, match="Invalid overflow"):
+        misc.LogQueueHandler(10, overflow="xx")
+
+
+# vim: ts=4
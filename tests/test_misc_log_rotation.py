@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Test RotatingLogFileHandler class."""
+
+import gzip
+import os
+import time
+import pytest
+from pcof import misc
+
+
+def read_rotated(handler):
+    contents = []
+    for name in handler.rotated_files():
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(name, "rt") as fd:
+            contents.append(fd.read())
+    return contents
+
+
+def test_rotation_size(tmp_path, make_logger):
+    logfile = str(tmp_path / "app.log")
+    handler = misc.RotatingLogFileHandler(logfile, max_bytes=30)
+    logger = make_logger("test_rotation_size", handler)
+    for num in range(10):
+        logger.info("line %02d", num)  # 8 bytes per line
+    handler.close()
+
+    # rotated when file has 4 lines (32 bytes)
+    assert read_rotated(handler) == [
+        "line 00\nline 01\nline 02\nline 03\n",
+        "line 04\nline 05\nline 06\nline 07\n",
+    ]
+    with open(logfile) as fd:
+        assert fd.read() == "line 08\nline 09\n"
+    assert all(not name.endswith(".gz") for name in handler.rotated_files())
+
+
+def test_rotation_compress(tmp_path, make_logger):
+    logfile = str(tmp_path / "app.log")
+    handler = misc.RotatingLogFileHandler(logfile, max_bytes=30, compress=True)
+    logger = make_logger("test_rotation_compress", handler)
+    for num in range(10):
+        logger.info("line %02d", num)
+    handler.close()
+
+    rotated = handler.rotated_files()
+    assert len(rotated) == 2
+    assert all(name.endswith(".gz") for name in rotated)
+    assert read_rotated(handler)[1] == "line 04\nline 05\nline 06\nline 07\n"
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        ["app.log"] + [os.path.basename(name) for name in rotated]
+    )
+
+
+def test_rotation_backup_count(tmp_path, make_logger):
+    logfile = str(tmp_path / "app.log")
+    handler = misc.RotatingLogFileHandler(
+        logfile, max_bytes=1, backup_count=3, compress=True
+    )
+    logger = make_logger("test_rotation_backup_count", handler)
+    for num in range(10):
+        logger.info("line %02d", num)
+    handler.close()
+
+    assert read_rotated(handler) == ["line 06\n", "line 07\n", "line 08\n"]
+
+
+def test_rotation_max_total_bytes(tmp_path, make_logger):
+    logfile = str(tmp_path / "app.log")
+    handler = misc.RotatingLogFileHandler(
+        logfile, max_bytes=1, max_total_bytes=20, delay=True
+    )
+    logger = make_logger("test_rotation_max_total_bytes", handler)
+    for num in range(10):
+        logger.info("line %02d", num)
+    handler.close()
+
+    assert read_rotated(handler) == ["line 07\n", "line 08\n"]
+
+
+def test_rotation_time(tmp_path, monkeypatch, make_logger):
+    now = [time.time()]
+    monkeypatch.setattr(misc.time, "time", lambda: now[0])
+    logfile = str(tmp_path / "app.log")
+    handler = misc.RotatingLogFileHandler(logfile, when="M", interval=2, delay=True)
+    logger = make_logger("test_rotation_time", handler)
+
+    logger.info("line 1")
+    now[0] += 119
+    logger.info("line 2")
+    assert handler.rotated_files() == []
+    now[0] += 1
+    logger.info("line 3")
+    now[0] += 60
+    logger.info("line 4")
+    handler.close()
+
+    assert read_rotated(handler) == ["line 1\nline 2\n"]
+    with open(logfile) as fd:
+        assert fd.read() == "line 3\nline 4\n"
+
+
+def test_rotation_midnight():
+    handler = misc.RotatingLogFileHandler(os.devnull, when="midnight", delay=True)
+    now = time.mktime((2020, 12, 31, 15, 30, 0, 0, 0, -1))
+    assert handler._next_rollover(now) == time.mktime((2021, 1, 1, 0, 0, 0, 0, 0, -1))
+    handler.interval = 3
+    assert handler._next_rollover(now) == time.mktime((2021, 1, 3, 0, 0, 0, 0, 0, -1))
+    handler.close()
+
+
+def test_rotation_error(tmp_path, capsys, make_logger):
+    with pytest.raises(ValueError, match="Invalid when"):
+        misc.RotatingLogFileHandler(os.devnull, when="W")
+
+    # error in the background thread
+    logfile = str(tmp_path / "app.log")
+    handler = misc.RotatingLogFileHandler(logfile, max_bytes=1, compress=True)
+    logger = make_logger("test_rotation_error", handler)
+    handler._remove_old_files = lambda: os.remove(logfile + ".xx")
+    logger.info("line 1")
+    logger.info("line 2")
+    handler.close()
+    out, err = capsys.readouterr()
+    assert "FileNotFoundError" in err
+
+
+# vim: ts=4
@@ -14,6 +14,8 @@ from pcof import misc
         ("yellow", "test", "\033[0;33mtest\033[0m\n"),
         ("", "test", "test\n"),
         ("nocolor", "test", "test\n"),
+        (False, "test", "test\n"),
+        (None, "test", "test\n"),
     ],
 )
 def test_msg(capsys, color, msg, result):
@@ -46,6 +48,7 @@ def test_msg_stderr(capsys, color, msg, result):
         ("", "test", "", "test"),
         ("nocolor", "test", "--", "test--"),
         ("blue", "test", "", "\033[0;34mtest\033[0m"),
+        ("", "test", None, "test\n"),
     ],
 )
 def test_msg_end(capsys, color, msg, end, result):
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Test MsgWriter class."""
+
+import gc
+import io
+import pytest
+from pcof import misc
+
+
+class TTYStream(io.StringIO):
+    def isatty(self):
+        return True
+
+
+class CountStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+
+@pytest.mark.parametrize(
+    "color, msg, result",
+    [
+        ("red", "test", "\033[1;31mtest\033[0m\n"),
+        ("blue", "test", "\033[0;34mtest\033[0m\n"),
+        ("cyan", 10, "\033[0;36m10\033[0m\n"),
+        ("", "test", "test\n"),
+        ("nocolor", "test", "test\n"),
+    ],
+)
+def test_msgwriter_tty(color, msg, result):
+    output = TTYStream()
+    with misc.MsgWriter(output) as writer:
+        assert writer.colors is True
+        writer.write(color, msg)
+    assert output.getvalue() == result
+
+
+@pytest.mark.parametrize("color", ["red", "blue", "green", "", "nocolor"])
+def test_msgwriter_no_tty(color):
+    output = io.StringIO()
+    with misc.MsgWriter(output) as writer:
+        assert writer.colors is False
+        writer.write(color, "test", end="--")
+    assert output.getvalue() == "test--"
+
+
+def test_msgwriter_colors():
+    output = io.StringIO()
+    with misc.MsgWriter(output, colors=True) as writer:
+        writer.write("green", "test")
+    assert output.getvalue() == "\033[0;32mtest\033[0m\n"
+
+    output = TTYStream()
+    with misc.MsgWriter(output, colors=False) as writer:
+        writer.write("green", "test")
+    assert output.getvalue() == "test\n"
+
+
+def test_msgwriter_stdout(capsys):
+    writer = misc.MsgWriter()
+    writer.write("red", "test")
+    writer.close()
+    out, err = capsys.readouterr()
+    assert out == "test\n"
+
+
+def test_msgwriter_buffer_size():
+    output = CountStream()
+    writer = misc.MsgWriter(output, buffer_size=95, flush_interval=60)
+    for num in range(10):
+        writer.write("", "{:08d}".format(num))
+    # nothing written yet, 90 chars in buffer
+    assert output.getvalue() == ""
+    writer.write("", "12345678")
+    assert output.writes == 1
+    assert output.getvalue() == "".join("{:08d}\n".format(num) for num in range(10)) + (
+        "12345678\n"
+    )
+    writer.write("", "x")
+    assert output.writes == 1
+    writer.flush()
+    assert output.writes == 2
+    assert output.getvalue().endswith("12345678\nx\n")
+
+
+def test_msgwriter_no_buffer():
+    output = CountStream()
+    writer = misc.MsgWriter(output, buffer_size=0)
+    writer.write("", "a")
+    writer.write("", "b")
+    assert output.writes == 2
+    assert output.getvalue() == "a\nb\n"
+
+
+def test_msgwriter_flush_interval(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(misc.time, "monotonic", lambda: now[0])
+    output = io.StringIO()
+    writer = misc.MsgWriter(output, flush_interval=5)
+    writer.write("", "a")
+    now[0] += 4
+    writer.write("", "b")
+    assert output.getvalue() == ""
+    now[0] += 1
+    writer.write("", "c")
+    assert output.getvalue() == "a\nb\nc\n"
+
+
+def test_msgwriter_garbage_collected():
+    output = io.StringIO()
+
+    def write_lines():
+        writer = misc.MsgWriter(output)
+        for num in range(3):
+            writer.write("", num)
+
+    write_lines()
+    gc.collect()
+    assert output.getvalue() == "0\n1\n2\n"
+
+
+def test_msgwriter_error():
+    writer = misc.MsgWriter(io.StringIO())
+    with pytest.raises(ValueError, match="Invalid color"):
+        writer.write("invalid_color", "test")
+
+
+# vim: ts=4
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Test setup_logging and shutdown_logging functions."""
+
+import gzip
+import json
+import logging
+import time
+import pytest
+from pcof import misc
+
+
+@pytest.fixture
+def atexit_calls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(misc.atexit, "register", calls.append)
+    return calls
+
+
+def read_lines(logfile):
+    with open(logfile) as log:
+        return log.read().splitlines()
+
+
+def test_setup_logging_file(tmp_path, isolated_root_logger):
+    logfile = str(tmp_path / "test.log")
+    with isolated_root_logger() as root:
+        logger = misc.setup_logging(logfile, log_level="INFO", date_format="%Y")
+        assert logger.name == "pcof.misc"
+        assert root.level == logging.INFO
+        logging.getLogger("test").debug("not logged")
+        logging.getLogger("test").info("line 1")
+    lines = read_lines(logfile)
+    assert len(lines) == 1
+    assert lines[0].endswith(" test_setup_logging_file INFO line 1")
+
+
+def test_setup_logging_stderr(isolated_root_logger, capsys):
+    with isolated_root_logger():
+        misc.setup_logging()
+        logging.getLogger("test").warning("to stderr")
+    assert "WARNING to stderr" in capsys.readouterr().err
+
+
+def test_setup_logging_already_configured(tmp_path, isolated_root_logger):
+    logfile = str(tmp_path / "test.log")
+    with isolated_root_logger() as root:
+        misc.setup_logging(logfile)
+        logging.getLogger("test").info("line 1")
+        handlers = root.handlers[:]
+        # does nothing: the log file is not opened (truncated) again
+        logger = misc.setup_logging(logfile, filemode="w", use_queue=True)
+        assert logger.name == "pcof.misc"
+        assert root.handlers == handlers
+        assert misc._LOG_LISTENERS == []
+        logging.getLogger("test").info("line 2")
+    lines = read_lines(logfile)
+    assert [line.split(" INFO ")[1] for line in lines] == ["line 1", "line 2"]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"log_level": "TRACE"},
+        {"filemode": "x"},
+        {"log_format": "xml"},
+        {"max_bytes": 100},
+        {"rotate_when": "H"},
+        {"use_queue": True, "queue_overflow": "wait"},
+    ],
+)
+def test_setup_logging_invalid(isolated_root_logger, kwargs):
+    with isolated_root_logger() as root:
+        with pytest.raises(ValueError):
+            misc.setup_logging(**kwargs)
+        assert root.handlers == []
+
+
+def test_setup_logging_queue(tmp_path, isolated_root_logger, atexit_calls):
+    logfile = str(tmp_path / "test.log")
+    with isolated_root_logger() as root:
+        misc.setup_logging(logfile, use_queue=True, queue_size=10)
+        assert isinstance(root.handlers[0], misc.LogQueueHandler)
+        assert atexit_calls == [misc.shutdown_logging]
+        for num in range(100):
+            logging.getLogger("test").info("line %d", num)
+
+        misc.shutdown_logging()
+        # all records written, the file handler replaces the queue handler
+        assert len(read_lines(logfile)) == 100
+        assert misc._LOG_LISTENERS == []
+        assert len(root.handlers) == 1
+        assert isinstance(root.handlers[0], logging.FileHandler)
+        logging.getLogger("test").info("after shutdown")
+        root.handlers[0].flush()
+        assert read_lines(logfile)[-1].endswith("INFO after shutdown")
+
+        # nothing to stop
+        misc.shutdown_logging()
+    lines = read_lines(logfile)
+    assert [line.split(" INFO ")[1] for line in lines[:3]] == [
+        "line 0",
+        "line 1",
+        "line 2",
+    ]
+
+
+def test_setup_logging_queue_overflow(tmp_path, isolated_root_logger, atexit_calls):
+    logfile = str(tmp_path / "test.log")
+    with isolated_root_logger() as root:
+        misc.setup_logging(logfile, use_queue=True, queue_overflow="drop")
+        assert root.handlers[0].overflow == "drop"
+        logging.getLogger("test").info("line")
+    assert len(read_lines(logfile)) == 1
+
+
+@pytest.mark.parametrize("use_queue", [False, True])
+def test_setup_logging_json(tmp_path, isolated_root_logger, atexit_calls, use_queue):
+    logfile = str(tmp_path / "test.log")
+    with isolated_root_logger():
+        misc.setup_logging(
+            logfile, log_format="json", date_format="%Y", use_queue=use_queue
+        )
+        logging.getLogger("test").info("user %s", "x", extra={"request_id": 7})
+        misc.shutdown_logging()
+    record = json.loads(read_lines(logfile)[0])
+    assert record["asctime"] == time.strftime("%Y")
+    assert record["levelname"] == "INFO"
+    assert record["funcName"] == "test_setup_logging_json"
+    assert record["message"] == "user x"
+    assert record["request_id"] == 7
+
+
+def test_setup_logging_rotation(tmp_path, isolated_root_logger, atexit_calls):
+    logfile = str(tmp_path / "app.log")
+    with isolated_root_logger() as root:
+        misc.setup_logging(
+            logfile,
+            max_bytes=100,
+            backup_count=2,
+            compress=True,
+            use_queue=True,
+        )
+        for num in range(50):
+            logging.getLogger("test").info("line %02d", num)
+        misc.shutdown_logging()
+        handler = root.handlers[0]
+        assert isinstance(handler, misc.RotatingLogFileHandler)
+        assert handler.max_bytes == 100
+        handler.close()
+        rotated = handler.rotated_files()
+    assert len(rotated) == 2
+    assert all(name.endswith(".gz") for name in rotated)
+    with gzip.open(rotated[-1], "rt") as fd:
+        assert "INFO line" in fd.read()
+    assert read_lines(logfile)[-1].endswith("INFO line 49")
+
+
+def test_setup_logging_rotation_time(tmp_path, isolated_root_logger):
+    logfile = str(tmp_path / "app.log")
+    with isolated_root_logger() as root:
+        misc.setup_logging(
+            logfile, rotate_when="H", rotate_interval=6, max_total_bytes=1000
+        )
+        handler = root.handlers[0]
+        assert isinstance(handler, misc.RotatingLogFileHandler)
+        assert (handler.when, handler.interval) == ("H", 6)
+        assert handler.max_bytes == 0
+        assert handler.max_total_bytes == 1000
+        assert handler.compress is False
+
+
+@pytest.mark.parametrize("use_queue", [False, True])
+def test_setup_logging_filters(tmp_path, isolated_root_logger, atexit_calls, use_queue):
+    logfile = str(tmp_path / "test.log")
+    log_filter = misc.DuplicateFilter(60)
+    with isolated_root_logger() as root:
+        misc.setup_logging(logfile, filters=[log_filter], use_queue=use_queue)
+        # in queue mode, the filter runs before the record is queued
+        assert root.handlers[0].filters == [log_filter]
+        for _ in range(5):
+            logging.getLogger("test").info("same")
+        misc.shutdown_logging()
+        # the handler that replaces the queue handler keeps the filter
+        assert root.handlers[0].filters == [log_filter]
+        logging.getLogger("test").info("same")
+    lines = read_lines(logfile)
+    assert [line.split(" INFO ")[1] for line in lines] == ["same"]
+
+
+# vim: ts=4
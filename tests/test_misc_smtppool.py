@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""Test SMTPPool class."""
+
+import smtplib
+import threading
+import pytest
+from pcof import misc
+
+
+def make_pool(smtp_server, **kwargs):
+    return misc.SMTPPool("127.0.0.1", smtp_server.port, timeout=5, **kwargs)
+
+
+def test_smtppool_send(smtp_server):
+    with make_pool(smtp_server) as pool:
+        pool.send("me@example.com", "you@example.com", "subject 1", "body 1")
+        pool.send("me@example.com", ["a@example.com", "b@example.com"], "s", "b")
+        stats = pool.stats()
+
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 2
+    message = smtp_server.messages[0]
+    assert message["from"] == "me@example.com"
+    assert message["to"] == ["you@example.com"]
+    assert "Subject: subject 1" in message["data"]
+    assert "body 1" in message["data"]
+    assert smtp_server.messages[1]["to"] == ["a@example.com", "b@example.com"]
+    assert "To: a@example.com, b@example.com" in smtp_server.messages[1]["data"]
+
+    assert stats["sent"] == 2
+    assert stats["failed"] == 0
+    assert stats["connections"] == 1
+    assert stats["reconnects"] == 0
+    assert stats["send_time"] > 0
+    assert stats["messages_per_second"] > 0
+
+
+def test_smtppool_send_many(smtp_server):
+    smtp_server.reject.add("bad@example.com")
+    messages = [
+        ("me@example.com", "user{}@example.com".format(num), "s", "b")
+        for num in range(20)
+    ]
+    messages.insert(5, ("me@example.com", "bad@example.com", "s", "b"))
+
+    with make_pool(smtp_server) as pool:
+        failed = pool.send_many(iter(messages))
+        stats = pool.stats()
+
+    assert len(failed) == 1
+    assert failed[0][0] == messages[5]
+    assert isinstance(failed[0][1], smtplib.SMTPRecipientsRefused)
+    assert len(smtp_server.messages) == 20
+    assert smtp_server.connections == 1
+    assert stats["sent"] == 20
+    assert stats["failed"] == 1
+
+
+def test_smtppool_send_error(smtp_server):
+    smtp_server.reject.add("bad@example.com")
+    with make_pool(smtp_server) as pool:
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            pool.send("me@example.com", "bad@example.com", "s", "b")
+
+
+def test_smtppool_invalid_message(smtp_server):
+    messages = [
+        ("me@example.com", "you@example.com", "two\nlines", "b"),
+        ("me@example.com", "you@example.com", "caf\u00e9", "caf\u00e9"),
+    ]
+    with make_pool(smtp_server) as pool:
+        failed = pool.send_many(messages)
+    assert len(failed) == 1
+    assert failed[0][0] == messages[0]
+    assert isinstance(failed[0][1], ValueError)
+    assert len(smtp_server.messages) == 1
+    assert "caf\u00e9" in smtp_server.messages[0]["data"]
+
+
+def test_smtppool_max_messages(smtp_server):
+    with make_pool(smtp_server, max_messages=3) as pool:
+        for num in range(7):
+            pool.send("me@example.com", "you@example.com", "s", str(num))
+        assert pool.stats()["connections"] == 3
+    assert len(smtp_server.messages) == 7
+    assert smtp_server.connections == 3
+
+
+def test_smtppool_max_messages_send_many(smtp_server):
+    messages = [
+        ("me@example.com", "you@example.com", "s", str(num)) for num in range(20)
+    ]
+    with make_pool(smtp_server, max_messages=5) as pool:
+        assert pool.send_many(messages) == []
+        stats = pool.stats()
+    assert len(smtp_server.messages) == 20
+    assert smtp_server.connections == 4
+    assert stats["connections"] == 4
+    assert stats["reconnects"] == 0
+
+
+def test_smtppool_reconnect(smtp_server):
+    smtp_server.disconnect_after = 2
+    with make_pool(smtp_server) as pool:
+        for num in range(4):
+            pool.send("me@example.com", "you@example.com", "s", str(num))
+        stats = pool.stats()
+    assert len(smtp_server.messages) == 4
+    assert smtp_server.connections == 2
+    assert stats["reconnects"] == 1
+    assert stats["connections"] == 2
+    assert stats["sent"] == 4
+
+
+def test_smtppool_connection_error(smtp_server):
+    port = smtp_server.port
+    smtp_server.shutdown()
+    smtp_server.server_close()
+    pool = misc.SMTPPool("127.0.0.1", port, size=1, timeout=5)
+    with pytest.raises(OSError):
+        pool.send("me@example.com", "you@example.com", "s", "b")
+    # slot is released
+    with pytest.raises(OSError):
+        pool.send("me@example.com", "you@example.com", "s", "b")
+    assert pool.stats()["messages_per_second"] == 0.0
+
+
+def test_smtppool_threads(smtp_server):
+    pool = make_pool(smtp_server, size=2)
+
+    def send(num):
+        for msg_num in range(10):
+            pool.send("me@example.com", "you@example.com", "s", str(msg_num))
+
+    threads = [threading.Thread(target=send, args=(num,)) for num in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+
+    assert len(smtp_server.messages) == 50
+    assert smtp_server.connections <= 2
+    assert pool.stats()["sent"] == 50
+    with pytest.raises(RuntimeError, match="SMTPPool is closed"):
+        pool.send("me@example.com", "you@example.com", "s", "b")
+
+
+def test_smtppool_login(monkeypatch):
+    calls = []
+
+    class FakeSMTP:
+        def __init__(self, host, port, timeout):
+            calls.append(("connect", host, port, timeout))
+
+        def starttls(self):
+            calls.append(("starttls",))
+
+        def login(self, username, password):
+            calls.append(("login", username, password))
+            if password == "bad":
+                raise smtplib.SMTPAuthenticationError(535, "bad password")
+
+        def send_message(self, mail_msg, mail_from, mail_to):
+            calls.append(("send_message", mail_from, mail_to))
+
+        def quit(self):
+            calls.append(("quit",))
+            raise smtplib.SMTPServerDisconnected()
+
+        def close(self):
+            calls.append(("close",))
+
+    monkeypatch.setattr(misc.smtplib, "SMTP", FakeSMTP)
+    with misc.SMTPPool(
+        "mail", 587, username="user", password="pass", starttls=True
+    ) as pool:
+        pool.send("me@example.com", "you@example.com", "s", "b")
+    assert calls == [
+        ("connect", "mail", 587, 60),
+        ("starttls",),
+        ("login", "user", "pass"),
+        ("send_message", "me@example.com", "you@example.com"),
+        ("quit",),
+        ("close",),
+    ]
+
+    del calls[:]
+    pool = misc.SMTPPool("mail", username="user", password="bad")
+    with pytest.raises(smtplib.SMTPAuthenticationError):
+        pool.send("me@example.com", "you@example.com", "s", "b")
+    assert calls[-1] == ("close",)
+
+
+def test_smtppool_reconnect_fail(monkeypatch):
+    connections = []
+
+    class FakeSMTP:
+        def __init__(self, host, port, timeout):
+            connections.append(self)
+
+        def send_message(self, mail_msg, mail_from, mail_to):
+            raise smtplib.SMTPServerDisconnected()
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(misc.smtplib, "SMTP", FakeSMTP)
+    pool = misc.SMTPPool()
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        pool.send("me@example.com", "you@example.com", "s", "b")
+    assert len(connections) == 2
+    assert pool.stats()["reconnects"] == 1
+    assert pool.stats()["failed"] == 1
+
+
+# vim: ts=4